@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+
+# Guard the cold-start time of vauban.py: shell completion and --check are
+# run constantly, and must stay close to the python interpreter start time.
+# Times are the best of $RUNS runs, minus the time python itself takes to start
+
+set -eEuo pipefail
+
+RUNS="${RUNS:-10}"
+CONFIG_PATH="${CONFIG_PATH:-config.yml}"
+# Allowed overhead over a bare python start, in ms
+COMPLETION_BUDGET_MS="${COMPLETION_BUDGET_MS:-30}"
+CHECK_BUDGET_MS="${CHECK_BUDGET_MS:-250}"
+
+function best_time_ms() {
+    local best="" start end elapsed
+    for _ in $(seq 1 "$RUNS"); do
+        start="$(date +%s%N)"
+        "$@" > /dev/null
+        end="$(date +%s%N)"
+        elapsed="$(( (end - start) / 1000000 ))"
+        if [[ -z "$best" ]] || (( elapsed < best )); then
+            best="$elapsed"
+        fi
+    done
+    echo "$best"
+}
+
+function complete_name() {
+    _VAUBAN_COMPLETE=bash_complete COMP_WORDS="vauban --config-path $CONFIG_PATH --name " COMP_CWORD=4 python3 vauban.py
+}
+
+# Fill the config cache first, as a shell completion would
+python3 vauban.py --check --config-path "$CONFIG_PATH" --name "" > /dev/null || true
+# Read the whole completion before filtering it: an early exit of grep would
+# break the pipe under pipefail
+completion="$(complete_name)"
+master="$(grep -m 1 '^plain,' <<< "$completion" | cut -d, -f2 || true)"
+if [[ -z "$master" ]]; then
+    echo "Could not complete a master name from $CONFIG_PATH"
+    exit 1
+fi
+
+python_ms="$(best_time_ms python3 -c pass)"
+completion_ms="$(( $(best_time_ms complete_name) - python_ms ))"
+check_ms="$(( $(best_time_ms python3 vauban.py --check --config-path "$CONFIG_PATH" --name "$master" --stage initramfs) - python_ms ))"
+
+printf "%-12s %6s %8s\n" "" "ms" "budget"
+printf "%-12s %6s %8s\n" "python" "$python_ms" "-"
+printf "%-12s %6s %8s\n" "completion" "+$completion_ms" "+$COMPLETION_BUDGET_MS"
+printf "%-12s %6s %8s\n" "--check" "+$check_ms" "+$CHECK_BUDGET_MS"
+
+if (( completion_ms > COMPLETION_BUDGET_MS )) || (( check_ms > CHECK_BUDGET_MS )); then
+    echo "vauban.py startup is over budget"
+    exit 1
+fi
@@ -2,11 +2,26 @@
 
 import os
 import sys
+import asyncio
+import hashlib
+import json
 import click
+import secrets
+import subprocess
 import time
-from datetime import datetime, UTC
-from kubernetes import client, config, utils
-from kubernetes_controller_resources import cm_dockerfile, get_pod_kaniko_manifest
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import urllib3
+import vauban_tracing
+from kubernetes import client, config, utils, watch
+from kubernetes_controller_resources import (
+    WARM_POOL_SIZE,
+    cm_dockerfile,
+    get_pod_kaniko_manifest,
+    get_warm_pod_manifest,
+    warm_destination,
+)
 from kubernetes.stream import stream
 
 
@@ -18,9 +33,112 @@ try:
     config.load_kube_config()
 except:
     config.load_incluster_config()
-k8s_client = client.ApiClient()
+# How many pods the batch actions operate at the same time
+CONTROLLER_WORKERS = int(os.environ.get("KUBE_CONTROLLER_WORKERS", "32"))
+# How many pods end-batch talks to at the same time. Waiting for kaniko to
+# push an image doesn't count
+END_CONCURRENCY = int(os.environ.get("KUBE_END_CONCURRENCY", CONTROLLER_WORKERS))
+configuration = client.Configuration.get_default_copy()
+configuration.connection_pool_maxsize = CONTROLLER_WORKERS
+k8s_client = client.ApiClient(configuration)
 api_instance = client.CoreV1Api(k8s_client)
 NS = os.environ.get("KUBE_NAMESPACE", "vauban")
+# The pods created by vauban to build images
+KANIKO_SELECTOR = "vauban.corp.dblc.io/vauban-type=kaniko"
+# The host a pod of the warm pool was claimed for, its destination images
+HOST_LABEL = "vauban.corp.dblc.io/host"
+WARM_POOL_LABEL = "vauban.corp.dblc.io/warm-pool"
+DESTINATIONS_ANNOTATION = "vauban.corp.dblc.io/destinations"
+SOURCE_DIGEST_ANNOTATION = "vauban.corp.dblc.io/source-digest"
+
+
+class PodCache:
+    """
+    Informer-style local copy of the pods of a namespace matching a label
+    selector: they are listed once, then kept up to date by a watch in a
+    background thread. Lookups and waits don't call the apiserver
+    """
+
+    def __init__(self, namespace, label_selector):
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self._pods = {}
+        self._resource_version = None
+        self._condition = threading.Condition()
+        self._list()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _list(self):
+        pods = api_instance.list_namespaced_pod(
+            namespace=self.namespace, label_selector=self.label_selector
+        )
+        with self._condition:
+            self._pods = {pod.metadata.name: pod for pod in pods.items}
+            self._resource_version = pods.metadata.resource_version
+            self._condition.notify_all()
+
+    def _watch(self):
+        while True:
+            w = watch.Watch()
+            try:
+                for event in w.stream(
+                    api_instance.list_namespaced_pod,
+                    namespace=self.namespace,
+                    label_selector=self.label_selector,
+                    resource_version=self._resource_version,
+                    timeout_seconds=300,
+                ):
+                    pod = event["object"]
+                    with self._condition:
+                        self._resource_version = pod.metadata.resource_version
+                        if event["type"] == "DELETED":
+                            self._pods.pop(pod.metadata.name, None)
+                        else:
+                            self._pods[pod.metadata.name] = pod
+                        self._condition.notify_all()
+            except client.ApiException as e:
+                if e.status == 410:
+                    # Our resource version is too old: list the pods again
+                    self._list()
+                else:
+                    time.sleep(1)
+            except urllib3.exceptions.HTTPError:
+                time.sleep(1)
+            finally:
+                w.stop()
+
+    def get(self, name):
+        with self._condition:
+            return self._pods.get(name)
+
+    def list(self):
+        with self._condition:
+            return list(self._pods.values())
+
+    def watch(self, name, timeout):
+        """
+        Yield the pod as soon as it exists, then each time it changes, until
+        the timeout
+        """
+        deadline = time.monotonic() + timeout
+        last = None
+        while True:
+            with self._condition:
+                changed = self._condition.wait_for(
+                    lambda: self._pods.get(name) is not last,
+                    timeout=max(0, deadline - time.monotonic()),
+                )
+                pod = self._pods.get(name)
+            if not changed:
+                raise TimeoutError("Could not find the pod in time")
+            if pod is None:
+                raise RuntimeError(f"Pod {name} was deleted")
+            last = pod
+            yield pod
+
+
+# Started by the batch actions, which operate many pods of the namespace
+pod_cache = None
 
 
 def delete_finished_pod(namespace, pod):
@@ -30,51 +148,126 @@ def delete_finished_pod(namespace, pod):
         pass
 
 
+def find_pods(namespace, names):
+    """
+    Return the existing pods among the given names: from the pod cache if it
+    is running, else with one query per name
+    """
+    if pod_cache is not None and pod_cache.namespace == namespace:
+        # Including the pods of the warm pool claimed for these names
+        return [pod for pod in map(pod_cache.get, names) if pod is not None] + [
+            pod
+            for pod in pod_cache.list()
+            if (pod.metadata.labels or {}).get(HOST_LABEL) in names
+        ]
+    pods = []
+    for name in names:
+        pods += api_instance.list_namespaced_pod(
+            namespace=namespace, field_selector=f"metadata.name={name}"
+        ).items
+    return pods
+
+
 def check_if_pods_already_exists(namespace, pods):
     assert isinstance(pods, list)
 
     r = []
 
-    ret = api_instance.list_namespaced_pod(namespace=namespace)
-    for pod in ret.items:
-        if pod.metadata.name in pods:
-            if pod.status.phase in ["Pending", "Running"]:
-                r.append(pod.metadata.name)
-            else:
-                delete_finished_pod(namespace, pod.metadata.name)
+    for pod in find_pods(namespace, pods):
+        if pod.status.phase in ["Pending", "Running"]:
+            r.append(pod.metadata.name)
+        else:
+            delete_finished_pod(namespace, pod.metadata.name)
 
     return len(r) > 0, r
 
 
+POD_TIMEOUT = 600
+
+
+def watch_pod(namespace, name, timeout=POD_TIMEOUT):
+    """
+    Yield the pod as it is now, then each time it changes, until the timeout.
+    Relies on the watch API: changes come as soon as they happen, without
+    polling the apiserver
+    """
+    if pod_cache is not None and pod_cache.namespace == namespace:
+        yield from pod_cache.watch(name, timeout)
+        return
+    deadline = time.monotonic() + timeout
+    field_selector = f"metadata.name={name}"
+    resource_version = None
+    while time.monotonic() < deadline:
+        if resource_version is None:
+            pods = api_instance.list_namespaced_pod(
+                namespace=namespace, field_selector=field_selector
+            )
+            resource_version = pods.metadata.resource_version
+            for pod in pods.items:
+                yield pod
+        w = watch.Watch()
+        try:
+            for event in w.stream(
+                api_instance.list_namespaced_pod,
+                namespace=namespace,
+                field_selector=field_selector,
+                resource_version=resource_version,
+                timeout_seconds=max(1, int(deadline - time.monotonic())),
+            ):
+                pod = event["object"]
+                resource_version = pod.metadata.resource_version
+                if event["type"] == "DELETED":
+                    raise RuntimeError(f"Pod {name} was deleted")
+                yield pod
+        except client.ApiException as e:
+            if e.status != 410:
+                raise
+            # Our resource version is too old: list the pod again
+            resource_version = None
+        finally:
+            w.stop()
+    raise TimeoutError("Could not find the pod in time")
+
+
+def raise_pod_failed(namespace, name, pod):
+    logs = api_instance.read_namespaced_pod_log(
+        name=name, namespace=namespace, tail_lines=20
+    )
+    eprint(f"Logs from Pod {name}:\n{logs}\nStatus from Pod {name}:\n{pod.status}")
+    raise RuntimeError("Pod is in Error/Failed status")
+
+
+def is_pod_ready(pod):
+    return any(
+        condition.type == "Ready" and condition.status == "True"
+        for condition in pod.status.conditions or []
+    )
+
+
 def wait_for_and_get_running_pod(namespace, name):
-    log_els = ("Server listening on", "Debian release imported")
-    start = datetime.now(UTC)
-    while (datetime.now(UTC) - start).seconds < 600:
-        pod = api_instance.read_namespaced_pod(name=name, namespace=namespace)
+    """
+    Wait for the pod to be ready: its entrypoint reports it through the
+    readiness probe, whose result shows up in the pod status we watch
+    """
+    # Time spent waiting for the pod to be scheduled and its image pulled,
+    # then for its entrypoint to be ready
+    scheduling_start = time.time_ns()
+    running_since = None
+    for pod in watch_pod(namespace, name):
         if pod.status.phase == "Failed":
-            logs = api_instance.read_namespaced_pod_log(
-                name=name, namespace=namespace, tail_lines=20
-            )
-            print(f"Logs from Pod {name}:")
-            print(logs)
-            print(f"Status from Pod {name}:")
-            print(pod.status)
-            raise RuntimeError("Pod is in Error/Failed status")
+            raise_pod_failed(namespace, name, pod)
         if pod.status.phase == "Succeeded":
             raise RuntimeError("Pod finished before expectations")
-        if pod.status.phase == "Running":
-            try:
-                logs = api_instance.read_namespaced_pod_log(
-                    name=name, namespace=namespace, tail_lines=100
-                )
-            except:
-                time.sleep(1)
-                continue
-            for log_el in log_els:
-                if log_el in logs:
-                    return pod
-        time.sleep(1)
-    raise TimeoutError("Could not find the pod in time")
+        if pod.status.phase == "Running" and running_since is None:
+            running_since = time.time_ns()
+            vauban_tracing.record(
+                "pod_scheduling", scheduling_start, running_since, pod=name
+            )
+        if running_since is not None and is_pod_ready(pod):
+            vauban_tracing.record(
+                "pod_startup", running_since, time.time_ns(), pod=name
+            )
+            return pod
 
 
 def create_needed_resources(namespace):
@@ -102,65 +295,362 @@ def exec_in_pod(name, namespace, exec_command):
     )
 
 
-def update_imginfo(name, namespace, imginfo):
+def signal_end(name, namespace, imginfo):
+    """
+    Tell the pod that ansible is done with it, in a single exec session: its
+    imginfo is updated, then kaniko snapshots the filesystem and pushes it
+    """
     exec_command = [
         "/usr/bin/env",
         "bash",
         "-c",
-        f"echo -e {imginfo} | base64 -d >> /imginfo;",
+        f"echo -e {imginfo} | base64 -d >> /imginfo; echo success > /tmp/vauban_control;",
     ]
     exec_in_pod(name, namespace, exec_command)
 
 
-def create_pod(name, source, debian_release, destination, in_conffs, uuid):
+def pod_name(namespace, name):
+    """
+    Return the name of the pod building the given host: the host itself,
+    unless a pod of the warm pool was claimed for it
+    """
+    if pod_cache is not None and pod_cache.namespace == namespace:
+        if pod_cache.get(name) is not None:
+            return name
+        for pod in pod_cache.list():
+            if (pod.metadata.labels or {}).get(HOST_LABEL) == name:
+                return pod.metadata.name
+        return name
+    pods = api_instance.list_namespaced_pod(
+        namespace=namespace, label_selector=f"{HOST_LABEL}={name}"
+    ).items
+    return pods[0].metadata.name if pods else name
+
+
+def uses_warm_pool(in_conffs, debian_release=None):
+    """
+    Whether a build may start from the warm pool. A warm pod is started
+    before its host is known, and keeps its own kernel hostname, which a
+    running pod can't change: conffs builds, which configure a host, and
+    debian bootstraps always get their own pod
+    """
+    return WARM_POOL_SIZE > 0 and debian_release is None and in_conffs != "True"
+
+
+def warm_pool_key(source, in_conffs):
+    return hashlib.sha256(f"{source} {in_conffs}".encode()).hexdigest()[:16]
+
+
+@lru_cache(maxsize=None)
+def source_digest(source):
+    """
+    Return the digest the source image currently points to, or None if it
+    can't be found
+    """
+    result = subprocess.run(
+        ["skopeo", "inspect", "--format", "{{.Digest}}", "docker://" + source],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    return result.stdout.strip() or None
+
+
+def warm_pool_pods(source, in_conffs):
+    """
+    Return the unclaimed pods of the warm pool of a source image, deleting
+    the ones started from an outdated version of it
+    """
+    digest = source_digest(source)
+    pool = warm_pool_key(source, in_conffs)
+    pods = []
+    for pod in pod_cache.list():
+        labels = pod.metadata.labels or {}
+        if labels.get(WARM_POOL_LABEL) != pool or HOST_LABEL in labels:
+            continue
+        if pod.status.phase not in ["Pending", "Running"] or (
+            (pod.metadata.annotations or {}).get(SOURCE_DIGEST_ANNOTATION) != digest
+        ):
+            delete_finished_pod(NS, pod.metadata.name)
+            continue
+        pods.append(pod)
+    return pods
+
+
+def claim_warm_pod(name, source, destination, in_conffs, uuid):
+    """
+    Take a ready pod from the warm pool of the source image for the given
+    host, or return None. Pods are claimed by relabelling them, conditioned
+    on their resource version, so that two controllers can't claim the same
+    """
+    if source_digest(source) is None:
+        return None
+    for pod in warm_pool_pods(source, in_conffs):
+        if not is_pod_ready(pod):
+            continue
+        body = {
+            "metadata": {
+                "resourceVersion": pod.metadata.resource_version,
+                "labels": {"vauban.corp.dblc.io/uuid": str(uuid), HOST_LABEL: name},
+                "annotations": {DESTINATIONS_ANNOTATION: json.dumps(list(destination))},
+            }
+        }
+        try:
+            pod = api_instance.patch_namespaced_pod(pod.metadata.name, NS, body)
+        except client.ApiException as e:
+            if e.status in (404, 409):
+                # Claimed or deleted in the meantime
+                continue
+            raise
+        exec_in_pod(
+            pod.metadata.name,
+            NS,
+            ["/usr/bin/env", "bash", "-c", f"echo {name} > /tmp/vauban_host"],
+        )
+        return pod
+    return None
+
+
+def fill_warm_pool(source, in_conffs):
+    """
+    Start pods in the warm pool of a source image until it holds
+    WARM_POOL_SIZE of them. Doesn't wait for them to be ready
+    """
+    digest = source_digest(source)
+    if digest is None:
+        return
+    pool = warm_pool_key(source, in_conffs)
+    # Not from the cache, which may not show the pods claimed just before yet
+    unclaimed = api_instance.list_namespaced_pod(
+        NS, label_selector=f"{WARM_POOL_LABEL}={pool},!{HOST_LABEL}"
+    ).items
+    for _ in range(WARM_POOL_SIZE - len(unclaimed)):
+        name = f"vauban-warm-{pool}-{secrets.token_hex(4)}"
+        utils.create_from_dict(
+            k8s_client,
+            get_warm_pod_manifest(name, source, in_conffs, pool, digest),
+            namespace=NS,
+        )
+
+
+def copy_warm_image(pod):
+    """
+    Copy the image pushed by a pod of the warm pool to the destinations of
+    the host it was claimed for
+    """
+    destinations = (pod.metadata.annotations or {}).get(DESTINATIONS_ANNOTATION)
+    if destinations is None:
+        return
+    source = pod.spec.containers[0].args
+    source = next(arg for arg in source if arg.startswith("SOURCE="))[len("SOURCE=") :]
+    image = "docker://" + warm_destination(source, pod.metadata.name)
+    try:
+        for destination in json.loads(destinations):
+            subprocess.run(
+                ["skopeo", "copy", image, "docker://" + destination],
+                capture_output=True,
+                check=True,
+            )
+    finally:
+        # The tag of the pod is of no use once copied, or if it can't be
+        subprocess.run(["skopeo", "delete", image], capture_output=True, check=False)
+
+
+def start_pod(name, source, destination, in_conffs, uuid, debian_release=None):
+    if pod_cache is not None and uses_warm_pool(in_conffs, debian_release):
+        pod = claim_warm_pod(name, source, destination, in_conffs, uuid)
+        if pod is not None:
+            return pod.status.pod_ip
     kaniko_pod = get_pod_kaniko_manifest(
         name, source, debian_release, destination, in_conffs, uuid
     )
-    conflict, list_conflicts = check_if_pods_already_exists(NS, [name])
-    if conflict:
-        raise RuntimeError(f"Conflict from {list_conflicts}")
-    else:
-        utils.create_from_dict(k8s_client, kaniko_pod, namespace=NS)
+    utils.create_from_dict(k8s_client, kaniko_pod, namespace=NS)
     pod = wait_for_and_get_running_pod(NS, name)
-    print(pod.status.pod_ip)
     if pod is None:
         raise RuntimeError("Pod was not well created")
     return pod.status.pod_ip
 
 
+def create_pod(name, source, debian_release, destination, in_conffs, uuid):
+    conflict, list_conflicts = check_if_pods_already_exists(NS, [name])
+    if conflict:
+        raise RuntimeError(f"Conflict from {list_conflicts}")
+    pod_ip = start_pod(name, source, destination, in_conffs, uuid, debian_release)
+    print(pod_ip)
+    return pod_ip
+
+
 def wait_for_completed_pod(namespace, name):
-    start = datetime.now(UTC)
-    while (datetime.now(UTC) - start).seconds < 600:
-        pod = api_instance.read_namespaced_pod(name=name, namespace=namespace)
+    for pod in watch_pod(namespace, name):
         if pod.status.phase == "Failed":
             raise RuntimeError("Pod is in Error/Failed status")
         if pod.status.phase == "Succeeded":
             return pod
-        time.sleep(1)
-    raise TimeoutError("Could not find the pod in time")
 
 
 def end_pod(name, imginfo):
-    update_imginfo(name, NS, imginfo)
-    exec_in_pod(name, NS, ["/usr/bin/env", "bash", "-c", "touch /tmp/vauban_success;"])
-    wait_for_completed_pod(NS, name)
+    name = pod_name(NS, name)
+    signal_end(name, NS, imginfo)
+    # Once told so, kaniko snapshots the filesystem and pushes the image
+    with vauban_tracing.span("kaniko_snapshot_push", pod=name):
+        pod = wait_for_completed_pod(NS, name)
+        copy_warm_image(pod)
     logs = api_instance.read_namespaced_pod_log(name=name, namespace=NS, tail_lines=8)
-    print(f"Logs from Pod {name}:")
-    print(logs)
+    print(f"Logs from Pod {name}:\n{logs}")
     delete_finished_pod(NS, name)
 
 
-def cleanup(uuid):
-    ret = api_instance.list_namespaced_pod(namespace=NS)
-    for pod in ret.items:
-        if (
-            pod.metadata.labels is not None
-            and "vauban.corp.dblc.io/uuid" in pod.metadata.labels
-        ):
-            if pod.metadata.labels["vauban.corp.dblc.io/uuid"] == uuid:
-                api_instance.delete_namespaced_pod(
-                    pod.metadata.name, NS, grace_period_seconds=1
+async def end_pod_async(name, imginfo, semaphore, parent):
+    """
+    End a pod of a batch. The blocking client calls run in threads, the
+    semaphore caps how many of them talk to the pods at the same time.
+    Returns the outcome for the pod instead of raising
+    """
+    start = time.monotonic()
+    try:
+        with vauban_tracing.span("end_pod", parent=parent, pod=name) as context:
+            async with semaphore:
+                await asyncio.to_thread(signal_end, pod_name(NS, name), NS, imginfo)
+            with vauban_tracing.span("kaniko_snapshot_push", parent=context, pod=name):
+                pod = await asyncio.to_thread(
+                    wait_for_completed_pod, NS, pod_name(NS, name)
+                )
+                await asyncio.to_thread(copy_warm_image, pod)
+            async with semaphore:
+                logs = await asyncio.to_thread(
+                    api_instance.read_namespaced_pod_log,
+                    name=pod.metadata.name,
+                    namespace=NS,
+                    tail_lines=8,
                 )
+                await asyncio.to_thread(delete_finished_pod, NS, pod.metadata.name)
+    except Exception as e:  # pylint: disable=broad-except
+        return name, False, time.monotonic() - start, repr(e)
+    return name, True, time.monotonic() - start, logs
+
+
+async def end_pods_async(batch):
+    # A thread per pod: most of them just wait for kaniko
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=max(1, len(batch)))
+    )
+    semaphore = asyncio.Semaphore(END_CONCURRENCY)
+    parent = vauban_tracing.current()
+    return await asyncio.gather(
+        *(
+            end_pod_async(kwargs["name"], kwargs["imginfo"], semaphore, parent)
+            for kwargs in batch
+        )
+    )
+
+
+def read_batch(path):
+    """
+    Read a batch file: one JSON object per line, giving the arguments of the
+    operation for one pod
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_batch(operation, batch):
+    """
+    Run an operation for each pod of a batch, concurrently, sharing the same
+    API client. Raise once they are all done if any of them failed
+    """
+    parent = vauban_tracing.current()
+    results = {}
+    errors = {}
+
+    def run(kwargs):
+        with vauban_tracing.span(operation.__name__, parent=parent, pod=kwargs["name"]):
+            return operation(**kwargs)
+
+    with ThreadPoolExecutor(max_workers=CONTROLLER_WORKERS) as executor:
+        futures = {executor.submit(run, kwargs): kwargs["name"] for kwargs in batch}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                eprint(f"Pod {futures[future]} failed: {e!r}")
+                errors[futures[future]] = e
+    if errors:
+        raise RuntimeError(f"{len(errors)} pod(s) out of {len(batch)} failed")
+    return results
+
+
+def start_pod_cache():
+    global pod_cache  # pylint: disable=global-statement
+    pod_cache = PodCache(NS, KANIKO_SELECTOR)
+
+
+def create_pods(batch, uuid):
+    """
+    Create the pods of a batch, and print the IP of each of them once they
+    are all running, as "<name> <ip>" lines
+    """
+    start_pod_cache()
+    conflict, list_conflicts = check_if_pods_already_exists(
+        NS, [kwargs["name"] for kwargs in batch]
+    )
+    if conflict:
+        raise RuntimeError(f"Conflict from {list_conflicts}")
+    results = run_batch(start_pod, [{**kwargs, "uuid": uuid} for kwargs in batch])
+    for name, pod_ip in results.items():
+        print(name, pod_ip)
+
+
+def warm_pool(source, in_conffs):
+    """
+    Fill the warm pool of a source image, for builds known to come. The
+    pools are only filled this way: the sources of most stages change with
+    each build, their pods would never be claimed
+    """
+    if not uses_warm_pool(in_conffs):
+        eprint("No warm pool for conffs builds, or with KUBE_WARM_POOL_SIZE=0")
+        return
+    start_pod_cache()
+    fill_warm_pool(source, in_conffs)
+
+
+def end_pods(batch):
+    """
+    End the pods of a batch, all at once: their images are pushed, then they
+    are deleted. Print the outcome for each of them
+    """
+    start_pod_cache()
+    outcomes = asyncio.run(end_pods_async(batch))
+    failed = [outcome for outcome in outcomes if not outcome[1]]
+    for name, success, duration, details in outcomes:
+        if success:
+            print(f"Logs from Pod {name}:\n{details}")
+    print(f"Pods ended: {len(outcomes) - len(failed)} ok, {len(failed)} failed")
+    for name, success, duration, details in sorted(outcomes, key=lambda o: o[1]):
+        print(f"  {name:<40} {'ok' if success else 'FAILED':<6} {duration:>7.1f}s")
+        if not success:
+            eprint(f"Pod {name} failed: {details}")
+    if failed:
+        raise RuntimeError(f"{len(failed)} pod(s) out of {len(batch)} failed")
+
+
+def cleanup(uuid):
+    api_instance.delete_collection_namespaced_pod(
+        NS,
+        label_selector=f"vauban.corp.dblc.io/uuid={uuid}",
+        grace_period_seconds=1,
+    )
+
+
+def warm_pool_cleanup():
+    """
+    Delete the unclaimed pods of every warm pool, which no build cleans up.
+    Claimed ones belong to their build, and are deleted with it
+    """
+    api_instance.delete_collection_namespaced_pod(
+        NS,
+        label_selector=f"{WARM_POOL_LABEL},!{HOST_LABEL}",
+        grace_period_seconds=1,
+    )
 
 
 @click.command()
@@ -220,7 +710,23 @@ def cleanup(uuid):
     type=str,
     help="A UUID to identify all the pods created to an instance of vauban, to do some cleanup if needed",
 )
-def main(action, name, source, debian_release, destination, conffs, imginfo, uuid):
+@click.option(
+    "--batch",
+    default=None,
+    show_default=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="For the create-batch and end-batch actions: a file with the arguments for each pod, one JSON object per line",
+)
+def main(action, name, source, debian_release, destination, conffs, imginfo, uuid, batch):
+    with vauban_tracing.span(f"kubernetes_controller {action}", pod=name):
+        return run_action(
+            action, name, source, debian_release, destination, conffs, imginfo, uuid, batch
+        )
+
+
+def run_action(
+    action, name, source, debian_release, destination, conffs, imginfo, uuid, batch
+):
     match action:
         case "init":
             return create_needed_resources(NS)
@@ -228,8 +734,16 @@ def main(action, name, source, debian_release, destination, conffs, imginfo, uui
             return create_pod(name, source, debian_release, destination, conffs, uuid)
         case "end":
             return end_pod(name, imginfo)
+        case "create-batch":
+            return create_pods(read_batch(batch), uuid)
+        case "end-batch":
+            return end_pods(read_batch(batch))
         case "cleanup":
             return cleanup(uuid)
+        case "warm-pool":
+            return warm_pool(source, conffs)
+        case "warm-pool-cleanup":
+            return warm_pool_cleanup()
         case _:
             eprint(f"Action not defined: {action}")
 
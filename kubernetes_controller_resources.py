@@ -6,15 +6,45 @@ first_rootfs_script = (
     + """
 set -exo pipefail
 
+DEBIAN_MIRROR="${DEBIAN_MIRROR:-http://deb.debian.org/debian}"
+DEBIAN_CACHE=/var/cache/vauban-debian
+
 if [[ -n "$DEBIAN_APT_GET_PROXY" ]]; then
     echo 'Acquire::HTTP::Proxy "'"$DEBIAN_APT_GET_PROXY"'";' > /etc/apt/apt.conf.d/99-build-proxy
 fi
+
+# With the cache volume, the debootstrapped release is kept as a tarball
+# named after the date of its Release file, hence reused until the mirror
+# publishes a new one
+tarball=""
+if [[ -d "$DEBIAN_CACHE" ]] && /usr/lib/apt/apt-helper download-file "$DEBIAN_MIRROR/dists/$DEBIAN_RELEASE/Release" /tmp/Release; then
+    release_date="$(date -u -d "$(sed -n 's/^Date: //p' /tmp/Release)" +%Y%m%dT%H%M%SZ)"
+    tarball="$DEBIAN_CACHE/$DEBIAN_RELEASE-$release_date.tar"
+    if [[ -f "$tarball" ]]; then
+        echo "Using the cached debootstrap of $DEBIAN_RELEASE from $release_date"
+        cp "$tarball" /srv/vauban/rootfs/rootfs.tar
+        exit 0
+    fi
+fi
+
 apt-get update
 apt-get install -y debootstrap tar
-http_proxy=$DEBIAN_APT_GET_PROXY https_proxy=$DEBIAN_APT_GET_PROXY debootstrap --include=debconf-utils,openssh-client,openssl,openssh-server,sudo,python3,bash-completion,unattended-upgrades,xz-utils,file,curl,ca-certificates --exclude apparmor,ifupdown "$DEBIAN_RELEASE" "/mnt"
+cache_dir_arg=()
+if [[ -d "$DEBIAN_CACHE" ]]; then
+    mkdir -p "$DEBIAN_CACHE/debs"
+    cache_dir_arg=(--cache-dir="$DEBIAN_CACHE/debs")
+fi
+http_proxy=$DEBIAN_APT_GET_PROXY https_proxy=$DEBIAN_APT_GET_PROXY debootstrap "${cache_dir_arg[@]}" --include=debconf-utils,openssh-client,openssl,openssh-server,sudo,python3,bash-completion,unattended-upgrades,xz-utils,file,curl,ca-certificates --exclude apparmor,ifupdown "$DEBIAN_RELEASE" "/mnt" "$DEBIAN_MIRROR"
 mkdir -p /mnt/proc /mnt/dev /mnt/sys
 rm -rf /mnt/var/cache/apt/archives/*deb
 tar cf /srv/vauban/rootfs/rootfs.tar -C /mnt .
+if [[ -n "$tarball" ]]; then
+    # Atomically, as pods of other nodes may build the same release, and
+    # dropping the tarballs of older Release files
+    cp /srv/vauban/rootfs/rootfs.tar "$tarball.$HOSTNAME"
+    mv -f "$tarball.$HOSTNAME" "$tarball"
+    find "$DEBIAN_CACHE" -maxdepth 1 -name "$DEBIAN_RELEASE-*.tar" ! -name "${tarball##*/}" -delete
+fi
 """
 )
 
@@ -45,35 +75,46 @@ function run_sshd() {
     echo -e "PermitRootLogin yes\\nPasswordAuthentication no\\nPubkeyAuthentication yes\\nSubsystem sftp /usr/lib/openssh/sftp-server" > /tmp/vauban_sshd
     mkdir -p /run/sshd
     { /usr/sbin/sshd -D -e -f /tmp/vauban_sshd ; } &
+    # The readiness probe also checks that sshd accepts connections
+    echo sshd > /tmp/vauban_ready
+}
+
+function wait_for_end() {
+    # Block until the controller writes to the control FIFO, which it does
+    # once ansible is done with us. Opened read-write so that neither side
+    # blocks on open()
+    local message=""
+    exec 3<> /tmp/vauban_control
+    read -r -t "${END_TIMEOUT:-3600}" message <&3 || true
+    exec 3<&-
+    # Pods of the warm pool learn which host they build when claimed
+    [[ -f /tmp/vauban_host ]] && HOST_NAME="$(< /tmp/vauban_host)"
+    [[ "$message" == "success" ]]
 }
 
 function from_scratch_metadata_and_leave() {
-    echo "Debian release imported"  # Important log line as it will be used as a marker of success
+    echo "Debian release imported"
+    echo scratch > /tmp/vauban_ready
     # FIXME: add /imginfo and /packages files
-    :
-    for i in $(seq 1 3600); do
-        if [[ -f /tmp/vauban_success ]]; then
-            set +e
-            rm /tmp/vauban_*
-            echo -e "\n\
+    wait_for_end || exit 1
+    set +e
+    rm /tmp/vauban_*
+    echo -e "\n\
 ---\n\
 packages:\n\
 \n\
 - source: debootstrap\n\
   hostname: ${HOST_NAME}\n\
   packages: |" >> /packages
-            apt list --installed | sed -e 's/stable,stable/stable/g' | tail -n +2 > /tmp/apt-after
-            cat /tmp/apt-after | sed "s/^/          + /g" >> /packages
-            rm -rf /tmp/* /etc/apt/apt.conf.d/99-build-proxy
-            exit 0 ;
-        fi ;
-        sleep 1 ;
-    done ;
-    exit 1
+    apt list --installed | sed -e 's/stable,stable/stable/g' | tail -n +2 > /tmp/apt-after
+    cat /tmp/apt-after | sed "s/^/          + /g" >> /packages
+    rm -rf /tmp/* /etc/apt/apt.conf.d/99-build-proxy
+    exit 0
 }
 
 export INITRD=No
-rm -rf /tmp/vauban_success
+rm -rf /tmp/vauban_*
+mkfifo /tmp/vauban_control
 
 apt list --installed | sed -e 's/stable,stable/stable/g' > /tmp/apt-before
 printf 'Package: linux-*-rt-*\nPin: release *\nPin-Priority: -1\n' > /etc/apt/preferences.d/block-kernel-rt
@@ -87,23 +128,18 @@ rm -f /etc/apt/apt.conf.d/99-build-proxy || true
 [[ $FROM_SCRATCH == "false" ]] && run_sshd
 [[ $FROM_SCRATCH == "true" ]] && from_scratch_metadata_and_leave
 
-for i in $(seq 1 3600); do
-    if [[ -f /tmp/vauban_success ]]; then
-        set +e
-        rm /tmp/vauban_*
-        sed -i "/vauban_build/d" /root/.ssh/authorized_keys ;
-        echo -e "\n\
+wait_for_end || exit 1
+set +e
+rm /tmp/vauban_*
+sed -i "/vauban_build/d" /root/.ssh/authorized_keys
+echo -e "\n\
 - playbook: ${PLAYBOOK:-fixme}\n\
   hostname: ${HOST_NAME}\n\
   packages: |" >> /packages
-        apt list --installed | sed -e 's/stable,stable/stable/g' > /tmp/apt-after
-        diff /tmp/apt-before /tmp/apt-after | grep '^[<>]' | sed 's/</          -/g' | sed 's/>/          +/g' >> /packages
-        rm -rf /root/.ansible /tmp/* /etc/apt/apt.conf.d/99-build-proxy
-        exit 0 ;
-    fi ;
-    sleep 1 ;
-done ;
-exit 1
+apt list --installed | sed -e 's/stable,stable/stable/g' > /tmp/apt-after
+diff /tmp/apt-before /tmp/apt-after | grep '^[<>]' | sed 's/</          -/g' | sed 's/>/          +/g' >> /packages
+rm -rf /root/.ansible /tmp/* /etc/apt/apt.conf.d/99-build-proxy
+exit 0
 """
 )
 
@@ -111,6 +147,7 @@ dockerfile_txt = """ARG SOURCE
 FROM $SOURCE
 ARG HOST_NAME
 ARG IN_CONFFS
+ARG END_TIMEOUT
 RUN bash /srv/vauban/entrypoint.sh
 """
 
@@ -122,6 +159,16 @@ ADD ./rootfs/rootfs.tar /
 RUN bash -c "FROM_SCRATCH=true bash /srv/vauban/entrypoint.sh"
 """
 
+# The entrypoint writes /tmp/vauban_ready once the pod can be handed over to
+# ansible, with "sshd" in it when ansible connects through ssh
+READINESS_COMMAND = [
+    "/usr/bin/env",
+    "bash",
+    "-c",
+    "[[ -f /tmp/vauban_ready ]]"
+    " && { [[ $(< /tmp/vauban_ready) != sshd ]] || : > /dev/tcp/127.0.0.1/22; }",
+]
+
 cm_dockerfile = {
     "apiVersion": "v1",
     "kind": "ConfigMap",
@@ -135,6 +182,93 @@ cm_dockerfile = {
 }
 
 
+# Opt-in cache of the base images on the nodes: an init container pulls the
+# SOURCE image into a hostPath directory, where images are stored by digest,
+# unless it is already there. kaniko then takes it from there instead of the
+# registry, so each node downloads a base image only once
+KANIKO_CACHE = os.environ.get("KUBE_KANIKO_CACHE", "no") == "yes"
+KANIKO_CACHE_PATH = os.environ.get("KUBE_KANIKO_CACHE_PATH", "/var/cache/vauban/kaniko")
+KANIKO_CACHE_REPO = os.environ.get("KUBE_KANIKO_CACHE_REPO", "")
+
+
+# Opt-in cache of the debootstrapped Debian releases on the nodes, for the
+# pods building a rootfs from scratch
+DEBIAN_CACHE = os.environ.get("KUBE_DEBIAN_CACHE", "no") == "yes"
+DEBIAN_CACHE_PATH = os.environ.get("KUBE_DEBIAN_CACHE_PATH", "/var/cache/vauban/debian")
+
+
+def add_kaniko_cache(pod_kaniko, source):
+    kaniko = pod_kaniko["spec"]["containers"][0]
+    # The RUN layer must never be taken from the cache: it is where ansible
+    # configures the image
+    kaniko["args"] += [
+        "--cache=true",
+        "--cache-dir=/cache",
+        "--cache-run-layers=false",
+        "--cache-copy-layers=false",
+    ]
+    if KANIKO_CACHE_REPO:
+        kaniko["args"].append("--cache-repo=" + KANIKO_CACHE_REPO)
+    kaniko["volumeMounts"].append({"name": "kaniko-cache", "mountPath": "/cache"})
+    pod_kaniko["spec"]["volumes"].append(
+        {
+            "name": "kaniko-cache",
+            "hostPath": {"path": KANIKO_CACHE_PATH, "type": "DirectoryOrCreate"},
+        }
+    )
+    pod_kaniko["spec"].setdefault("initContainers", []).append(
+        {
+            "name": "warm-base-image",
+            "image": "gcr.io/kaniko-project/warmer:latest",
+            "args": ["--cache-dir=/cache", "--image=" + source],
+            "volumeMounts": [
+                {"name": "kaniko-cache", "mountPath": "/cache"},
+                {"name": "registryconfig", "mountPath": "/kaniko/.docker"},
+            ],
+        }
+    )
+
+
+# Resources of the build pods, so that the scheduler places them on nodes that
+# can hold them instead of piling them up until they get evicted. An empty
+# value leaves the request/limit unset
+POD_RESOURCES = {
+    kind: {
+        resource: os.environ.get(f"KUBE_POD_{resource.upper()}_{kind[:-1].upper()}", "")
+        for resource in ("cpu", "memory")
+    }
+    for kind in ("requests", "limits")
+}
+# "preferred" or "required" to spread the build pods of a run across nodes
+POD_ANTI_AFFINITY = os.environ.get("KUBE_POD_ANTI_AFFINITY", "no")
+
+
+def add_pod_scheduling(pod_kaniko, uuid):
+    resources = {
+        kind: {resource: value for resource, value in values.items() if value}
+        for kind, values in POD_RESOURCES.items()
+    }
+    resources = {kind: values for kind, values in resources.items() if values}
+    if resources:
+        pod_kaniko["spec"]["containers"][0]["resources"] = resources
+
+    term = {
+        "labelSelector": {"matchLabels": {"vauban.corp.dblc.io/uuid": str(uuid)}},
+        "topologyKey": "kubernetes.io/hostname",
+    }
+    if POD_ANTI_AFFINITY == "preferred":
+        anti_affinity = {
+            "preferredDuringSchedulingIgnoredDuringExecution": [
+                {"weight": 100, "podAffinityTerm": term}
+            ]
+        }
+    elif POD_ANTI_AFFINITY == "required":
+        anti_affinity = {"requiredDuringSchedulingIgnoredDuringExecution": [term]}
+    else:
+        return
+    pod_kaniko["spec"]["affinity"] = {"podAntiAffinity": anti_affinity}
+
+
 def get_pod_kaniko_manifest(name, source, debian_release, tags, in_conffs, uuid):
     pod_kaniko = {
         "apiVersion": "v1",
@@ -181,6 +315,11 @@ def get_pod_kaniko_manifest(name, source, debian_release, tags, in_conffs, uuid)
                         },
                     ],
                     "ports": [{"containerPort": 22}],
+                    "readinessProbe": {
+                        "exec": {"command": READINESS_COMMAND},
+                        "periodSeconds": 1,
+                        "failureThreshold": 1,
+                    },
                     "env": [
                         {
                             "name": "PATH",
@@ -235,5 +374,49 @@ def get_pod_kaniko_manifest(name, source, debian_release, tags, in_conffs, uuid)
                 {"name": "root", "mountPath": "/srv/vauban/rootfs"},
             ],
         }
+        if DEBIAN_CACHE:
+            init_container["volumeMounts"].append(
+                {"name": "debian-cache", "mountPath": "/var/cache/vauban-debian"}
+            )
+            pod_kaniko["spec"]["volumes"].append(
+                {
+                    "name": "debian-cache",
+                    "hostPath": {
+                        "path": DEBIAN_CACHE_PATH,
+                        "type": "DirectoryOrCreate",
+                    },
+                }
+            )
         pod_kaniko["spec"]["initContainers"] = [init_container]
+    if KANIKO_CACHE and source is not None:
+        add_kaniko_cache(pod_kaniko, source)
+    add_pod_scheduling(pod_kaniko, uuid)
+    return pod_kaniko
+
+
+# Optional pool of pods started ahead of time from a source image, ready to
+# be claimed for any host of a stage: they skip the cold start of a pod
+WARM_POOL_SIZE = int(os.environ.get("KUBE_WARM_POOL_SIZE", "0"))
+# How long a pod of the pool waits to be claimed and used, in seconds
+WARM_POOL_TTL = int(os.environ.get("KUBE_WARM_POOL_TTL", "86400"))
+
+
+def get_warm_pod_manifest(name, source, in_conffs, pool, source_digest):
+    # The host, hence the destinations, are only known when the pod is
+    # claimed: kaniko pushes to a tag of its own, copied at the end
+    pod_kaniko = get_pod_kaniko_manifest(
+        name, source, None, [warm_destination(source, name)], in_conffs, "warm-pool"
+    )
+    pod_kaniko["metadata"]["labels"]["vauban.corp.dblc.io/warm-pool"] = pool
+    pod_kaniko["metadata"]["annotations"] = {
+        "vauban.corp.dblc.io/source-digest": source_digest
+    }
+    pod_kaniko["spec"]["containers"][0]["args"] += [
+        "--build-arg",
+        f"END_TIMEOUT={WARM_POOL_TTL}",
+    ]
     return pod_kaniko
+
+
+def warm_destination(source, name):
+    return source.rsplit("/", 1)[0] + "/vauban-warm:" + name
@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name="vauban",
     version="1.0.0",
-    py_modules=["vauban"],
+    py_modules=["vauban", "vauban_squashfs", "vauban_tracing"],
     install_requires=[
         "Click",
         "pyyaml",
@@ -13,6 +13,7 @@ setup(
     entry_points={
         "console_scripts": [
             "vauban = vauban:vauban",
+            "vauban-squashfs-benchmark = vauban_squashfs:benchmark",
         ],
     },
 )
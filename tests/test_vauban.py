@@ -0,0 +1,218 @@
+import os
+import threading
+
+import pytest
+
+import vauban
+
+CONFIG = """
+configuration: {}
+debian-12:
+  stages: [base]
+  master-a:
+    stages: [a]
+    conffs: [host-a]
+    master-a1:
+      stages: [a1]
+  master-b:
+    stages: [b]
+"""
+
+
+@pytest.fixture
+def configuration(tmp_path, monkeypatch):
+    monkeypatch.setattr(vauban, "CONFIG_CACHE_DIR", str(tmp_path / "cache"))
+    path = tmp_path / "config.yml"
+    path.write_text(CONFIG)
+    return vauban.VaubanConfiguration(str(path))
+
+
+def build_config(stage, jobs=1, build_parents=0):
+    return vauban.BuildConfig(
+        name=(),
+        stage=stage,
+        branch=None,
+        debug=False,
+        check=False,
+        config_path="config.yml",
+        build_parents=build_parents,
+        conffs=None,
+        kubernetes_no_cleanup=False,
+        jobs=jobs,
+        no_stage_cache=False,
+    )
+
+
+def plan(configuration, names, cc):
+    graph = vauban.BuildGraph(cc.jobs)
+    for name in names:
+        configuration.get_master(name).plan(cc, graph)
+    graph._link()
+    return graph
+
+
+def test_shared_ancestors_are_planned_once(configuration):
+    graph = plan(
+        configuration,
+        ["master-a1", "master-b"],
+        build_config("rootfs", jobs=2, build_parents=-1),
+    )
+    assert sorted(graph.nodes) == [
+        ("debian-12", "rootfs"),
+        ("master-a", "rootfs"),
+        ("master-a1", "rootfs"),
+        ("master-b", "rootfs"),
+    ]
+    assert len(graph._unique_nodes()) == 4
+    rootfs = {name: node for (name, _), node in graph.nodes.items()}
+    assert rootfs["master-a1"].dependencies == [rootfs["master-a"]]
+    assert rootfs["master-a"].dependencies == [rootfs["debian-12"]]
+    assert rootfs["master-b"].dependencies == [rootfs["debian-12"]]
+    assert rootfs["debian-12"].dependencies == []
+
+
+def test_all_stages_share_a_node_with_one_job(configuration):
+    graph = plan(configuration, ["master-a"], build_config("all"))
+    (node,) = graph._unique_nodes()
+    assert [cc.stage for cc in node.ccs] == ["rootfs", "conffs", "initramfs"]
+    assert node.dependencies == []
+
+
+def test_stages_come_after_their_rootfs_with_jobs(configuration):
+    graph = plan(configuration, ["master-a"], build_config("trueall", jobs=2))
+    rootfs = graph.nodes[("master-a", "rootfs")]
+    assert len(graph._unique_nodes()) == 4
+    for stage in ["conffs", "initramfs", "kernel"]:
+        assert graph.nodes[("master-a", stage)].dependencies == [rootfs]
+
+
+def test_initramfs_of_a_release_are_not_built_concurrently(configuration):
+    graph = plan(
+        configuration, ["master-a", "master-b"], build_config("initramfs", jobs=2)
+    )
+    nodes = graph.nodes
+    # Their rootfs are not planned: built before
+    assert nodes[("master-a", "initramfs")].dependencies == []
+    assert nodes[("master-b", "initramfs")].dependencies == [
+        nodes[("master-a", "initramfs")]
+    ]
+
+
+def record_builds(monkeypatch, failing=()):
+    built = []
+    lock = threading.Lock()
+
+    def build_stages(self, ccs, background=False, trace_parent=None):
+        with lock:
+            built.append(f"{self.name}:{'+'.join(cc.stage for cc in ccs)}")
+        if self.name in failing:
+            raise RuntimeError(f"{self.name} failed")
+
+    monkeypatch.setattr(vauban.VaubanMaster, "_build_stages", build_stages)
+    return built
+
+
+def test_run_builds_dependencies_first(configuration, monkeypatch):
+    built = record_builds(monkeypatch)
+    masters, _ = configuration.match_masters(["master-a1", "master-b"])
+    vauban.build(masters, build_config("rootfs", jobs=3, build_parents=-1))
+    assert sorted(built) == [
+        "debian-12:rootfs",
+        "master-a1:rootfs",
+        "master-a:rootfs",
+        "master-b:rootfs",
+    ]
+    assert built[0] == "debian-12:rootfs"
+    assert built.index("master-a:rootfs") < built.index("master-a1:rootfs")
+
+
+def test_run_stops_at_the_first_failure(configuration, monkeypatch):
+    built = record_builds(monkeypatch, failing=["master-a"])
+    with pytest.raises(RuntimeError, match="master-a failed"):
+        vauban.build(
+            [configuration.get_master("master-a1")],
+            build_config("rootfs", jobs=2, build_parents=-1),
+        )
+    assert built == ["debian-12:rootfs", "master-a:rootfs"]
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    yaml = pytest.importorskip("yaml")
+    calls = []
+    safe_load = yaml.safe_load
+
+    def counting_safe_load(content):
+        calls.append(content)
+        return safe_load(content)
+
+    monkeypatch.setattr(yaml, "safe_load", counting_safe_load)
+    return calls
+
+
+def test_config_is_parsed_once(configuration, parses):
+    path = configuration.path
+    assert list(vauban.load_config(path)) == ["configuration", "debian-12"]
+    assert parses == []
+
+
+def test_config_touched_is_not_parsed_again(configuration, parses):
+    path = configuration.path
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert "debian-12" in vauban.load_config(path)
+    assert parses == []
+    # The cache now has the new mtime
+    assert vauban.read_config_cache(path)[1]
+
+
+def test_config_changed_is_parsed_again(configuration, parses):
+    path = configuration.path
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("debian-13:\n  stages: [base]\n")
+    assert "debian-13" in vauban.load_config(path)
+    assert len(parses) == 1
+    assert vauban.read_config_cache(path)[1]
+
+
+def test_corrupted_config_cache_is_ignored(configuration, parses):
+    path = configuration.path
+    with open(vauban.config_cache_path(path), "w", encoding="utf-8") as f:
+        f.write("{")
+    assert vauban.read_config_cache(path) == ({}, False)
+    assert "debian-12" in vauban.load_config(path)
+    assert len(parses) == 1
+
+
+def complete(monkeypatch, tmp_path, words, shell="bash"):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("_VAUBAN_COMPLETE", f"{shell}_complete")
+    monkeypatch.setenv("COMP_WORDS", words)
+    monkeypatch.setenv("COMP_CWORD", str(len(words.split()) - 1))
+    return vauban.fast_complete()
+
+
+def test_names_are_completed_from_the_config_cache(
+    configuration, tmp_path, monkeypatch, capsys
+):
+    assert complete(monkeypatch, tmp_path, "vauban --name master-")
+    assert capsys.readouterr().out.splitlines() == [
+        "plain,master-a",
+        "plain,master-a1",
+        "plain,master-b",
+    ]
+
+
+def test_completion_is_left_to_click_with_a_stale_cache(
+    configuration, tmp_path, monkeypatch, capsys
+):
+    with open(configuration.path, "a", encoding="utf-8") as f:
+        f.write("debian-13:\n  stages: [base]\n")
+    assert not complete(monkeypatch, tmp_path, "vauban --name deb")
+    assert capsys.readouterr().out == ""
+
+
+def test_completion_is_left_to_click_for_other_options(
+    configuration, tmp_path, monkeypatch
+):
+    assert not complete(monkeypatch, tmp_path, "vauban --stage r")
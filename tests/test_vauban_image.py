@@ -0,0 +1,194 @@
+import json
+import os
+import stat
+
+import pytest
+
+import vauban_image
+
+
+@pytest.fixture
+def overlay_whiteouts(tmp_path):
+    """
+    Skip where overlayfs whiteouts can't be made: they take root
+    """
+    try:
+        os.mknod(tmp_path / "whiteout", stat.S_IFCHR, os.makedev(0, 0))
+        os.setxattr(tmp_path, vauban_image.OPAQUE_XATTR, b"y")
+    except PermissionError:
+        pytest.skip("overlayfs whiteouts need root")
+    os.remove(tmp_path / "whiteout")
+    os.removexattr(tmp_path, vauban_image.OPAQUE_XATTR)
+
+
+def make_tree(root, files):
+    """
+    Create files, given as {relative path: content}, under root
+    """
+    for relative, content in files.items():
+        path = root / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(content)
+    return root
+
+
+def test_oci_whiteouts_are_converted(tmp_path, overlay_whiteouts):
+    layer = make_tree(
+        tmp_path / "layer",
+        {
+            "etc/hosts": "hosts",
+            "etc/.wh.passwd": "",
+            "var/.wh..wh..opq": "",
+            "var/lib/keep": "keep",
+        },
+    )
+    vauban_image.convert_whiteouts(layer)
+    assert sorted(os.listdir(layer / "etc")) == ["hosts", "passwd"]
+    assert vauban_image.is_whiteout(layer / "etc/passwd")
+    assert not vauban_image.is_whiteout(layer / "etc/hosts")
+    assert os.listdir(layer / "var") == ["lib"]
+    assert vauban_image.is_opaque(layer / "var")
+    assert not vauban_image.is_opaque(layer / "etc")
+    assert (layer / "var/lib/keep").read_text() == "keep"
+
+
+NOW = 1_000_000_000
+OLD = NOW - 2 * vauban_image.GC_GRACE_PERIOD
+
+
+def layer(name, size, last_used=OLD, images=()):
+    return vauban_image.StoredLayer(name * 64, size, last_used, set(images))
+
+
+def evicted(layers, budget, mounted=()):
+    return [
+        l.digest[0]
+        for l in vauban_image.layers_to_evict(layers, budget, set(mounted), NOW)
+    ]
+
+
+def test_unreferenced_layers_are_evicted_first():
+    layers = [
+        layer("a", 10, OLD - 20, images=["image"]),
+        layer("b", 10, OLD),
+        layer("c", 10, OLD - 10),
+    ]
+    assert evicted(layers, 20) == ["c"]
+    assert evicted(layers, 10) == ["c", "b"]
+    assert evicted(layers, 0) == ["c", "b", "a"]
+
+
+def test_nothing_is_evicted_under_the_budget():
+    assert evicted([layer("a", 10), layer("b", 10)], 20) == []
+
+
+def test_recently_used_layers_are_kept():
+    layers = [layer("a", 10, NOW - 60), layer("b", 10)]
+    assert evicted(layers, 0) == ["b"]
+
+
+def test_mounted_layers_are_kept():
+    layers = [layer("a", 10), layer("b", 10, OLD + 1)]
+    # Overlay mounts name their lower directories by a digest prefix
+    assert evicted(layers, 0, mounted=["a" * 12]) == ["b"]
+
+
+def test_gc_removes_the_images_of_evicted_layers(tmp_path, monkeypatch):
+    monkeypatch.setattr(vauban_image, "mounted_layers", set)
+    store = tmp_path
+    blobs = store / "oci_shared" / "sha256"
+    blobs.mkdir(parents=True)
+    (blobs / "config").write_text("{}")
+    (blobs / "manifest").write_text(
+        json.dumps(
+            {
+                "config": {"digest": "sha256:config"},
+                "layers": [{"digest": "sha256:" + "a" * 64}],
+            }
+        )
+    )
+    make_tree(
+        store / "image",
+        {"index.json": json.dumps({"manifests": [{"digest": "sha256:manifest"}]})},
+    )
+    for name in ["a", "b"]:
+        make_tree(store / "layers" / (name * 64), {"file": name})
+        metadata = store / "layers" / (name * 64 + ".json")
+        metadata.write_text(json.dumps({"diskUsage": 10}))
+        os.utime(metadata, (OLD, OLD))
+
+    evicted_layers = vauban_image.gc(str(store), 10)
+    assert [l.digest for l in evicted_layers] == ["b" * 64]
+    assert sorted(os.listdir(store / "layers")) == ["a" * 64, "a" * 64 + ".json"]
+    assert (store / "image").is_dir()
+
+    vauban_image.gc(str(store), 0)
+    assert os.listdir(store / "layers") == []
+    assert not (store / "image").exists()
+    # The blobs of the image removed are kept for the grace period
+    assert sorted(os.listdir(blobs)) == ["config", "manifest"]
+
+
+def test_merged_layers_apply_whiteouts(tmp_path, overlay_whiteouts):
+    lower = make_tree(
+        tmp_path / "lower",
+        {"etc/a": "lower", "etc/b": "lower", "var/x/y": "lower", "srv/s": "lower"},
+    )
+    upper = make_tree(tmp_path / "upper", {"etc/b": "upper", "var/x/z": "upper"})
+    os.mknod(upper / "etc/a", stat.S_IFCHR, os.makedev(0, 0))
+    os.setxattr(upper / "var/x", vauban_image.OPAQUE_XATTR, b"y")
+
+    entries = vauban_image.merge_layers([str(lower), str(upper)])
+    assert sorted(entries) == [
+        "etc",
+        "etc/b",
+        "srv",
+        "srv/s",
+        "var",
+        "var/x",
+        "var/x/z",
+    ]
+    assert entries["etc/b"] == str(upper / "etc/b")
+    assert entries["srv/s"] == str(lower / "srv/s")
+    assert entries["var/x"] == str(upper / "var/x")
+
+
+def test_union_entries_move_toslash_to_the_root(tmp_path):
+    layer = make_tree(
+        tmp_path / "layer",
+        {
+            "etc/hostname": "layer",
+            "etc/hosts": "layer",
+            "toslash/etc/hostname": "toslash",
+            "toslash/.hidden": "toslash",
+        },
+    )
+    added = make_tree(tmp_path / "added", {"etc/hostname": "added", "etc/ssh/key": ""})
+
+    entries = vauban_image.union_entries([str(layer)], str(added))
+    assert sorted(entries) == [
+        "etc",
+        "etc/hostname",
+        "etc/hosts",
+        "etc/ssh",
+        "etc/ssh/key",
+    ]
+    # The directories already there are kept
+    assert entries["etc"] == str(layer / "etc")
+    assert entries["etc/hosts"] == str(layer / "etc/hosts")
+    assert entries["etc/hostname"] == str(added / "etc/hostname")
+
+    entries = vauban_image.union_entries(
+        [str(layer)], str(added), added_over_toslash=False
+    )
+    assert entries["etc/hostname"] == str(layer / "toslash/etc/hostname")
+    assert entries["etc/ssh/key"] == str(added / "etc/ssh/key")
+
+
+def test_excludes_match_from_the_root():
+    patterns = ["var/log", "var/lib/apt/lists/*"]
+    assert vauban_image.excluded("var/log", patterns)
+    assert vauban_image.excluded("var/log/syslog", patterns)
+    assert vauban_image.excluded("var/lib/apt/lists/partial/x", patterns)
+    assert not vauban_image.excluded("var/lib/apt/lists", patterns)
+    assert not vauban_image.excluded("usr/var/log", patterns)
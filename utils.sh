@@ -59,8 +59,10 @@ function cleanup() {
     umount linux-build/merged > /dev/null 2> /dev/null || true
     losetup -D > /dev/null 2> /dev/null || true
 
-    # Remove our locks
-    find "$BUILD_PATH" "$KUBE_IMAGE_DOWNLOAD_PATH" -maxdepth 2 -type f -name "*.vauban.lock" -exec bash -c 'file="$1" ; [[ "'$$'" = "$(cat "$file")" ]] && rm "$file"' bash {} \; 2> /dev/null
+    # Unmount the rootfs assembled as overlays, by us or our subshells, like
+    # the conffs workers. Our locks go with us
+    release_locks all
+    rm -rf "$VAUBAN_LOCK_REGISTRY"
 
     "${_arg_build_engine}"_cleanup_build_engine
 }
@@ -119,6 +121,8 @@ function catch_err() {
     if [[ "$$" == "$BASHPID" ]]; then
         end 1
     else
+        # Killed along with the process group, a subshell doesn't run end()
+        [[ -z "${trace_root_span:-}" ]] || trace_close_spans ERROR
         PGID="$(get_pgid)"
         kill -10 -- "$PGID"
         sleep 1
@@ -132,7 +136,17 @@ function end() {
     trap '' EXIT
     set +xeE
     [[ -z "$(jobs -p)" ]] || kill "$(jobs -p)" 2> /dev/null
+    if [[ -n "${trace_root_span:-}" ]]; then
+        trace_close_spans "$([[ -z "$return_code" || "$return_code" == "0" ]] && echo OK || echo ERROR)"
+    fi
     if [[ "$$" == "$BASHPID" ]]; then
+        if [[ -n "${trace_root_span:-}" ]]; then
+            VAUBAN_TRACEPARENT="00-${VAUBAN_TRACEPARENT:3:32}-$trace_root_span-01"
+            trace_write vauban.sh "$trace_root_span" "$trace_root_parent" "$trace_root_start" \
+                "$([[ -z "$return_code" || "$return_code" == "0" ]] && echo OK || echo ERROR)" \
+                name="${_arg_name:-}" stages="${_arg_stages[*]:-}"
+            [[ "$trace_summarize" == "no" ]] || trace_summary
+        fi
         if [[ -z "$return_code" ]] || [[ "$return_code" == "0" ]]; then
             print_recap "$return_code"
         fi
@@ -144,6 +158,9 @@ function end() {
             cat "$STACKTRACE_FILE" >&2
         fi
         cleanup
+    else
+        # A subshell, like a session stage: the main shell cleans up the rest
+        release_locks
     fi
     [[ -z "$return_code" ]] || exit "$return_code"
 }
@@ -230,7 +247,11 @@ function prepare_debian_release() {
 }
 
 
+ANSIBLE_REPO_FETCHED="no"
 function clone_ansible_repo() {
+    if [[ "$ANSIBLE_REPO_FETCHED" == "yes" ]]; then
+        return
+    fi
     GIT_SSH_COMMAND="ssh -i $(pwd)/$_arg_ssh_priv_key -o IdentitiesOnly=yes -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
     export GIT_SSH_COMMAND
     if [[ ! -d ansible ]]; then
@@ -241,6 +262,7 @@ function clone_ansible_repo() {
     git config --global --add safe.directory "$(pwd)"
     git fetch 2> /dev/null
     )
+    ANSIBLE_REPO_FETCHED="yes"
 }
 
 function get_conffs_hosts() {
@@ -273,6 +295,7 @@ function wait_pids() {
         return_code=0
         wait "${local_pids[i]}" || let "return_code=1"
         if [[ "$return_code" != 0 ]]; then
+            vauban_log "   - Failed for ${local_hosts_built[i]:-pid ${local_pids[i]}}"
             must_exit="yes"  # one fail - everyone fail. No one's left behind !
         fi
     done
@@ -317,6 +340,70 @@ function retry() {
     done
 }
 
+# The file descriptors of the locks held with lock_hold, by lock file
+[[ -v VAUBAN_LOCK_FDS ]] || declare -gA VAUBAN_LOCK_FDS=()
+# The locks held by this process and its subshells, one file per lock and
+# process holding it, so that cleanup sees the ones taken in subshells
+[[ -v VAUBAN_LOCK_REGISTRY ]] || VAUBAN_LOCK_REGISTRY="$(mktemp -d -p /tmp/vauban)"
+
+function lock_hold() {
+    # lock_hold <shared|exclusive> <lock file>
+    # Take an advisory lock on a file, waiting up to VAUBAN_LOCK_TIMEOUT
+    # seconds for the holders of a conflicting one, until lock_release or
+    # the end of the process. Locks of dead processes vanish with them
+    local mode="$1"
+    local file="$2"
+    local fd
+    exec {fd}>> "$file"
+    if ! flock "--$mode" --timeout "${VAUBAN_LOCK_TIMEOUT:-3600}" "$fd"; then
+        exec {fd}>&-
+        vauban_log "Timed out waiting for the lock on $file. Is another Vauban instance using these files ?"
+        return 1
+    fi
+    VAUBAN_LOCK_FDS["$file"]="$fd"
+    echo "$file" > "$VAUBAN_LOCK_REGISTRY/$BASHPID${file//\//_}"
+}
+
+function lock_release() {
+    local file="$1"
+    if [[ -n "${VAUBAN_LOCK_FDS["$file"]:-}" ]]; then
+        exec {VAUBAN_LOCK_FDS["$file"]}>&-
+        unset 'VAUBAN_LOCK_FDS[$file]'
+    fi
+    rm -f "$VAUBAN_LOCK_REGISTRY/$BASHPID${file//\//_}"
+}
+
+function release_locks() {
+    # release_locks [all]
+    # Unmount the rootfs assembled as overlays under the locks held by this
+    # process, or by every process of the build, and forget these locks
+    local entry file
+    local prefix="${BASHPID}_"
+    [[ "${1:-}" != "all" ]] || prefix=""
+    for entry in "$VAUBAN_LOCK_REGISTRY/$prefix"*; do
+        [[ -f "$entry" ]] || continue
+        file="$(cat "$entry")"
+        if mountpoint -q "${file%.vauban.lock}" 2> /dev/null; then
+            umount "${file%.vauban.lock}" || true
+        fi
+        lock_release "$file"
+        rm -f "$entry"
+    done
+}
+
+function with_lock() {
+    # with_lock <shared|exclusive> <lock file> <command...>
+    # Run a command holding a lock, see lock_hold
+    local mode="$1"
+    local file="$2"
+    shift 2
+    local rc=0
+    lock_hold "$mode" "$file" || return 1
+    "$@" || rc=$?
+    lock_release "$file"
+    return "$rc"
+}
+
 function docker_push() {
     local img_name="$1"
 
@@ -367,13 +454,121 @@ else
     vauban_log_path=/tmp/vauban
 fi
 vauban_start_time="$(date --iso-8601=seconds | tr : _ | cut -d '+' -f1)"
-recap_file="$vauban_log_path/$vauban_start_time-vauban.log"
-ansible_recap_file="$vauban_log_path/$vauban_start_time-vauban-ansible.log"
+recap_file="$vauban_log_path/$vauban_start_time-$$-vauban.log"
+ansible_recap_file="$vauban_log_path/$vauban_start_time-$$-vauban-ansible.log"
 
 function vauban_log() {
     printf "[%+15s] %s\n" "$PROCESS_NAME" "$@" | tee -a "$recap_file"
 }
 
+# Build tracing: each phase of the build is recorded as a span, one JSON
+# object per line in $trace_file, in a format close to OTLP JSON. Children
+# processes (kubernetes_controller.py) write their spans to the same file,
+# under the span given to them by VAUBAN_TRACEPARENT
+trace_file="${VAUBAN_TRACE_FILE:-$vauban_log_path/$vauban_start_time-$$-vauban-trace.jsonl}"
+export VAUBAN_TRACE_FILE="$trace_file"
+
+function trace_new_id() {
+    od -An -N"$1" -tx1 /dev/urandom | tr -d ' \n'
+}
+
+function trace_write() {
+    local name="$1"
+    local span_id="$2"
+    local parent_span_id="$3"
+    local start="$4"
+    local status="$5"
+    shift 5
+
+    jq -nc \
+        --arg trace_id "${VAUBAN_TRACEPARENT:3:32}" \
+        --arg span_id "$span_id" \
+        --arg parent_span_id "$parent_span_id" \
+        --arg name "$name" \
+        --argjson start_time "$start" \
+        --argjson end_time "${EPOCHREALTIME//[!0-9]/}000" \
+        --arg status "$status" \
+        '{traceId: $trace_id, spanId: $span_id, parentSpanId: $parent_span_id, name: $name,
+          startTimeUnixNano: $start_time, endTimeUnixNano: $end_time,
+          attributes: ([$ARGS.positional[] | capture("^(?<key>[^=]*)=(?<value>.*)$")] | from_entries),
+          status: {code: $status}}' \
+        --args "$@" >> "$trace_file" 2> /dev/null || true
+}
+
+function trace_span() {
+    # Run a command in the current shell, and record the time it took:
+    #   trace_span <name> [key=value ...] -- <command> [args ...]
+    local name="$1"
+    shift
+    local attributes=()
+    while [[ "$1" != "--" ]]; do
+        attributes+=("$1")
+        shift
+    done
+    shift
+    local parent="$VAUBAN_TRACEPARENT"
+    local span_id start return_code entry
+    span_id="$(trace_new_id 8)"
+    start="${EPOCHREALTIME//[!0-9]/}000"
+
+    VAUBAN_TRACEPARENT="00-${parent:3:32}-$span_id-01"
+    # A failing command exits through the ERR trap, before it returns here:
+    # end() writes the spans left open by this process
+    printf -v entry '%s\x1f' "$BASHPID" "$name" "$span_id" "${parent:36:16}" "$start" "${attributes[@]}"
+    trace_open_spans+=("$entry")
+    "$@"
+    return_code=$?
+    unset 'trace_open_spans[-1]'
+    VAUBAN_TRACEPARENT="$parent"
+    trace_write "$name" "$span_id" "${parent:36:16}" "$start" "$([[ $return_code == 0 ]] && echo OK || echo ERROR)" "${attributes[@]}"
+    return "$return_code"
+}
+
+function trace_close_spans() {
+    # Write the spans this process left open, the innermost first, with the
+    # status of the run
+    local status="$1"
+    local i fields
+    for (( i = ${#trace_open_spans[@]} - 1; i >= 0; i-- )); do
+        IFS=$'\x1f' read -r -a fields <<< "${trace_open_spans[i]}"
+        [[ "${fields[0]}" == "$BASHPID" ]] || continue
+        trace_write "${fields[1]}" "${fields[2]}" "${fields[3]}" "${fields[4]}" "$status" "${fields[@]:5}"
+    done
+    trace_open_spans=()
+}
+
+function trace_summary() {
+    [[ -s "$trace_file" ]] || return 0
+    vauban_log "Time spent per phase (trace file: $trace_file)"
+    vauban_log "$(printf "  %-40s %6s %10s %10s" span count total max)"
+    jq -rs --arg trace_id "${VAUBAN_TRACEPARENT:3:32}" '
+        map(select(.traceId == $trace_id))
+        | group_by(.name)
+        | map({name: .[0].name, count: length, durations: map((.endTimeUnixNano - .startTimeUnixNano) / 1e9)})
+        | sort_by(-(.durations | add))
+        | .[] | [.name, .count, (.durations | add), (.durations | max)] | @tsv' "$trace_file" \
+        | while IFS=$'\t' read -r name count total longest; do
+            vauban_log "$(printf "  %-40s %6d %9.1fs %9.1fs" "$name" "$count" "$total" "$longest")"
+        done
+}
+
+# The root span, covering the whole run, is written by end(). It continues
+# the trace of the caller (vauban.py) if any, which then summarizes it
+if [[ -z "${trace_root_span:-}" ]]; then
+    trace_open_spans=()
+    trace_root_span="$(trace_new_id 8)"
+    trace_root_start="${EPOCHREALTIME//[!0-9]/}000"
+    if [[ "${VAUBAN_TRACEPARENT:-}" =~ ^00-([0-9a-f]{32})-([0-9a-f]{16})-01$ ]]; then
+        trace_root_parent="${BASH_REMATCH[2]}"
+        trace_summarize="no"
+    else
+        VAUBAN_TRACEPARENT="00-$(trace_new_id 16)-0000000000000000-01"
+        trace_root_parent=""
+        trace_summarize="yes"
+    fi
+    export VAUBAN_TRACEPARENT="00-${VAUBAN_TRACEPARENT:3:32}-$trace_root_span-01"
+fi
+
 function print_recap() {
     set "+x"
 
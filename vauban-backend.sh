@@ -14,14 +14,121 @@ function end_stage_for_host() {
     "${_arg_build_engine}"_end_stage_for_host "$@"
 }
 
+function stage_wave_size() {
+    # How many of the given number of hosts a stage is applied to at once.
+    # Build engines limiting their number of containers/pods in flight
+    # provide ${engine}_stage_wave_size
+    if declare -F "${_arg_build_engine}"_stage_wave_size > /dev/null; then
+        "${_arg_build_engine}"_stage_wave_size "$1"
+    else
+        echo "$1"
+    fi
+}
+
+function stage_names_for_host() {
+    # Set local_prefix, local_source_name and local_final_name, the names of
+    # the images of a stage for a host. Conffs have an image per host
+    local host="$1"
+    local source_name="$2"
+    local prefix_name="$3"
+    local final_name="$4"
+    local is_conffs="$5"
+
+    if [[ "$is_conffs" == "yes" ]]; then
+        local_prefix="$prefix_name/$host"
+        local_source_name="${source_name//HOSTNAME/$host}"
+        if [[ -z "$final_name" ]]; then
+            local_final_name=""
+        else
+            local_final_name="$final_name/$host"
+        fi
+    else
+        local_prefix="$prefix_name"
+        local_source_name="$source_name"
+        local_final_name="$final_name"
+    fi
+}
+
+function prepare_stage_for_hosts() {
+    # Start a container/pod for each host. Build engines able to do it for all
+    # the hosts at once provide ${engine}_prepare_stage_for_hosts
+    local source_name="$1"
+    local prefix_name="$2"
+    local pb="$3"
+    local is_conffs="$4"
+    local final_name="$5"
+    shift 5
+    local hosts_prepared=("$@")
+    local pids_prepare_stage=()
+    local local_prefix local_source_name local_final_name
+
+    if declare -F "${_arg_build_engine}"_prepare_stage_for_hosts > /dev/null; then
+        "${_arg_build_engine}"_prepare_stage_for_hosts "$source_name" "$prefix_name" "$pb" "$is_conffs" "$final_name" "$@"
+        return
+    fi
+    for host in "${hosts_prepared[@]}"; do
+        stage_names_for_host "$host" "$source_name" "$prefix_name" "$final_name" "$is_conffs"
+        {
+            trap 'set +x; catch_err $?' ERR
+            PROCESS_NAME="prepare_stage"
+            prepare_stage_for_host "$host" "$local_source_name" "$is_conffs" "$local_prefix/$pb" "$local_final_name"
+        } &
+        pids_prepare_stage+=("$!")
+    done
+    wait_pids "pids_prepare_stage" "hosts_prepared"
+}
+
+function end_stage_for_hosts() {
+    # Wrap up the container/pod of each host, which pushes its image. Build
+    # engines able to do it for all the hosts at once provide
+    # ${engine}_end_stage_for_hosts
+    local source_name="$1"
+    local pb="$2"
+    local branch="$3"
+    local is_conffs="$4"
+    shift 4
+    local hosts_ended=("$@")
+    local pids_end_stage=()
+
+    if declare -F "${_arg_build_engine}"_end_stage_for_hosts > /dev/null; then
+        "${_arg_build_engine}"_end_stage_for_hosts "$source_name" "$pb" "$branch" "$is_conffs" "$@"
+        return
+    fi
+    for host in "${hosts_ended[@]}"; do
+        {
+            trap 'set +x; catch_err $?' ERR
+            # shellcheck disable=SC2034 # variable is actually used elswhere
+            PROCESS_NAME="end_stage"
+            end_stage_for_host "$host" "$pb" "${source_name//HOSTNAME/$host}" "$branch"
+        } &
+        pids_end_stage+=("$!")
+    done
+    wait_pids "pids_end_stage" "hosts_ended"
+}
+
+BUILD_ENGINE_INITIALIZED="no"
 function init_build_engine() {
+    if [[ "$BUILD_ENGINE_INITIALIZED" == "yes" ]]; then
+        return
+    fi
     "${_arg_build_engine}"_init_build_engine
+    BUILD_ENGINE_INITIALIZED="yes"
 }
 
 function prepare_rootfs() {
     "${_arg_build_engine}"_prepare_rootfs "$@"
 }
 
+function release_rootfs() {
+    # Remove a rootfs made by prepare_rootfs. Build engines that don't just
+    # write files there provide ${engine}_release_rootfs
+    if declare -F "${_arg_build_engine}"_release_rootfs > /dev/null; then
+        "${_arg_build_engine}"_release_rootfs "$1"
+    else
+        rm -rf "$1"
+    fi
+}
+
 
 function create_parent_rootfs() {
     vauban_log "Will create a rootfs from a Debian Release (${_arg_debian_release})"
@@ -30,6 +137,19 @@ function create_parent_rootfs() {
 }
 
 
+function stage_cache_restore() {
+    # Reuse the image built by a previous run from the very same inputs instead
+    # of building it again. Returns 1 if the stage must be built
+    [[ "$_arg_stage_cache" == "yes" ]] || return 1
+    "${_arg_build_engine}"_stage_cache_restore "$@"
+}
+
+function stage_cache_store() {
+    [[ "$_arg_stage_cache" == "yes" ]] || return 0
+    "${_arg_build_engine}"_stage_cache_store "$@"
+}
+
+
 function put_sshd_keys() {
     [[ "${2:0:1}" = "/" ]] || vauban_log "put_sshd_keys \$host \$dst needs an absolute path for the \$dst"
 
@@ -37,6 +157,60 @@ function put_sshd_keys() {
 }
 
 
+function apply_stage_on_wave() {
+    # Apply the stage to the hosts of the current wave. Runs in the scope of
+    # apply_stage, whose variables it uses
+    local pids_stage_cache=()
+    local current_dir
+
+    vauban_log "   - Starting a container/pod for each host"
+    trace_span prepare_stage stage="$stage" hosts="${#wave[@]}" -- \
+        prepare_stage_for_hosts "$source_name" "$prefix_name" "$local_pb" "$is_conffs" "$final_name" "${wave[@]}"
+
+    current_dir="$(pwd)"
+    cd "ansible/${ANSIBLE_ROOT_DIR:-.}"
+    export ANSIBLE_ANY_ERRORS_FATAL=True
+    export ANSIBLE_BECOME_ALLOW_SAME_USER=False
+    export ANSIBLE_KEEP_REMOTE_FILES=True
+    export ANSIBLE_TIMEOUT=60
+    export ANSIBLE_DOCKER_TIMEOUT=60
+    export ANSIBLE_INVENTORY_CACHE_TIMEOUT=10
+    if [[ "$_arg_build_engine" == "docker" ]]; then
+        ansible_connection_module="community.docker.docker_api"
+    elif [[ "$_arg_build_engine" == "kubernetes" ]]; then
+        ansible_connection_module="ansible.builtin.ssh"
+    fi
+
+    eval "$HOOK_PRE_ANSIBLE"
+
+    vauban_log "   - Running ansible-playbook"
+
+    ANSIBLE_PLAYBOOK_RUNNING="true"
+    # shellcheck disable=SC2086 # Intended splitting
+    trace_span ansible-playbook stage="$stage" hosts="${#wave[@]}" -- \
+        eval ansible-playbook --forks 200 "$local_pb" --diff -l "$(IFS=,; echo "${wave[*]}")" -c "$ansible_connection_module" -v -e \''{"in_vauban": True, "in_conffs_build": '\''"$(to_boolean is_conffs)"'\''}'\' $ANSIBLE_EXTRA_ARGS | tee -a "$ansible_recap_file"
+    ANSIBLE_PLAYBOOK_RUNNING="false"
+
+    eval "$HOOK_POST_ANSIBLE"
+
+    cd "$current_dir"
+
+    vauban_log "    - Stage $stage applied successfully. Waiting for each container/pod to wrap up"
+    trace_span end_stage stage="$stage" hosts="${#wave[@]}" -- \
+        end_stage_for_hosts "$source_name" "$local_pb" "$local_branch" "$is_conffs" "${wave[@]}"
+    pids_stage_cache=()
+    for host in "${wave[@]}"; do
+        stage_names_for_host "$host" "$source_name" "$prefix_name" "$final_name" "$is_conffs"
+        {
+            trap 'set +x; catch_err $?' ERR
+            PROCESS_NAME="stage_cache"
+            stage_cache_store "$local_prefix/$local_pb" "$stage_cache_dir/$host"
+        } &
+        pids_stage_cache+=("$!")
+    done
+    wait_pids "pids_stage_cache" "wave"
+}
+
 function apply_stage() {
     local source_name="$1"
     shift
@@ -50,13 +224,15 @@ function apply_stage() {
     shift
     hosts=$*
 
-    local pids_prepare_stage=()
-    local pids_end_stage=()
-    local hosts_built=()
+    local pids_stage_cache=()
+    local hosts_list=()
+    local hosts_to_build=()
     local local_prefix=""
     local local_source_name=""
     local local_final_name=""
-    local current_dir
+    local stage_cache_dir
+    local wave_size wave_start
+    local wave=()
 
 
     if [[ "$stage" = *"@"* ]]; then
@@ -73,78 +249,46 @@ function apply_stage() {
     )
 
     vauban_log " - Applying stage $stage to ${source_name//\/HOSTNAME/} (playbook $local_pb from branch $local_branch) on $hosts"
-    vauban_log "   - Starting a container/pod for each host"
-    for host in $hosts; do
-        if [[ "$is_conffs" == "yes" ]]; then
-            local_prefix="$prefix_name/$host"
-            local_source_name="${source_name//HOSTNAME/$host}"
-            if [[ -z "$final_name" ]]; then
-                local_final_name=""
-            else
-                local_final_name="$final_name/$host"
-            fi
-        else
-            local_prefix="$prefix_name"
-            local_source_name="$source_name"
-            local_final_name="$final_name"
-        fi
-        hosts_built+=("$host")
-        {
-            trap 'set +x; catch_err $?' ERR
-            PROCESS_NAME="prepare_stage"
-            prepare_stage_for_host "$host" "$local_source_name" "$is_conffs" "$local_prefix/$local_pb" "$local_final_name"
-        } &
-        pids_prepare_stage+=("$!")
+    stage_cache_dir="$(mktemp -d -p /tmp/vauban)"
+    # The cache is looked up for as many hosts at once as are built at once
+    read -r -a hosts_list <<< "$hosts"
+    wave_size="$(stage_wave_size "${#hosts_list[@]}")"
+    for (( wave_start = 0; wave_start < ${#hosts_list[@]}; wave_start += wave_size )); do
+        wave=("${hosts_list[@]:wave_start:wave_size}")
+        pids_stage_cache=()
+        for host in "${wave[@]}"; do
+            stage_names_for_host "$host" "$source_name" "$prefix_name" "$final_name" "$is_conffs"
+            {
+                trap 'set +x; catch_err $?' ERR
+                PROCESS_NAME="stage_cache"
+                if stage_cache_restore "$host" "$local_source_name" "$is_conffs" "$local_prefix/$local_pb" "$local_final_name" "$stage" "$stage_cache_dir/$host"; then
+                    touch "$stage_cache_dir/$host.cached"
+                fi
+            } &
+            pids_stage_cache+=("$!")
+        done
+        wait_pids "pids_stage_cache" "wave"
     done
 
-    wait_pids "pids_prepare_stage" "hosts_built"
-
-    current_dir="$(pwd)"
-    cd "ansible/${ANSIBLE_ROOT_DIR:-.}"
-    export ANSIBLE_ANY_ERRORS_FATAL=True
-    export ANSIBLE_BECOME_ALLOW_SAME_USER=False
-    export ANSIBLE_KEEP_REMOTE_FILES=True
-    export ANSIBLE_TIMEOUT=60
-    export ANSIBLE_DOCKER_TIMEOUT=60
-    export ANSIBLE_INVENTORY_CACHE_TIMEOUT=10
-    if [[ "$_arg_build_engine" == "docker" ]]; then
-        ansible_connection_module="community.docker.docker_api"
-    elif [[ "$_arg_build_engine" == "kubernetes" ]]; then
-        ansible_connection_module="ansible.builtin.ssh"
+    for host in $hosts; do
+        [[ -f "$stage_cache_dir/$host.cached" ]] || hosts_to_build+=("$host")
+    done
+    if (( ${#hosts_to_build[@]} == 0 )); then
+        vauban_log "    - Stage $stage reused from cache for every host"
+        rm -rf "$stage_cache_dir"
+        return
     fi
 
-    eval "$HOOK_PRE_ANSIBLE"
-
-    vauban_log "   - Running ansible-playbook"
-
-    ANSIBLE_PLAYBOOK_RUNNING="true"
-    # shellcheck disable=SC2086 # Intended splitting
-    eval ansible-playbook --forks 200 "$local_pb" --diff -l "${hosts// /,}" -c "$ansible_connection_module" -v -e \''{"in_vauban": True, "in_conffs_build": '\''"$(to_boolean is_conffs)"'\''}'\' $ANSIBLE_EXTRA_ARGS | tee -a "$ansible_recap_file"
-    ANSIBLE_PLAYBOOK_RUNNING="false"
-
-    eval "$HOOK_POST_ANSIBLE"
-
-    cd "$current_dir"
-
-    vauban_log "    - Stage $stage applied successfully. Waiting for each container/pod to wrap up"
-    for host in $hosts; do
-        if [[ "$is_conffs" == "yes" ]]; then
-            local_prefix="$prefix_name/$host"
-            local_source_name="${source_name//HOSTNAME/$host}"
-        else
-            local_prefix="$prefix_name"
-            local_source_name="$source_name"
+    wave_size="$(stage_wave_size "${#hosts_to_build[@]}")"
+    for (( wave_start = 0; wave_start < ${#hosts_to_build[@]}; wave_start += wave_size )); do
+        wave=("${hosts_to_build[@]:wave_start:wave_size}")
+        if (( wave_size < ${#hosts_to_build[@]} )); then
+            vauban_log "   - Wave of ${#wave[@]} host(s): $((wave_start + 1)) to $((wave_start + ${#wave[@]})) out of ${#hosts_to_build[@]}"
         fi
-        {
-            trap 'set +x; catch_err $?' ERR
-            # shellcheck disable=SC2034 # variable is actually used elswhere
-            PROCESS_NAME="end_stage"
-            end_stage_for_host "$host" "$local_pb" "$local_source_name" "$local_branch"
-        } &
-        pids_end_stage+=("$!")
+        apply_stage_on_wave
     done
-    wait_pids "pids_end_stage" "hosts_built"
     wait
+    rm -rf "$stage_cache_dir"
 
     vauban_log "    - Stage built"
 }
@@ -283,9 +427,31 @@ function export_rootfs() {
     working_dir="$BUILD_PATH/$(image_name_to_local_path "$image_name")"
 
     mkdir -p "$working_dir"
+    # Builds of the same rootfs take turns
+    lock_hold exclusive "$working_dir.vauban.lock"
     vauban_log "Creating rootfs from $image_name"
+    if [[ "$_arg_build_engine" == "kubernetes" ]] && [[ "$KUBE_ROOTFS_EXPORT_MODE" == "stream" ]]; then
+        kubernetes_squash_rootfs "$image_name" "$working_dir"
+    else
+        export_rootfs_tree "$image_name" "$working_dir"
+    fi
+    tar cvf rootfs.tgz rootfs.img
+    kernel_version="$(get_rootfs_kernel_version "$working_dir")"
+    release_rootfs "$working_dir"
+    lock_release "$working_dir.vauban.lock"
+    vauban_log "rootfs compressed and bundled in tar archive"
+    upload_list="$upload_list rootfs.tgz"
+}
+
+function export_rootfs_tree() {
+    # Assemble the rootfs in the working directory, clean it up, then
+    # compress it to rootfs.img
+    local image_name="$1"
+    local working_dir="$2"
+    local squashfs_options=()
+
     vauban_log " - Preparing rootfs files locally"
-    prepare_rootfs "$image_name" "$working_dir"
+    trace_span prepare_rootfs image="$image_name" -- prepare_rootfs "$image_name" "$working_dir"
 
     chroot "$working_dir" bin/bash << "EOF"
     (
@@ -301,12 +467,10 @@ EOF
     put_sshd_keys "$image_name" "$working_dir"
     vauban_log " - Compressing rootfs"
     mkdir "$working_dir/proc" "$working_dir/dev" "$working_dir/sys" -p
-    mksquashfs "$working_dir" rootfs.img -noappend -always-use-fragments -comp xz -no-exports
-    tar cvf rootfs.tgz rootfs.img
-    kernel_version="$(get_rootfs_kernel_version "$working_dir")"
-    rm -rf "$working_dir"
-    vauban_log "rootfs compressed and bundled in tar archive"
-    upload_list="$upload_list rootfs.tgz"
+    # The compression options come from the squashfs profile of the master
+    read -r -a squashfs_options <<< "$_arg_squashfs_options"
+    trace_span mksquashfs image="$image_name" -- \
+        mksquashfs "$working_dir" rootfs.img -noappend -no-exports "${squashfs_options[@]}"
 }
 
 function build_rootfs() {
@@ -337,16 +501,51 @@ function build_conffs() {
     local source_name="$1"
     local prefix_name="$2"
     local hosts_built=()
+    local jobs_dir jobs_number
+    local running=0
+    local must_exit="no"
 
     apply_stages "$source_name" "$prefix_name" "$prefix_name" "yes" "${_arg_stages[@]}"
 
+    # The hosts are built by a pool of workers, each one in its own scratch
+    # directory, where it leaves the files it adds to the upload list
+    jobs_number="${CONFFS_BUILD_JOBS:-$(nproc)}"
+    jobs_dir="$(mktemp -d -p /tmp/vauban)"
     vauban_log "build_conffs: Hosts recap"
     for host in $hosts; do
+        if (( running >= jobs_number )); then
+            wait -n || true
+            running=$((running - 1))
+        fi
         host_prefix_name="$prefix_name/$host"  # All intermediate images will be named name/host/stage
         # with name being the name of the OS being installed, like debian-10.8
-        build_conffs_given_host "$host" "$source_name" "$host_prefix_name"
-        vauban_log "$host: success"
+        mkdir "$jobs_dir/$host"
+        {
+            trap 'set +x; catch_err $?' ERR
+            PROCESS_NAME="build_conffs"
+            export TMPDIR="$jobs_dir/$host"
+            upload_list=""
+            trace_span build_conffs host="$host" -- build_conffs_given_host "$host" "$source_name" "$host_prefix_name"
+            echo "$upload_list" > "$jobs_dir/$host.upload_list"
+        } &
+        running=$((running + 1))
+        hosts_built+=("$host")
+    done
+    wait || true
+
+    for host in "${hosts_built[@]}"; do
+        if [[ -f "$jobs_dir/$host.upload_list" ]]; then
+            upload_list="$upload_list $(cat "$jobs_dir/$host.upload_list")"
+            vauban_log "$host: success"
+        else
+            vauban_log "$host: failure"
+            must_exit="yes"
+        fi
     done
+    rm -rf "$jobs_dir"
+    if [[ "$must_exit" = "yes" ]]; then
+        end 1
+    fi
     vauban_log "build_conffs: logs" "Conffs built"
 }
 
@@ -373,7 +572,7 @@ function build_initramfs() {
     local release_path
     vauban_log "Building the initramfs"
     release_path="$BUILD_PATH/$_arg_debian_release"
-    prepare_debian_release "$release_path"
+    trace_span debootstrap release="$_arg_debian_release" -- prepare_debian_release "$release_path"
     kernel="$(find_kernel "$release_path")"
     kernel_version="$(get_kernel_version "$kernel")"
     vauban_log " - Fetching kernel $kernel_version"
@@ -385,7 +584,7 @@ function build_initramfs() {
         printf "%s does not exist. Cannot find kernel modules for version %s" "$modules_path" "$kernel_version"
         end 1
     fi
-    chroot_dracut "$release_path" "$modules_path" "$kernel_version"
+    trace_span dracut kernel_version="$kernel_version" -- chroot_dracut "$release_path" "$modules_path" "$kernel_version"
     vauban_log " - initramfs.img created"
     mv "$release_path/initramfs.img" .
     rm -rf "$release_path"
@@ -410,12 +609,14 @@ function upload() {
             fi
             remote_file="$file-$kernel_version"
             vauban_log " - Uploading $file"
-            retry 3 curl -s -f -u "$UPLOAD_CREDS" "$UPLOAD_ENDPOINT/upload/vauban/linux/$remote_file" -F "file=@$file" | jq .ok
+            trace_span upload_file file="$file" -- \
+                retry 3 curl -s -f -u "$UPLOAD_CREDS" "$UPLOAD_ENDPOINT/upload/vauban/linux/$remote_file" -F "file=@$file" | jq .ok
             must_symlink=1
         else
             remote_file="$(basename "$file")"
             vauban_log " - Uploading $file"
-            retry 3 curl -s -f -u "$UPLOAD_CREDS" "$UPLOAD_ENDPOINT/upload/vauban/$master_name/$remote_file" -F "file=@$file" | jq .ok
+            trace_span upload_file file="$file" -- \
+                retry 3 curl -s -f -u "$UPLOAD_CREDS" "$UPLOAD_ENDPOINT/upload/vauban/$master_name/$remote_file" -F "file=@$file" | jq .ok
         fi
     done
     if [[ $must_symlink == 1 ]]; then
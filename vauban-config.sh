@@ -80,7 +80,59 @@ BUILD_PATH=/srv/build-vauban/
 DEBIAN_CACHE_PATH=/srv/debian/cache/
 ## Kubernetes build engine
 KUBE_IMAGE_DOWNLOAD_PATH=/srv/images
+# How many layers of an image are downloaded and extracted at the same time
+export KUBE_IMAGE_PULL_JOBS="${KUBE_IMAGE_PULL_JOBS:-4}"
+# Size the images and layers of KUBE_IMAGE_DOWNLOAD_PATH are kept under, like
+# 200G, by evicting the least recently used layers. Empty for no limit
+export KUBE_IMAGE_STORE_BUDGET="${KUBE_IMAGE_STORE_BUDGET:-}"
+# How the layers of an image make a rootfs: "copy" copies them to the build
+# directory, "overlay" mounts them as an overlay, without copying anything
+export KUBE_ASSEMBLY_MODE="${KUBE_ASSEMBLY_MODE:-copy}"
+# How the conffs archive of a host is made: "tree" assembles its layers in the
+# build directory then archives them, "stream" archives the union of its
+# layers directly, without writing anything but the archive
+export KUBE_CONFFS_BUILD_MODE="${KUBE_CONFFS_BUILD_MODE:-tree}"
+# How rootfs.img is made: "tree" assembles the rootfs in the build directory,
+# cleans it up in a chroot, then compresses it. "stream" gives the layers to
+# mksquashfs as a tar, cleaned up on the fly (needs squashfs-tools >= 4.6)
+export KUBE_ROOTFS_EXPORT_MODE="${KUBE_ROOTFS_EXPORT_MODE:-tree}"
+# How long, in seconds, a build waits for another one using the same image or
+# build directory before failing
+export VAUBAN_LOCK_TIMEOUT="${VAUBAN_LOCK_TIMEOUT:-3600}"
 KUBE_NAMESPACE="vauban"
+# How many pods kubernetes_controller.py creates or waits for at the same time
+export KUBE_CONTROLLER_WORKERS="${KUBE_CONTROLLER_WORKERS:-32}"
+# How many pods are told to push their image, or have their logs read, at the
+# same time when a stage ends
+export KUBE_END_CONCURRENCY="${KUBE_END_CONCURRENCY:-$KUBE_CONTROLLER_WORKERS}"
+# Cache the base images of the build pods on the nodes, in KUBE_KANIKO_CACHE_PATH,
+# so that they are pulled once per node. Can also be given a kaniko cache repo
+export KUBE_KANIKO_CACHE="${KUBE_KANIKO_CACHE:-no}"
+export KUBE_KANIKO_CACHE_PATH="${KUBE_KANIKO_CACHE_PATH:-/var/cache/vauban/kaniko}"
+export KUBE_KANIKO_CACHE_REPO="${KUBE_KANIKO_CACHE_REPO:-}"
+# Cache the debootstrapped Debian releases on the nodes, in KUBE_DEBIAN_CACHE_PATH,
+# for the rootfs built from scratch
+export KUBE_DEBIAN_CACHE="${KUBE_DEBIAN_CACHE:-no}"
+export KUBE_DEBIAN_CACHE_PATH="${KUBE_DEBIAN_CACHE_PATH:-/var/cache/vauban/debian}"
+# Maximum number of build pods in flight: the hosts of a stage are built in
+# waves of that size. 0 builds every host at once
+export KUBE_MAX_INFLIGHT_PODS="${KUBE_MAX_INFLIGHT_PODS:-0}"
+# CPU/memory requests and limits of the build pods (unset when empty)
+export KUBE_POD_CPU_REQUEST="${KUBE_POD_CPU_REQUEST:-}"
+export KUBE_POD_MEMORY_REQUEST="${KUBE_POD_MEMORY_REQUEST:-}"
+export KUBE_POD_CPU_LIMIT="${KUBE_POD_CPU_LIMIT:-}"
+export KUBE_POD_MEMORY_LIMIT="${KUBE_POD_MEMORY_LIMIT:-}"
+# Spread the build pods of a run across nodes: no, preferred or required
+export KUBE_POD_ANTI_AFFINITY="${KUBE_POD_ANTI_AFFINITY:-no}"
+# Number of pods started and ready from a source image, to be claimed by the
+# next builds of its stage, by
+# `python3 kubernetes_controller.py --action warm-pool --source <image>`.
+# Conffs builds, which are per host, don't use them. Pods of the pool wait
+# KUBE_WARM_POOL_TTL seconds to be used: no build deletes them, run
+# `python3 kubernetes_controller.py --action warm-pool-cleanup` to reap them
+# sooner. 0 disables the pool
+export KUBE_WARM_POOL_SIZE="${KUBE_WARM_POOL_SIZE:-0}"
+export KUBE_WARM_POOL_TTL="${KUBE_WARM_POOL_TTL:-86400}"
 # end Kubernetes build engine
 
 
@@ -89,3 +141,6 @@ DEBIAN_APT_GET_PROXY=${DEBIAN_APT_GET_PROXY:-}
 
 # Conffs archive max size in byte
 CONFFS_MAX_SIZE=52428800 # 50 Mib
+# How many hosts have their conffs built at the same time. Empty for the
+# number of cores of the machine running vauban
+CONFFS_BUILD_JOBS=${CONFFS_BUILD_JOBS:-}
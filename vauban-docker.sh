@@ -10,6 +10,14 @@ function docker_cleanup_build_engine() {
     :
 }
 
+function docker_stage_cache_restore() {
+    return 1  # Not supported by the docker build engine
+}
+
+function docker_stage_cache_store() {
+    :
+}
+
 function docker_prepare_stage_for_host() {
     local host="$1"
     local playbook="$2"
@@ -184,11 +192,11 @@ function docker_build_conffs_for_host() {
         --exclude "root/ansible" \
         . > /dev/null
     mv "conffs-$host.tgz" "$BUILD_DIR"
-    upload_list="$upload_list $BUILD_DIR/conffs-$host.tgz"
     if [[ -n "$overlayfs_args" ]]; then
         umount merged
     fi
     )
+    upload_list="$upload_list $BUILD_DIR/conffs-$host.tgz"
 }
 
 function docker_prepare_rootfs() {
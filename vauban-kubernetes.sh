@@ -7,6 +7,10 @@ VAUBAN_KUBERNETES_UUID="$(uuidgen || echo $BASHPID)"
 SRC_PATH="$(pwd)"
 source utils.sh
 
+# Left out of the conffs archives, with their content, from the root of the
+# conffs: the same for the assembled ones and the streamed ones
+KUBE_CONFFS_EXCLUDES=("var/log" "var/cache" "root/ansible" "root/.ansible" "var/lib/apt/lists/*")
+
 function kubernetes_init_build_engine() {
     export DEBIAN_APT_GET_PROXY="$DEBIAN_APT_GET_PROXY"
     python3 ./kubernetes_controller.py --action init
@@ -45,17 +49,66 @@ function kubernetes_prepare_stage_for_host() {
     echo -e "\n[all]\n$host ansible_host=$pod_ip\n" >> "ansible/${ANSIBLE_ROOT_DIR:-.}/inventory"
 }
 
-function kubernetes_end_stage_for_host() {
+function kubernetes_prepare_stage_for_hosts() {
+    # Start the pods of all the hosts with a single kubernetes_controller.py
+    # process, which creates them concurrently
+    local source_name="$1"
+    local prefix_name="$2"
+    local pb="$3"
+    local is_conffs="$4"
+    local final_name="$5"
+    shift 5
+    local batch_file host pod_ip
+    local destinations=()
+    local local_prefix local_source_name local_final_name
+
+    batch_file="$(mktemp -p /tmp/vauban)"
+    for host in "$@"; do
+        stage_names_for_host "$host" "$source_name" "$prefix_name" "$final_name" "$is_conffs"
+        destinations=("$REGISTRY/$local_prefix/$pb:$current_date" "$REGISTRY/$local_prefix/$pb:latest")
+        if [[ -n "$local_final_name" ]]; then
+            destinations+=("$REGISTRY/$local_final_name:latest" "$REGISTRY/$local_final_name:$current_date")
+        fi
+        jq -nc \
+            --arg name "$host" \
+            --arg source "$REGISTRY/$local_source_name" \
+            --arg in_conffs "$(to_boolean "$is_conffs")" \
+            '{name: $name, source: $source, destination: $ARGS.positional, in_conffs: $in_conffs}' \
+            --args "${destinations[@]}" >> "$batch_file"
+    done
+
+    vauban_log "      - Starting Pods for $# host(s)"
+    python3 kubernetes_controller.py \
+        --action create-batch \
+        --batch "$batch_file" \
+        --uuid "$VAUBAN_KUBERNETES_UUID" \
+        > "$batch_file.ips"
+    while read -r host pod_ip; do
+        echo -e "\n[all]\n$host ansible_host=$pod_ip\n" >> "ansible/${ANSIBLE_ROOT_DIR:-.}/inventory"
+    done < "$batch_file.ips"
+    vauban_log "      - Pods started successfully"
+    rm -f "$batch_file" "$batch_file.ips"
+}
+
+function kubernetes_stage_wave_size() {
+    # Build at most KUBE_MAX_INFLIGHT_PODS hosts at once
+    local hosts_count="$1"
+    if (( KUBE_MAX_INFLIGHT_PODS > 0 && KUBE_MAX_INFLIGHT_PODS < hosts_count )); then
+        echo "$KUBE_MAX_INFLIGHT_PODS"
+    else
+        echo "$hosts_count"
+    fi
+}
+
+function kubernetes_imginfo_update() {
     local host="$1"
     local playbook="$2"
     local source="$3"
     local branch="$4"
-    local ansible_sha1 vauban_sha1 imginfo_update
+    local ansible_sha1="$5"
+    local vauban_sha1="$6"
 
-    ansible_sha1="$( (cd ansible; git rev-parse HEAD) )"
-    # shellcheck disable=SC2153
-    vauban_sha1="$(git rev-parse HEAD 2> /dev/null || echo "$VAUBAN_SHA1")"
-    imginfo_update="$(echo -e "\n\
+    echo -e "\n\
     - date: $(date --iso-8601=seconds)\n\
       playbook: ${playbook}\n\
       hostname: ${host}\n\
@@ -63,79 +116,121 @@ function kubernetes_end_stage_for_host() {
       ansible-sha1: ${ansible_sha1}\n\
       ansible-branch: ${branch}\n\
       build-engine: kubernetes\n\
-      vauban-sha1: ${vauban_sha1}\n" | base64 -w0)"
+      vauban-sha1: ${vauban_sha1}\n" | base64 -w0
+}
+
+function kubernetes_end_stage_for_host() {
+    local host="$1"
+    local playbook="$2"
+    local source="$3"
+    local branch="$4"
+    local ansible_sha1 vauban_sha1 imginfo_update
+
+    ansible_sha1="$( (cd ansible; git rev-parse HEAD) )"
+    # shellcheck disable=SC2153
+    vauban_sha1="$(git rev-parse HEAD 2> /dev/null || echo "$VAUBAN_SHA1")"
+    imginfo_update="$(kubernetes_imginfo_update "$host" "$playbook" "$source" "$branch" "$ansible_sha1" "$vauban_sha1")"
 
     vauban_log "      - Waiting for Pod $host to finish"
     python3 kubernetes_controller.py --name "$host" --action end --imginfo "$imginfo_update"
     vauban_log "      - Pod $host finished successfully"
 }
 
-function kubernetes_check_lock_file() {
-    if [[ -f "$1" ]]; then
-        >&2 echo "$1 file detected. Is another Vauban instance using these files ?"
-        end 1
-    fi
+function kubernetes_end_stage_for_hosts() {
+    # End the pods of all the hosts with a single kubernetes_controller.py
+    # process, which waits for them concurrently
+    local source_name="$1"
+    local playbook="$2"
+    local branch="$3"
+    local is_conffs="$4"
+    shift 4
+    local batch_file host ansible_sha1 vauban_sha1
+
+    ansible_sha1="$( (cd ansible; git rev-parse HEAD) )"
+    # shellcheck disable=SC2153
+    vauban_sha1="$(git rev-parse HEAD 2> /dev/null || echo "$VAUBAN_SHA1")"
+    batch_file="$(mktemp -p /tmp/vauban)"
+    for host in "$@"; do
+        jq -nc \
+            --arg name "$host" \
+            --arg imginfo "$(kubernetes_imginfo_update "$host" "$playbook" "${source_name//HOSTNAME/$host}" "$branch" "$ansible_sha1" "$vauban_sha1")" \
+            '{name: $name, imginfo: $imginfo}' >> "$batch_file"
+    done
+
+    vauban_log "      - Waiting for the Pods of $# host(s) to finish"
+    python3 kubernetes_controller.py --action end-batch --batch "$batch_file"
+    vauban_log "      - Pods finished successfully"
+    rm -f "$batch_file"
+}
+
+function kubernetes_stage_cache_key() {
+    # The cache key of a stage is a hash of everything that makes its result:
+    # the image it starts from, the ansible and vauban code, and the arguments
+    local host="$1"
+    local source="$2"
+    local in_conffs="$3"
+    local stage="$4"
+    local source_digest ansible_sha1 vauban_sha1
+
+    source_digest="$(skopeo inspect "docker://$REGISTRY/$source" | jq -r .Digest)"
+    [[ -n "$source_digest" ]] || return 1
+    ansible_sha1="$( (cd ansible; git rev-parse HEAD) )"
+    # shellcheck disable=SC2153
+    vauban_sha1="$(git rev-parse HEAD 2> /dev/null || echo "$VAUBAN_SHA1")"
+    printf '%s\n' "$source_digest" "$ansible_sha1" "$vauban_sha1" "$stage" "$host" "$in_conffs" \
+        "$ANSIBLE_EXTRA_ARGS" "$HOOK_PRE_ANSIBLE" "$HOOK_POST_ANSIBLE" | sha256sum | cut -d' ' -f1
+}
+
+function kubernetes_stage_cache_restore() {
+    local host="$1"
+    local source="$2"
+    local in_conffs="$3"
+    local destination="$4"
+    local final_name="$5"
+    local stage="$6"
+    local key_file="$7"
+    local key cached tag
+
+    key="$(kubernetes_stage_cache_key "$host" "$source" "$in_conffs" "$stage")" || return 1
+    echo "$key" > "$key_file"
+    cached="docker://$REGISTRY/$destination:cache-$key"
+    skopeo inspect "$cached" > /dev/null 2>&1 || return 1
+
+    vauban_log "      - Inputs unchanged for $host: reusing $destination:cache-$key"
+    for tag in "$current_date" latest; do
+        retry 3 skopeo copy "$cached" "docker://$REGISTRY/$destination:$tag" > /dev/null || return 1
+        if [[ -n "$final_name" ]]; then
+            retry 3 skopeo copy "$cached" "docker://$REGISTRY/$final_name:$tag" > /dev/null || return 1
+        fi
+    done
+}
+
+function kubernetes_stage_cache_store() {
+    local destination="$1"
+    local key_file="$2"
+
+    [[ -f "$key_file" ]] || return 0
+    retry 3 skopeo copy "docker://$REGISTRY/$destination:$current_date" "docker://$REGISTRY/$destination:cache-$(cat "$key_file")" > /dev/null
 }
 
 function kubernetes_download_image() {
+    # Fetch the image, and extract its layers, in KUBE_IMAGE_DOWNLOAD_PATH.
+    # vauban_image.py streams the layers concurrently from the registry.
+    # Builds fetching the same image wait for the first one, then find the
+    # image up to date
     local image_name="$1"
-    local image_local_path manifest_id_sha manifest_id digest i extracted_dest tar_output
+    local image_local_path
     image_local_path="$(image_name_to_local_path "$image_name")"
-    local image_remote_path="docker://$REGISTRY/$image_name"
     (
         mkdir -p "$KUBE_IMAGE_DOWNLOAD_PATH" && cd "$KUBE_IMAGE_DOWNLOAD_PATH"
-        mkdir -p oci_shared layers
-        kubernetes_check_lock_file "$image_local_path.vauban.lock"
-        echo $$ > "$image_local_path.vauban.lock"
-        # shellcheck disable=SC2015 # ack
-        local_digest="$([[ -d "$image_local_path" ]] && cat "$image_local_path"/Digest.vauban || true)"
-        remote_digest="$(skopeo inspect "$image_remote_path" | jq .Digest -r)"
-        (
-        if [[ "$local_digest" == "$remote_digest" ]]; then
-            return
-        else
-            rm -rf "$image_local_path"
+        with_lock exclusive "$image_local_path.vauban.lock" \
+            python3 "$SRC_PATH/vauban_image.py" pull \
+            --image "$REGISTRY/$image_name" \
+            --local-path "$image_local_path" \
+            --store "$KUBE_IMAGE_DOWNLOAD_PATH"
+        if [[ -n "$KUBE_IMAGE_STORE_BUDGET" ]]; then
+            python3 "$SRC_PATH/vauban_image.py" gc --store "$KUBE_IMAGE_DOWNLOAD_PATH"
         fi
-        skopeo copy --dest-shared-blob-dir oci_shared "$image_remote_path" "oci:$image_local_path"
-        echo "$remote_digest" > "$image_local_path/Digest.vauban"
-
-        i=0
-        manifest_id_sha="$(cat "$image_local_path/index.json" | jq '.manifests[0].digest' -r)"
-        manifest_id="${manifest_id_sha#sha256:}"
-        (
-        cd "oci_shared/sha256"
-        echo "Extracting layers"
-        cat "$manifest_id" | jq -r '.layers.[].digest' | while read -r digest_sha; do
-            digest="${digest_sha#sha256:}"
-            extracted_dest="$KUBE_IMAGE_DOWNLOAD_PATH/layers/$digest"
-            if [[ -f "$extracted_dest" ]]; then
-                echo "Skipping extraction of $digest: already done"
-                continue
-            fi
-            if [[ ! -f $digest.tar ]]; then
-                gunzip < "$digest" > "$digest".tar
-            fi
-            mkdir -p "$extracted_dest"
-            tar_output="$(tar xf "$digest.tar" -C "$extracted_dest" 2>&1 || true)"
-            while IFS= read -r line; do
-                if [[ -z "$line" ]]; then continue; fi
-                if echo "$line" | grep "Removing leading" >/dev/null 2>&1; then continue; fi
-                if echo "$line" | grep "can't create hardlink" >/dev/null 2>&1; then
-                    # FIXME create symlink instead
-                    echo "$line"
-                    end 1
-                else
-                    echo "tar error ! $line"
-                    end 1
-                fi
-            done <<< "$tar_output"
-            rm "$digest.tar"
-
-            i="$((i+1))"
-        done
-        )
-        )
-        rm "$image_local_path.vauban.lock"
     )
 }
 
@@ -144,10 +239,13 @@ function kubernetes_assemble_layers() {
     local dst_path="$2"
     local start="$3"
     local stop="$4"
-    local manifest_id_sha manifest_id layer_path
+    local layer_id src_lock lowerdir=""
+    local layers=()
 
-    kubernetes_check_lock_file "$src_path.vauban.lock"
-    echo "$$" > "$src_path.vauban.lock"
+    # The image must not be replaced by a newer one while we read it. The
+    # caller holds the lock of the rootfs
+    src_lock="$(realpath "$src_path").vauban.lock"
+    lock_hold shared "$src_lock"
 
     if [[ -d "$dst_path" ]] && [[ -z "$(find "$dst_path" -maxdepth 0 -empty 2>/dev/null)" ]]; then
         find "$dst_path"
@@ -155,17 +253,43 @@ function kubernetes_assemble_layers() {
         end 1
     fi
     mkdir -p "$dst_path"
-    kubernetes_check_lock_file "$dst_path.vauban.lock"
-    echo "$$" > "$dst_path.vauban.lock"
 
     manifest="$(kubernetes_get_manifest "$src_path")"
     for i in $(seq "$start" "$stop"); do
         layer_id="$(echo "$manifest" | jq -r '.layers.['"$i"'].digest')"
-        layer_path="$KUBE_IMAGE_DOWNLOAD_PATH/layers/${layer_id#sha256:}"
-        rsync -a --force -r -l "$layer_path/" "$dst_path/"
+        layers+=("${layer_id#sha256:}")
+        # The last use of the layer, for the garbage collection of the store
+        touch -c "$KUBE_IMAGE_DOWNLOAD_PATH/layers/${layer_id#sha256:}.json"
     done
 
-    rm "$src_path.vauban.lock"
+    if [[ "$KUBE_ASSEMBLY_MODE" == "overlay" ]] && (( ${#layers[@]} > 0 )); then
+        # The layers are the lower directories of an overlay, the highest
+        # first, through short links to fit in the mount options. What is
+        # written to the rootfs goes to an upper directory next to it
+        mkdir -p "$KUBE_IMAGE_DOWNLOAD_PATH/layers/l" "$dst_path.overlay/upper" "$dst_path.overlay/work"
+        for layer_id in "${layers[@]}"; do
+            ln -sfn "../$layer_id" "$KUBE_IMAGE_DOWNLOAD_PATH/layers/l/${layer_id:0:12}"
+            lowerdir="l/${layer_id:0:12}${lowerdir:+:$lowerdir}"
+        done
+        (
+        cd "$KUBE_IMAGE_DOWNLOAD_PATH/layers"
+        mount -t overlay overlay -o "lowerdir=$lowerdir,upperdir=$dst_path.overlay/upper,workdir=$dst_path.overlay/work" "$dst_path"
+        )
+    else
+        python3 "$SRC_PATH/vauban_image.py" copy-layers --destination "$dst_path" \
+            "${layers[@]/#/$KUBE_IMAGE_DOWNLOAD_PATH/layers/}"
+    fi
+
+    lock_release "$src_lock"
+}
+
+function kubernetes_release_rootfs() {
+    # Remove a rootfs made by kubernetes_assemble_layers
+    local dst_path="$1"
+    if mountpoint -q "$dst_path"; then
+        umount "$dst_path"
+    fi
+    rm -rf "$dst_path" "$dst_path.overlay"
 }
 
 function kubernetes_get_manifest() {
@@ -182,11 +306,11 @@ function kubernetes_prepare_rootfs() {
     local image_local_path layers_number
     image_local_path="$(image_name_to_local_path "$image_name")"
 
-    kubernetes_download_image "$image_name"
+    trace_span download_image image="$image_name" -- kubernetes_download_image "$image_name"
     (
     cd "$KUBE_IMAGE_DOWNLOAD_PATH/$image_local_path"
     layers_number="$(kubernetes_get_manifest | jq '.layers | length')"
-    kubernetes_assemble_layers . "$dst_path" 0 "$((layers_number  - 1))"
+    trace_span assemble_layers layers="$layers_number" -- kubernetes_assemble_layers . "$dst_path" 0 "$((layers_number  - 1))"
     )
 }
 
@@ -201,14 +325,22 @@ function kubernetes_build_conffs_for_host() {
     local dst_path="$BUILD_PATH/$host_local_path"
 
     printf "Building conffs for host=%s\n" "$host"
+    lock_hold exclusive "$dst_path.vauban.lock"
 
-    kubernetes_download_image "$conffs_image"
-    kubernetes_download_image "$root_image"
+    trace_span download_image image="$conffs_image" -- kubernetes_download_image "$conffs_image"
+    trace_span download_image image="$root_image" -- kubernetes_download_image "$root_image"
     root_layers_number="$(cd "$KUBE_IMAGE_DOWNLOAD_PATH/$root_image_local_path" && kubernetes_get_manifest | jq '.layers | length')"
+    if [[ "$KUBE_CONFFS_BUILD_MODE" == "stream" ]]; then
+        kubernetes_pack_conffs "$host" "$conffs_image_local_path" "$root_layers_number"
+        upload_list="$upload_list $BUILD_PATH/conffs-$host.tgz"
+        lock_release "$dst_path.vauban.lock"
+        return
+    fi
     (
     cd "$KUBE_IMAGE_DOWNLOAD_PATH/$conffs_image_local_path"
     conffs_layers_number="$(kubernetes_get_manifest | jq '.layers | length')"
-    kubernetes_assemble_layers . "$dst_path" "$root_layers_number" "$((conffs_layers_number - 1))"
+    trace_span assemble_layers layers="$((conffs_layers_number - root_layers_number))" -- \
+        kubernetes_assemble_layers . "$dst_path" "$root_layers_number" "$((conffs_layers_number - 1))"
     )
 
     put_sshd_keys "$host" "$dst_path"
@@ -219,12 +351,9 @@ function kubernetes_build_conffs_for_host() {
     )
     (
     cd "$BUILD_PATH"
-    tar cvfz "conffs-$host.tgz" \
+    trace_span conffs_archive host="$host" -- tar cvfz "conffs-$host.tgz" \
         -C "$host_local_path" \
-        --exclude "var/log" \
-        --exclude "var/cache" \
-        --exclude "root/ansible" \
-        --exclude "root/.ansible" \
+        --anchored "${KUBE_CONFFS_EXCLUDES[@]/#/--exclude=./}" \
         . > /dev/null
     conffs_archive_size="$(stat -c%s "conffs-$host.tgz")";
     if [[ "$conffs_archive_size" -ge $CONFFS_MAX_SIZE ]]; then
@@ -236,7 +365,75 @@ function kubernetes_build_conffs_for_host() {
     )
 
     upload_list="$upload_list $BUILD_PATH/conffs-$host.tgz"
-    rm -rf "$dst_path"
+    release_rootfs "$dst_path"
+    lock_release "$dst_path.vauban.lock"
+}
+
+function kubernetes_layer_paths() {
+    # kubernetes_layer_paths <image path> <first layer>
+    # Print the paths of the extracted layers of an image from the given one,
+    # the lowest first, and mark them as used for the garbage collection of
+    # the store
+    local manifest layer_id
+    manifest="$(kubernetes_get_manifest "$1")"
+    for i in $(seq "$2" "$(($(echo "$manifest" | jq '.layers | length') - 1))"); do
+        layer_id="$(echo "$manifest" | jq -r '.layers.['"$i"'].digest')"
+        echo "$KUBE_IMAGE_DOWNLOAD_PATH/layers/${layer_id#sha256:}"
+        touch -c "$KUBE_IMAGE_DOWNLOAD_PATH/layers/${layer_id#sha256:}.json"
+    done
+}
+
+function kubernetes_squash_rootfs() {
+    # Write rootfs.img straight from the layers of the image, with the sshd
+    # keys and the cleanup of export_rootfs, without assembling the rootfs on
+    # disk. Only the kernel is extracted to the working directory, to get its
+    # version
+    local image_name="$1"
+    local working_dir="$2"
+    local image_path
+    local keys_dir
+    local layers=()
+
+    image_path="$KUBE_IMAGE_DOWNLOAD_PATH/$(image_name_to_local_path "$image_name")"
+    trace_span download_image image="$image_name" -- kubernetes_download_image "$image_name"
+    keys_dir="$(mktemp -d)"
+    put_sshd_keys "$image_name" "$keys_dir"
+
+    lock_hold shared "$image_path.vauban.lock"
+    mapfile -t layers < <(kubernetes_layer_paths "$image_path" 0)
+    vauban_log " - Compressing rootfs"
+    trace_span mksquashfs image="$image_name" -- python3 "$SRC_PATH/vauban_image.py" pack-rootfs \
+        --output rootfs.img \
+        --squashfs-options "$_arg_squashfs_options" \
+        --add "$keys_dir" \
+        "${layers[@]}"
+    lock_release "$image_path.vauban.lock"
+    rm -rf "$keys_dir"
+    unsquashfs -no-progress -f -d "$working_dir" rootfs.img 'boot/vmlinuz*' > /dev/null
+}
+
+function kubernetes_pack_conffs() {
+    # Write the conffs archive of a host straight from the layers of its
+    # conffs image above the root ones, without assembling them on disk
+    local host="$1"
+    local image_path="$KUBE_IMAGE_DOWNLOAD_PATH/$2"
+    local root_layers_number="$3"
+    local keys_dir
+    local layers=()
+
+    keys_dir="$(mktemp -d)"
+    put_sshd_keys "$host" "$keys_dir"
+
+    lock_hold shared "$image_path.vauban.lock"
+    mapfile -t layers < <(kubernetes_layer_paths "$image_path" "$root_layers_number")
+    trace_span conffs_archive host="$host" -- python3 "$SRC_PATH/vauban_image.py" pack-conffs \
+        --output "$BUILD_PATH/conffs-$host.tgz" \
+        --max-size "$CONFFS_MAX_SIZE" \
+        "${KUBE_CONFFS_EXCLUDES[@]/#/--exclude=}" \
+        --add "$keys_dir" \
+        "${layers[@]}"
+    lock_release "$image_path.vauban.lock"
+    rm -rf "$keys_dir"
 }
 
 function kubernetes_create_parent_rootfs() {
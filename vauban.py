@@ -8,35 +8,126 @@ Manage vauban with simple arguments
 
 from __future__ import annotations  # Requires python >= 3.7
 import sys
-import uuid
 import os
-import subprocess
-import traceback
 import hashlib
 import json
-from copy import deepcopy
-from dataclasses import dataclass
+import shlex
 
-import signal
+CONFIG_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "vauban"
+)
 
-try:
-    import sentry_sdk
 
-except (ImportError, ModuleNotFoundError) as e:
-    if not os.environ.get("_VAUBAN_COMPLETE"):
-        print(e)
-        print("sentry_sdk not found in your environment. Please install sentry_sdk")
+def config_cache_path(path):
+    """
+    Return the path of the parse cache of a configuration file
+    """
+    return os.path.join(
+        CONFIG_CACHE_DIR,
+        f"config-{hashlib.sha256(os.path.abspath(path).encode()).hexdigest()}.json",
+    )
 
 
-# Import external module and print an nice error message if module is not found
-for module, module_name in [
-    ("yaml", "pyyaml"),
-    ("click", "click"),
-    ("requests", "requests"),
-    ("sentry_sdk", "sentry-sdk"),
-]:
+def read_config_cache(path):
+    """
+    Return the parse cache of a configuration file, and whether it is still
+    up to date with the file (same mtime and size)
+    """
+    stat = os.stat(path)
     try:
-        globals()[module] = __import__(module)
+        with open(config_cache_path(path), encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}, False
+    return cache, (
+        cache.get("mtime_ns") == stat.st_mtime_ns and cache.get("size") == stat.st_size
+    )
+
+
+def fast_complete():
+    """
+    Complete master names for --name straight from the config cache, without
+    importing click or any other dependency. Return False when the completion
+    must be left to click
+    """
+    shell, _, action = os.environ.get("_VAUBAN_COMPLETE", "").partition("_")
+    if action != "complete" or shell not in ["bash", "zsh", "fish"]:
+        return False
+    try:
+        words = shlex.split(os.environ["COMP_WORDS"])
+        if shell == "fish":
+            incomplete = os.environ["COMP_CWORD"]
+            args = words[1:]
+            if incomplete and args and args[-1] == incomplete:
+                args.pop()
+        else:
+            cword = int(os.environ["COMP_CWORD"])
+            args = words[1:cword]
+            incomplete = words[cword] if cword < len(words) else ""
+    except (KeyError, ValueError):
+        return False
+    if not args or args[-1] != "--name":
+        return False
+
+    config_path = "config.yml"
+    if "--config-path" in args[:-1]:
+        config_path = args[args.index("--config-path") + 1]
+    try:
+        cache, fresh = read_config_cache(config_path)
+    except OSError:
+        return False
+    if not fresh:
+        return False
+
+    # Same walk as VaubanConfiguration/VaubanMaster do
+    names = []
+    todo = [
+        (k, v) for k, v in reversed(cache["config"].items()) if k != "configuration"
+    ]
+    while todo:
+        k, v = todo.pop()
+        if not isinstance(v, dict):
+            continue
+        names.append(v.get("name", k))
+        todo += reversed(list(v.items()))
+
+    try:
+        for name in dict.fromkeys(names):
+            if name.startswith(incomplete):
+                print(f"plain\n{name}\n_" if shell == "zsh" else f"plain,{name}")
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader is gone, like grep -m 1: so is the flush on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return True
+
+
+# Shell completion is run on every Tab press: answer it before loading anything
+if os.environ.get("_VAUBAN_COMPLETE") and fast_complete():
+    sys.exit(0)
+
+import uuid
+import subprocess
+import traceback
+import shutil
+import threading
+import signal
+import gzip
+import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from copy import deepcopy
+from dataclasses import dataclass, field
+import vauban_tracing
+
+
+def require(module, module_name):
+    """
+    Import an external module and print an nice error message if module is not
+    found
+    """
+    try:
+        return __import__(module)
     except ModuleNotFoundError:
         print(f"Unable to import module: {module_name}")
         print("Try to install it:")
@@ -47,14 +138,31 @@ for module, module_name in [
         print(f"	apt install -y python3-{module_name}")
         print(f"	pacman -S python-{module}")
         print(f"	apk add --no-cache py3-{module}")
-        exit(1)
-SENTRY_DSN = os.environ.get("SENTRY_DSN", None)
-if SENTRY_DSN:
+        sys.exit(1)
+
+
+click = require("click", "click")
+
+
+def init_sentry():
+    """
+    Report errors to sentry if SENTRY_DSN is set. sentry_sdk is only imported
+    then
+    """
+    sentry_dsn = os.environ.get("SENTRY_DSN", None)
+    if not sentry_dsn:
+        return
+    try:
+        import sentry_sdk  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        print(e)
+        print("sentry_sdk not found in your environment. Please install sentry_sdk")
+        return
     sentry_sdk.init(
-        dsn=SENTRY_DSN,
-        # Set traces_sample_rate to 1.0 to capture 100%
-        # of transactions for performance monitoring.
-        traces_sample_rate=1.0,
+        dsn=sentry_dsn,
+        # Defaults to 1.0 to capture 100% of transactions for performance
+        # monitoring.
+        traces_sample_rate=float(os.environ.get("SENTRY_TRACES_SAMPLE_RATE", "1.0")),
     )
 
 
@@ -70,7 +178,7 @@ class BuildConfig:
     Store build configuration, the cli arguments, as an object
     """
 
-    name: str
+    name: tuple
     stage: str
     branch: str
     debug: bool
@@ -79,6 +187,8 @@ class BuildConfig:
     build_parents: int
     conffs: str
     kubernetes_no_cleanup: bool
+    jobs: int
+    no_stage_cache: bool
 
     def copy(self):
         return deepcopy(self)
@@ -95,7 +205,7 @@ class MasterNameType(click.ParamType):
 
     def shell_complete(self, ctx, param, incomplete):
         try:
-            config = VaubanConfiguration()
+            config = VaubanConfiguration(ctx.params.get("config_path") or "config.yml")
         except FileNotFoundError:
             return []
         return [
@@ -105,6 +215,47 @@ class MasterNameType(click.ParamType):
         ]
 
 
+def load_config(path):
+    """
+    Load the content of a configuration file. The parsed content is cached on
+    disk, keyed on the file's mtime and hash, so that the YAML is only parsed
+    again when the file changes
+    """
+    cache, fresh = read_config_cache(path)
+    if fresh:
+        return cache["config"]
+
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        content = f.read()
+    sha256 = hashlib.sha256(content).hexdigest()
+    if cache.get("sha256") == sha256:
+        config = cache["config"]
+    else:
+        config = require("yaml", "pyyaml").safe_load(content)
+
+    cache = {
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "sha256": sha256,
+        "config": config,
+    }
+    cache_path = config_cache_path(path)
+    tmp_path = f"{cache_path}.{os.getpid()}"
+    try:
+        os.makedirs(CONFIG_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        # Not being able to cache is not an issue, only slower
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+    return config
+
+
 class VaubanConfiguration:
     """
     Represent a vauban configuration from its config file
@@ -118,14 +269,15 @@ class VaubanConfiguration:
         self.output = output
         super().__init__()
         self.masters = []
+        # name -> VaubanMaster, for every master of the configuration
+        self.index: dict = {}
         self._parse()
 
     def _parse(self):
         """
         Open and parse the configuration file to create VaubanMasters
         """
-        with open(self.path, encoding="utf-8") as f:
-            config_yml = yaml.safe_load(f.read())
+        config_yml = load_config(self.path)
         self.config = config_yml.get("configuration", {})
         self._check_config()
 
@@ -138,6 +290,8 @@ class VaubanConfiguration:
         for k, default in [
             ("ignore_stage_in_conffs", []),
             ("never_upload", []),
+            ("always_apply_stage_in_conffs", []),
+            ("squashfs_profiles", {}),
         ]:
             if k not in self.config:
                 self.config[k] = default
@@ -146,67 +300,136 @@ class VaubanConfiguration:
         """
         Return a VaubanMaster instance from a name
         """
-        for master in self.masters:
-            m = master.get_master(name)
-            if m is not None:
-                return m
-        return None
+        return self.index.get(name)
 
     def list_masters(self) -> [str]:
         """
         Return a list of master names
         """
-        r = []
-        for master in self.masters:
-            r += master.list_masters()
-        return r
+        return list(self.index)
+
+    def match_masters(self, patterns) -> ([VaubanMaster], [str]):
+        """
+        Return the masters whose name matches one of the given glob patterns,
+        parents first, and the patterns that matched nothing
+        """
+        matched = {}
+        unmatched = []
+        for pattern in patterns:
+            names = fnmatch.filter(self.index, pattern)
+            if not names:
+                unmatched.append(pattern)
+            matched.update(dict.fromkeys(names))
+        return [m for name, m in self.index.items() if name in matched], unmatched
+
+
+LOGS_DIR = "/tmp/vauban"
+
+
+class LogCollector:
+    """
+    Consume the output of a vauban.sh run as it comes: echo it (unless the run
+    is in the background), spill it to a compressed log file, and keep only
+    the last error lines in memory
+    """
+
+    ERROR_LINES = 200
+
+    def __init__(self, process, path, echo=True):
+        self.path = path
+        self.echo = echo
+        self.recap_path = None
+        self.error_lines = deque(maxlen=LogCollector.ERROR_LINES)
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._consume, args=(process.stdout, sys.stdout)),
+            threading.Thread(target=self._consume, args=(process.stderr, sys.stderr)),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def _consume(self, pipe, stream):
+        for line in pipe:
+            if self.echo:
+                stream.write(line)
+                stream.flush()
+            with self._lock:
+                self._file.write(line)
+            if stream is sys.stderr:
+                self.error_lines.append(line)
+            elif self.recap_path is None and "recap file: " in line:
+                self.recap_path = line.split("recap file: ")[1].strip()
+
+    def close(self):
+        for thread in self._threads:
+            thread.join()
+        self._file.close()
 
 
 class OutputHandler:
     OK_GREEN = "\033[92m"
     KO_RED = "\033[91m"
     RESET = "\033[0m"
+    MAX_LINES = 10000
 
     def __init__(self):
-        self._logs = OutputHandler.OK_GREEN
+        # Bounded: the oldest lines are dropped, the full logs are on disk
+        self._logs = deque(maxlen=OutputHandler.MAX_LINES)
+        self._dropped = 0
+        self._full_logs = []
         self._header = False
+        self._lock = threading.Lock()
 
     def get_output(self):
-        return self._logs + OutputHandler.RESET
-
-    def _process(self, content, error=False, error_lines=None):
+        output = [OutputHandler.OK_GREEN]
+        if self._dropped:
+            output.append(f"[... {self._dropped} lines dropped ...]\n")
+        output += self._logs
+        output.append(OutputHandler.RESET)
+        if self._full_logs:
+            output.append("\nFull logs:\n" + "\n".join(self._full_logs))
+        return "".join(output)
+
+    def _append(self, line):
+        if len(self._logs) == self._logs.maxlen:
+            self._dropped += 1
+        self._logs.append(line)
+
+    def _process(self, recap_path, error=False, error_lines=None):
         if error:
-            self._logs += OutputHandler.KO_RED
-        lines = content.split("\n")
+            self._append(OutputHandler.KO_RED)
         found_separation_line = False
-        for line in lines[1:]:
-            if "recap file: " in line:
-                found_separation_line = True
-                continue
-            if found_separation_line or not self._header:
-                self._logs += line + "\n"
+        with open(recap_path, "r", errors="replace") as f:
+            next(f, None)
+            for line in f:
+                if "recap file: " in line:
+                    found_separation_line = True
+                    continue
+                if found_separation_line or not self._header:
+                    self._append(line)
         assert found_separation_line
         self._header = True
         if error:
-            self._logs += "".join(error_lines)
+            for line in error_lines:
+                self._append(line)
 
-    def process(self, path, error=False):
-        with open(path + "-stdout", "r") as f:
-            lines = f.readlines()
-        error_lines = None
-        if error:
-            with open(path + "-stderr", "r") as f:
-                error_lines = f.readlines()
-        for line in lines:
-            if "recap file: " in line:
-                self._process(
-                    open(line.split("recap file: ")[1].strip()).read(),
-                    error,
-                    error_lines,
-                )
-                break
-        os.remove(path + "-stdout")
-        os.remove(path + "-stderr")
+    def print_logs(self, path, title):
+        """
+        Print in one block the logs of a build that ran alongside others, so
+        that the logs of concurrent builds are not mixed up
+        """
+        with self._lock:
+            print(f"{'=' * 20} {title} {'=' * 20}", flush=True)
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                shutil.copyfileobj(f, sys.stdout)
+            sys.stdout.flush()
+
+    def process(self, collector, error=False):
+        with self._lock:
+            self._full_logs.append(collector.path)
+            if collector.recap_path is not None:
+                self._process(collector.recap_path, error, collector.error_lines)
 
 
 class VaubanMaster:
@@ -230,11 +453,24 @@ class VaubanMaster:
         self.stages = value.get("stages", [])
         self.conffs = value.get("conffs", None)
         self.branch = value.get("branch", None)
+        # The squashfs profile is inherited from the parent
+        self.squashfs = value.get(
+            "squashfs", None if parent is None else parent.squashfs
+        )
+        if (
+            self.squashfs is not None
+            and self.squashfs not in configuration.config["squashfs_profiles"]
+        ):
+            raise click.ClickException(
+                f"Unknown squashfs profile {self.squashfs} for {name}, not in "
+                "squashfs_profiles"
+            )
         self.is_release = parent is None
         self.release: str = name if self.is_release else parent.release
         self.name = value.get("name", name)
         self.configuration: VaubanConfiguration = configuration
         self.output = configuration.output
+        configuration.index.setdefault(self.name, self)
         for k, v in value.items():
             if isinstance(v, dict):
                 self.children.append(VaubanMaster(k, v, self.configuration, self))
@@ -245,6 +481,15 @@ class VaubanMaster:
     def __str__(self):
         return self.name
 
+    def squashfs_options(self) -> str:
+        """
+        Return the mksquashfs options of our squashfs profile, or None to use
+        the vauban.sh ones
+        """
+        if self.squashfs is None:
+            return None
+        return self.configuration.config["squashfs_profiles"][self.squashfs]
+
     def get_master(self, name) -> VaubanMaster:
         """
         Get a master by a name. Could be us, or one of our children
@@ -275,13 +520,17 @@ class VaubanMaster:
         print("=" * 53)
         print()
 
-    def _build_stage(self, cc):
+    def _build_stages(self, ccs, background=False, trace_parent=None):
         """
         Internal build function. Actually performs the build if not in debug
-        mode
+        mode. Several stages are built in a single vauban.sh session, sharing
+        its initialization. In background mode, the build runs in its own
+        working directory and its logs are printed once it is done
         """
 
-        assert cc.stage in ["rootfs", "initramfs", "conffs", "kernel"]
+        cc = ccs[0]
+        for stage_cc in ccs:
+            assert stage_cc.stage in ["rootfs", "initramfs", "conffs", "kernel"]
 
         if cc.branch is None or cc.branch == "ansible-branch-name-here":
             branch = self.branch or "master"
@@ -308,13 +557,30 @@ class VaubanMaster:
         ]
         if cc.kubernetes_no_cleanup:
             vauban_cli += ["--kubernetes-no-cleanup", "yes"]
+        if cc.no_stage_cache:
+            vauban_cli += ["--stage-cache", "no"]
 
         if cc.conffs is not None:
             # Override conffs from config.yml
             self.conffs = cc.conffs
 
-        # Auto expand vauban CLI based on the current stage
-        vauban_cli = STAGES[cc.stage](self.configuration.config, vauban_cli, self)
+        # Auto expand vauban CLI based on the current stage(s)
+        session = None
+        if len(ccs) == 1:
+            vauban_cli = STAGES[cc.stage](self.configuration.config, vauban_cli, self)
+        else:
+            session = []
+            for stage_cc in ccs:
+                try:
+                    session.append(
+                        STAGES[stage_cc.stage](self.configuration.config, [], self)
+                    )
+                except NothingToDoException:
+                    pass
+            session_path = os.path.join(
+                LOGS_DIR, f"vauban-session-{str(uuid.uuid4())}.jsonl"
+            )
+            vauban_cli += ["--session", session_path]
 
         my_env = os.environ.copy()
         my_env["VAUBAN_PRINT_RECAP"] = "no"
@@ -323,50 +589,262 @@ class VaubanMaster:
             my_env["VAUBAN_SET_FLAGS"] = my_env.get("VAUBAN_SET_FLAGS", "") + "x"
             debug_cmd = "VAUBAN_SET_FLAGS=" + my_env["VAUBAN_SET_FLAGS"] + " "
 
-        tmp_path = f"/tmp/vauban-logs-{str(uuid.uuid4())}"
-        exec_cmd = "setsid "
+        exec_cmd = "setsid --wait "
         for el in vauban_cli:
             exec_cmd += "'" + el + "' "
-        exec_cmd += f" > >(tee {tmp_path}-stdout) 2> >(tee {tmp_path}-stderr >&2)"
 
+        title = f"{self.name} {'+'.join(stage_cc.stage for stage_cc in ccs)}"
         if cc.debug:
             print(f"{debug_cmd} {exec_cmd}")
+            if session is not None:
+                for stage_args in session:
+                    print(f"    session stage: {' '.join(stage_args)}")
         if cc.check:
             return
 
-        try:
-            process = subprocess.run(
-                ["bash", "-c", exec_cmd], check=True, env=my_env, start_new_session=True
+        cwd = prepare_workspace(title.replace(" ", "-")) if background else None
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        if session is not None:
+            with open(session_path, "w", encoding="utf-8") as f:
+                for stage_args in session:
+                    f.write(json.dumps(stage_args) + "\n")
+        log_path = os.path.join(LOGS_DIR, f"vauban-logs-{str(uuid.uuid4())}.log.gz")
+        # vauban.sh writes its spans to its own file, merged into ours after
+        trace_path = os.path.join(LOGS_DIR, f"vauban-trace-{str(uuid.uuid4())}.jsonl")
+        my_env[vauban_tracing.TRACE_FILE_ENV] = trace_path
+        with vauban_tracing.span(
+            "build", parent=trace_parent, master=self.name, stages=title.split()[1]
+        ) as context:
+            my_env.update(vauban_tracing.env(context))
+            process = subprocess.Popen(
+                ["bash", "-c", exec_cmd],
+                env=my_env,
+                start_new_session=True,
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                errors="replace",
+            )
+            collector = LogCollector(process, log_path, echo=not background)
+            try:
+                returncode = process.wait()
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                collector.close()
+                if session is not None:
+                    os.remove(session_path)
+                vauban_tracing.merge(trace_path)
+                if os.path.exists(trace_path):
+                    os.remove(trace_path)
+
+        if background:
+            self.output.print_logs(
+                log_path, title + (" (failed)" if returncode else "")
             )
-        except subprocess.CalledProcessError:
-            self.output.process(tmp_path, error=True)
-            raise
-        self.output.process(tmp_path)
-        assert process.returncode == 0
+        self.output.process(collector, error=returncode != 0)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, exec_cmd)
 
-    def build(self, cc):
+    def plan(self, cc, graph):
         """
-        Build this master with the given parameters. "Recursive" function,
-        it handles the cases where stage=[all, trueall] and build_parents
-        option
+        Add to the build graph the stages needed to build this master with the
+        given parameters. "Recursive" function, it handles the cases where
+        stage=[all, trueall] and build_parents option
         """
         if cc.build_parents != 0:
             if cc.stage in ["rootfs", "all", "trueall"]:
                 if self.parent is not None:
-                    self.parent.build(cc.u_stage("rootfs"))
+                    self.parent.plan(cc.u_stage("rootfs"), graph)
             else:
-                self.build(cc.u_stage("rootfs"))
+                self.plan(cc.u_stage("rootfs"), graph)
         if cc.stage in ["all", "trueall"]:
-            self._build_stage(cc.u_stage("rootfs"))
-            try:
-                self._build_stage(cc.u_stage("conffs"))
-            except NothingToDoException:
-                pass
-            self._build_stage(cc.u_stage("initramfs"))
+            stages = ["rootfs", "conffs", "initramfs"]
             if cc.stage == "trueall":
-                self._build_stage(cc.u_stage("kernel"))
+                stages.append("kernel")
+            ccs = [cc.u_stage(stage) for stage in stages]
+            if graph.jobs == 1:
+                # Nothing to build alongside: build everything in one session
+                graph.add(self, *ccs)
+            else:
+                for stage_cc in ccs:
+                    graph.add(self, stage_cc)
         else:
-            self._build_stage(cc)
+            graph.add(self, cc)
+
+    def build(self, cc):
+        """
+        Build this master with the given parameters
+        """
+        build([self], cc)
+
+
+def build(masters, cc):
+    """
+    Build several masters with the given parameters. They are planned in the
+    same graph, so that an ancestor shared by several of them is only built
+    once, before its descendants
+    """
+    graph = BuildGraph(cc.jobs)
+    for master in masters:
+        master.plan(cc, graph)
+    graph.run()
+
+
+@dataclass(eq=False)
+class BuildNode:
+    """
+    A node of the build graph: stage(s) of a master built together, and the
+    nodes that must be built before
+    """
+
+    master: VaubanMaster
+    ccs: list
+    dependencies: list = field(default_factory=list)
+
+    def __str__(self):
+        return f"{self.master}:{'+'.join(cc.stage for cc in self.ccs)}"
+
+
+class BuildGraph:
+    """
+    Dependency graph of the stages to build. Nodes that don't depend on each
+    other are built concurrently, up to `jobs` at a time
+    """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        # (master name, stage) -> BuildNode. A node may build several stages
+        self.nodes: dict = {}
+
+    def add(self, master, *ccs) -> BuildNode:
+        """
+        Add stage(s) of a master to the graph, as a single node. Stages already
+        in the graph are not added again
+        """
+        ccs = [cc for cc in ccs if (master.name, cc.stage) not in self.nodes]
+        if not ccs:
+            return None
+        node = BuildNode(master, ccs)
+        for cc in ccs:
+            self.nodes[(master.name, cc.stage)] = node
+        return node
+
+    def _unique_nodes(self) -> [BuildNode]:
+        return list(dict.fromkeys(self.nodes.values()))
+
+    def _link(self):
+        """
+        Compute the dependencies between the nodes of the graph:
+        - a rootfs is built from its parent's rootfs
+        - conffs, initramfs and kernel come after their master's rootfs
+        - initramfs from the same debian release share a working directory,
+          and are not built concurrently
+        """
+        last_initramfs = {}
+        for node in self._unique_nodes():
+            master = node.master
+            node.dependencies = []
+            for cc in node.ccs:
+                if cc.stage == "rootfs":
+                    dependency = (
+                        None
+                        if master.parent is None
+                        else self.nodes.get((master.parent.name, "rootfs"))
+                    )
+                else:
+                    dependency = self.nodes.get((master.name, "rootfs"))
+                if cc.stage == "initramfs" and self.jobs > 1:
+                    if master.release in last_initramfs:
+                        node.dependencies.append(last_initramfs[master.release])
+                    last_initramfs[master.release] = node
+                if dependency is not None and dependency is not node:
+                    node.dependencies.append(dependency)
+
+    def run(self):
+        """
+        Build all the nodes of the graph. On the first failure, no new node is
+        started, the running ones are waited for, and the error is raised
+        """
+        self._link()
+        pending = self._unique_nodes()
+        done = set()
+        running = {}
+        errors = []
+        # Worker threads don't inherit the current span
+        trace_parent = vauban_tracing.current()
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                ready = [
+                    node
+                    for node in pending
+                    if all(d in done for d in node.dependencies)
+                ]
+                while not errors and ready and len(running) < self.jobs:
+                    node = ready.pop(0)
+                    pending.remove(node)
+                    future = executor.submit(
+                        node.master._build_stages,
+                        node.ccs,
+                        self.jobs > 1,
+                        trace_parent,
+                    )
+                    running[future] = node
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    try:
+                        future.result()
+                    except NothingToDoException:
+                        pass
+                    except Exception as e:  # pylint: disable=broad-except
+                        print(f"Building {node} failed !")
+                        errors.append(e)
+                        continue
+                    done.add(node)
+        if errors:
+            raise errors[0]
+
+
+WORKSPACES_DIR = ".vauban-jobs"
+# Build artifacts and per-build state that vauban.sh writes in its working
+# directory: they must not be shared between concurrent builds
+WORKSPACE_PRIVATE_ENTRIES = [
+    WORKSPACES_DIR,
+    "ansible",
+    "tmp",
+    "overlayfs",
+    "linux-build",
+    "rootfs.img",
+    "rootfs.tgz",
+    "initramfs.img",
+    "vmlinuz",
+    "vmlinuz-default",
+]
+
+
+def prepare_workspace(name):
+    """
+    Create, or refresh, the working directory of a build running alongside
+    others. It links to everything in the current directory but the build
+    artifacts, and keeps its own ansible checkout between runs
+    """
+    source = os.getcwd()
+    path = os.path.join(source, WORKSPACES_DIR, name.replace("/", "_"))
+    os.makedirs(path, exist_ok=True)
+    for entry in os.listdir(source):
+        if entry in WORKSPACE_PRIVATE_ENTRIES:
+            continue
+        link = os.path.join(path, entry)
+        if os.path.islink(link):
+            os.remove(link)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(source, entry), link)
+    return path
 
 
 def rootfs(config, vauban_cli, master, only=True):  # pylint: disable=unused-argument
@@ -386,6 +864,8 @@ def rootfs(config, vauban_cli, master, only=True):  # pylint: disable=unused-arg
             "--kernel",
             "no",
         ]
+    if master.squashfs_options() is not None:
+        vauban_cli += ["--squashfs-options", master.squashfs_options()]
     if not master.is_release:
         vauban_cli += ["--source-image", str(master.parent)] + master.stages
     return vauban_cli
@@ -468,13 +948,25 @@ STAGES = {
 signal.signal(signal.SIGUSR1, lambda a, b: None)
 
 
+def print_trace_summary(trace_path):
+    """
+    Print where the time of the build went, from its trace
+    """
+    if trace_path is None or not os.path.exists(trace_path):
+        return
+    print()
+    print(f"Time spent per phase (trace file: {trace_path}):")
+    print(vauban_tracing.summary(trace_path))
+
+
 @click.command()
 @click.option(
     "--name",
-    default="master-11-netdata",
+    default=["master-11-netdata"],
     show_default=True,
+    multiple=True,
     type=MasterNameType(),
-    help="Name of the master to build",
+    help="Name of the master to build. Can be given several times, and can be a glob pattern, like 'master-12-*'",
 )
 @click.option(
     "--stage",
@@ -533,50 +1025,79 @@ signal.signal(signal.SIGUSR1, lambda a, b: None)
     show_default=True,
     help="Disable automatic cleanup of resources in the end",
 )
+@click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="How many stages to build at the same time, when they don't depend on each other",
+)
+@click.option(
+    "--no-stage-cache",
+    is_flag=True,
+    default=False,
+    show_default=True,
+    help="Rebuild every stage, even the ones whose inputs didn't change since they were last built",
+)
 def vauban(**kwargs):
     """
     Wrapper around vauban.sh for ease of use. Uses a config file to generate
     vauban.sh commands
     """
+    init_sentry()
     cc = BuildConfig(**kwargs)
     if cc.check:
         cc.debug = True
 
     output = OutputHandler()
     config = VaubanConfiguration(cc.config_path, output)
-    master = config.get_master(cc.name)
+    masters, unmatched = config.match_masters(cc.name)
 
-    if master is None:
-        print(f"Cannot build {cc.name}: not found in {cc.config_path}")
+    if unmatched:
+        print(f"Cannot build {', '.join(unmatched)}: not found in {cc.config_path}")
         sys.exit(1)
+    names = ", ".join(str(master) for master in masters)
     if cc.debug:
         print("Available masters:")
         print(json.dumps(config.list_masters(), indent=4))
-        print("Selected master:")
-        print(repr(master))
+        print("Selected masters:" if len(masters) > 1 else "Selected master:")
+        for master in masters:
+            print(repr(master))
+
+    trace_path = None
+    if not cc.check:
+        trace_path = vauban_tracing.trace_file() or os.path.join(
+            LOGS_DIR, f"vauban-trace-{str(uuid.uuid4())}.jsonl"
+        )
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+        vauban_tracing.configure(trace_path)
 
     try:
-        master.build(cc)
+        with vauban_tracing.span("vauban.py", masters=names, stage=cc.stage):
+            build(masters, cc)
     except NothingToDoException as e:
         pass
     except subprocess.CalledProcessError as e:
         print("Building failed !")
         print(output.get_output())
+        print_trace_summary(trace_path)
         sys.exit(1)
     except Exception as e:
         exc_info = sys.exc_info()
         traceback.print_exception(*exc_info)
         print(output.get_output())
+        print_trace_summary(trace_path)
         print()
         print("Building failed !")
         sys.exit(1)
     print(output.get_output())
+    print_trace_summary(trace_path)
 
     if not cc.debug:
         if cc.stage in ["rootfs", "all", "trueall"]:
-            print(f"Building successful ! {cc.name} was built")
+            print(f"Building successful ! {names} was/were built")
         if cc.stage in ["conffs", "all", "trueall"]:
-            print(f"Building successful ! conffs for {cc.name} was/were built.")
+            print(f"Building successful ! conffs for {names} was/were built.")
         if cc.stage in ["initramfs", "all", "trueall", "kernel"]:
             print("Building successful !")
     return 0
@@ -50,76 +50,111 @@ function check_args() {
     fi
 }
 
-function main() {
+function build_stages() {
     local kernel
     local kernel_version=""
     local prefix_name
     local source_name
     local upload_list=""
-    # Try to be nicer
-    ionice -c3 -p $$ > /dev/null 2>&1 || true
-    renice -n 20 $$ > /dev/null 2>&1 || true
-
-    check_args
 
-
-vauban_log "$NEWLINE$(cat <<"EOF"
-
- ____      ____        ____    ____   ____       _____          ____  _____   ______
-|    |    |    |  ____|\   \  |    | |    | ___|\     \    ____|\   \|\    \ |\     \
-|    |    |    | /    /\    \ |    | |    ||    |\     \  /    /\    \\\    \| \     \
-|    |    |    ||    |  |    ||    | |    ||    | |     ||    |  |    |\|    \  \     |
-|    |    |    ||    |__|    ||    | |    ||    | /_ _ / |    |__|    | |     \  |    |
-|    |    |    ||    .--.    ||    | |    ||    |\    \  |    .--.    | |      \ |    |
-|\    \  /    /||    |  |    ||    | |    ||    | |    | |    |  |    | |    |\ \|    |
-| \ ___\/___ / ||____|  |____||\___\_|____||____|/____/| |____|  |____| |____||\_____/|
- \ |   ||   | / |    |  |    || |    |    ||    /     || |    |  |    | |    |/ \|   ||
-  \|___||___|/  |____|  |____| \|____|____||____|_____|/ |____|  |____| |____|   |___|/
-    \(    )/      \(      )/      \(   )/    \(    )/      \(      )/     \(       )/
-     '    '        '      '        '   '      '    '        '      '       '       '
-=======================================================================================
-EOF
-)"
-vauban_log "                                $current_date"
-vauban_log "recap file: $recap_file"
     if [[ "$_arg_rootfs" = "yes" ]]; then
         if [[ -n "$_arg_source_image" ]]; then
             prefix_name="$(echo "$_arg_source_image" | cut -d'/' -f1)"
             source_name="$_arg_source_image"
         else
-            create_parent_rootfs "$_arg_name" "$_arg_debian_release" "${_arg_stages[@]}"
+            trace_span create_parent_rootfs release="$_arg_debian_release" -- \
+                create_parent_rootfs "$_arg_name" "$_arg_debian_release" "${_arg_stages[@]}"
             prefix_name="debian-$_arg_debian_release"
             source_name="$prefix_name/iso"
         fi
-        build_rootfs "$source_name" "$prefix_name" "$_arg_name" "$_arg_name" "${_arg_stages[@]}"
+        trace_span rootfs name="$_arg_name" -- \
+            build_rootfs "$source_name" "$prefix_name" "$_arg_name" "$_arg_name" "${_arg_stages[@]}"
         _arg_source_image="$source_name"  # conffs will be built on top of what we just built
     fi
     if [[ "$_arg_conffs" = "yes" ]]; then
         if [[ -n "$_arg_source_image" ]]; then
             prefix_name="$(echo "$_arg_source_image" | cut -d'/' -f1)"
-            build_conffs "$_arg_source_image" "$prefix_name"
+            trace_span conffs name="$_arg_name" -- build_conffs "$_arg_source_image" "$prefix_name"
         else
-            build_conffs "$_arg_name" "$prefix_name"
+            trace_span conffs name="$_arg_name" -- build_conffs "$_arg_name" "$prefix_name"
         fi
     fi
     if [[ "$_arg_initramfs" = "yes" ]]; then
         [[ -z "${name:-}" ]] && name="$_arg_name"
-        build_initramfs "$name"
+        trace_span initramfs release="$_arg_debian_release" -- build_initramfs "$name"
         kernel="./vmlinuz-default"
         #kernel_version="$(get_kernel_version "$kernel")"
     fi
     if [[ "$_arg_kernel" = "yes" ]]; then
         [[ -z "${name:-}" ]] && name="$_arg_name"
-        build_kernel "$name"
+        trace_span kernel -- build_kernel "$name"
         kernel="./vmlinuz"
         kernel_version="$(get_kernel_version "$kernel")"
     fi
     if [[ $_arg_upload = "yes" ]]; then
-        upload "$_arg_name" "$kernel_version" "$upload_list"
+        trace_span upload name="$_arg_name" -- upload "$_arg_name" "$kernel_version" "$upload_list"
         if [[ "$_arg_rootfs" = "yes" ]]; then
             set_deployed "$_arg_name"
         fi
     fi
+}
+
+function run_session() {
+    # Build every stage listed in the session file within this process: the
+    # build engine, the ansible checkout and the registry credentials are
+    # initialized once for all of them. Each stage is parsed and built in a
+    # subshell, on top of the arguments given to vauban.sh
+    local session_file="$1"
+    local stage_args
+
+    init_build_engine
+    clone_ansible_repo
+    while IFS= read -r stage_args; do
+        (
+        # The mounts and locks of a failed stage must not outlive it
+        trap 'release_locks' EXIT
+        mapfile -t stage_args_array < <(echo "$stage_args" | jq -r '.[]')
+        _positionals=()
+        _arg_stages=()
+        parse_commandline "${stage_args_array[@]}"
+        assign_positional_args 1 "${_positionals[@]}"
+        check_args
+        build_stages
+        )
+    done < "$session_file"
+}
+
+function main() {
+    # Try to be nicer
+    ionice -c3 -p $$ > /dev/null 2>&1 || true
+    renice -n 20 $$ > /dev/null 2>&1 || true
+
+    [[ -n "$_arg_session" ]] || check_args
+
+vauban_log "$NEWLINE$(cat <<"EOF"
+
+ ____      ____        ____    ____   ____       _____          ____  _____   ______
+|    |    |    |  ____|\   \  |    | |    | ___|\     \    ____|\   \|\    \ |\     \
+|    |    |    | /    /\    \ |    | |    ||    |\     \  /    /\    \\\    \| \     \
+|    |    |    ||    |  |    ||    | |    ||    | |     ||    |  |    |\|    \  \     |
+|    |    |    ||    |__|    ||    | |    ||    | /_ _ / |    |__|    | |     \  |    |
+|    |    |    ||    .--.    ||    | |    ||    |\    \  |    .--.    | |      \ |    |
+|\    \  /    /||    |  |    ||    | |    ||    | |    | |    |  |    | |    |\ \|    |
+| \ ___\/___ / ||____|  |____||\___\_|____||____|/____/| |____|  |____| |____||\_____/|
+ \ |   ||   | / |    |  |    || |    |    ||    /     || |    |  |    | |    |/ \|   ||
+  \|___||___|/  |____|  |____| \|____|____||____|_____|/ |____|  |____| |____|   |___|/
+    \(    )/      \(      )/      \(   )/    \(    )/      \(      )/     \(       )/
+     '    '        '      '        '   '      '    '        '      '       '       '
+=======================================================================================
+EOF
+)"
+vauban_log "                                $current_date"
+vauban_log "recap file: $recap_file"
+    if [[ -n "$_arg_session" ]]; then
+        run_session "$_arg_session"
+    else
+        build_stages
+    fi
     vauban_log "Done ! Exiting at $current_date"
     end 0
 }
@@ -137,6 +172,9 @@ vauban_log "recap file: $recap_file"
 # ARG_OPTIONAL_SINGLE([ansible-host],[a],[The ansible hosts to generate the config rootfs on. Equivalent to ansible's --limit, but is empty by default],[])
 # ARG_OPTIONAL_SINGLE([build-engine],[e],[The build engine used by vauban. Can be docker, kubernetes],[kubernetes])
 # ARG_OPTIONAL_SINGLE([kubernetes-no-cleanup],[],[Don't cleanup kubernetes resources in the end],[no])
+# ARG_OPTIONAL_SINGLE([stage-cache],[],[Reuse images built by a previous run with the same inputs],[yes])
+# ARG_OPTIONAL_SINGLE([session],[],[A file listing the stages to build in this same session, one JSON array of arguments per line],[])
+# ARG_OPTIONAL_SINGLE([squashfs-options],[],[The mksquashfs options compressing the rootfs],[-comp xz -always-use-fragments])
 # ARG_POSITIONAL_INF([stages],[The stages to add to this image, i.e. the ansible playbooks to apply. For example pb_base.yml],[0])
 # ARG_HELP([Build master images and makes coffee])
 # ARGBASH_SET_INDENT([    ])
@@ -181,12 +219,15 @@ _arg_branch="master"
 _arg_ansible_host=
 _arg_build_engine="kubernetes"
 _arg_kubernetes_no_cleanup="no"
+_arg_stage_cache="yes"
+_arg_session=
+_arg_squashfs_options="-comp xz -always-use-fragments"
 
 
 print_help()
 {
     printf '%s\n' "Build master images and makes coffee"
-    printf 'Usage: %s [-r|--rootfs <arg>] [-i|--initramfs <arg>] [-p|--kernel <arg>] [-l|--conffs <arg>] [-u|--upload <arg>] [-d|--debian-release <arg>] [-s|--source-image <arg>] [-k|--ssh-priv-key <arg>] [-n|--name <arg>] [-b|--branch <arg>] [-a|--ansible-host <arg>] [-e|--build-engine <arg>] [--kubernetes-no-cleanup <arg>] [-h|--help] [<stages-1>] ... [<stages-n>] ...\n' "$0"
+    printf 'Usage: %s [-r|--rootfs <arg>] [-i|--initramfs <arg>] [-p|--kernel <arg>] [-l|--conffs <arg>] [-u|--upload <arg>] [-d|--debian-release <arg>] [-s|--source-image <arg>] [-k|--ssh-priv-key <arg>] [-n|--name <arg>] [-b|--branch <arg>] [-a|--ansible-host <arg>] [-e|--build-engine <arg>] [--kubernetes-no-cleanup <arg>] [--stage-cache <arg>] [--session <arg>] [--squashfs-options <arg>] [-h|--help] [<stages-1>] ... [<stages-n>] ...\n' "$0"
     printf '\t%s\n' "<stages>: The stages to add to this image, i.e. the ansible playbooks to apply. For example pb_base.yml"
     printf '\t%s\n' "-r, --rootfs: Build the rootfs ? (default: 'yes')"
     printf '\t%s\n' "-i, --initramfs: Build the initramfs ? (default: 'yes')"
@@ -201,6 +242,9 @@ print_help()
     printf '\t%s\n' "-a, --ansible-host: The ansible hosts to generate the config rootfs on. Equivalent to ansible's --limit, but is empty by default (no default)"
     printf '\t%s\n' "-e, --build-engine: The build engine used by vauban. Can be docker, kubernetes (default: 'kubernetes')"
     printf '\t%s\n' "--kubernetes-no-cleanup: Don't cleanup kubernetes resources in the end (default: 'no')"
+    printf '\t%s\n' "--stage-cache: Reuse images built by a previous run with the same inputs (default: 'yes')"
+    printf '\t%s\n' "--session: A file listing the stages to build in this same session, one JSON array of arguments per line (no default)"
+    printf '\t%s\n' "--squashfs-options: The mksquashfs options compressing the rootfs (default: '-comp xz -always-use-fragments')"
     printf '\t%s\n' "-h, --help: Prints help"
 }
 
@@ -352,6 +396,30 @@ parse_commandline()
             --kubernetes-no-cleanup=*)
                 _arg_kubernetes_no_cleanup="${_key##--kubernetes-no-cleanup=}"
                 ;;
+            --stage-cache)
+                test $# -lt 2 && die "Missing value for the optional argument '$_key'." 1
+                _arg_stage_cache="$2"
+                shift
+                ;;
+            --stage-cache=*)
+                _arg_stage_cache="${_key##--stage-cache=}"
+                ;;
+            --session)
+                test $# -lt 2 && die "Missing value for the optional argument '$_key'." 1
+                _arg_session="$2"
+                shift
+                ;;
+            --session=*)
+                _arg_session="${_key##--session=}"
+                ;;
+            --squashfs-options)
+                test $# -lt 2 && die "Missing value for the optional argument '$_key'." 1
+                _arg_squashfs_options="$2"
+                shift
+                ;;
+            --squashfs-options=*)
+                _arg_squashfs_options="${_key##--squashfs-options=}"
+                ;;
             -h|--help)
                 print_help
                 exit 0
@@ -0,0 +1,1084 @@
+#!/usr/bin/env python3
+"""
+Fetch images from the registry for the kubernetes build engine. The layers
+are downloaded concurrently, and each of them is streamed through its digest
+check and a decompressor into tar: no compressed blob nor intermediate tar
+file is written to disk. The result keeps the layout the engine expects: an
+OCI layout for the image, whose blobs but the layers are in oci_shared, and
+each layer extracted once in layers/<digest>.
+
+The whiteouts of the extracted layers are in the overlayfs format, so that
+they can be mounted as the lower directories of an overlay. copy-layers
+applies them when copying the layers instead, and pack-conffs and
+pack-rootfs when writing the union of layers to an archive or a squashfs
+image without assembling it on disk.
+
+Each layer has its metadata in layers/<digest>.json, whose modification time
+is the last time the layer was used. gc keeps the store under a size budget
+by evicting layers, the unreferenced then the least recently used first
+"""
+
+import base64
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import click
+import requests
+
+import vauban_tracing
+
+# How many layers are downloaded and extracted at the same time
+PULL_JOBS = int(os.environ.get("KUBE_IMAGE_PULL_JOBS", "4"))
+MANIFEST_TYPES = [
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+INDEX_TYPES = MANIFEST_TYPES[2:]
+CHUNK_SIZE = 1 << 20
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_MARKER = ".wh..wh..opq"
+OPAQUE_XATTR = "trusted.overlay.opaque"
+# Size the store is kept under by gc, like 200G. Empty for no limit
+STORE_BUDGET = os.environ.get("KUBE_IMAGE_STORE_BUDGET", "")
+# Layers used that recently are never evicted: they may be in use
+GC_GRACE_PERIOD = 3600
+# The cleanup export_rootfs does in a chroot on an assembled rootfs, for
+# pack-rootfs: what apt-get clean and rm remove, the resolv.conf link and
+# the mount points
+ROOTFS_EXCLUDES = [
+    "var/cache/apt/archives/*.deb",
+    "var/cache/apt/archives/partial/*",
+    "var/cache/apt/*.bin",
+    "root/.ssh/vauban__id_ed25519",
+    "root/ansible",
+    "root/.ansible",
+    "boot/initrd*",
+    "var/lib/apt/lists/*",
+    "tmp/*",
+    "var/tmp/*",
+]
+ROOTFS_SYMLINKS = {"etc/resolv.conf": "../run/resolvconf/resolv.conf"}
+ROOTFS_DIRECTORIES = ["proc", "dev", "sys"]
+
+
+def eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+@contextmanager
+def lock(path, exclusive=True, blocking=True):
+    """
+    Hold an advisory lock on a file, like lock_hold does in bash. Yields
+    whether the lock was taken: it always is, unless not blocking
+    """
+    with open(path, "a", encoding="utf-8") as f:
+        try:
+            fcntl.flock(
+                f,
+                (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                | (0 if blocking else fcntl.LOCK_NB),
+            )
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+
+def store_lock_path(store):
+    return os.path.join(store, ".vauban-store.lock")
+
+
+def decompressor(media_type):
+    """
+    Return the command decompressing a layer of the given media type to its
+    standard output, multi-threaded when the tools allow it
+    """
+    if media_type.endswith("zstd"):
+        return ["zstd", "-d", "-c", "-T0", "-q"]
+    if media_type.endswith("gzip"):
+        if shutil.which("pigz"):
+            return ["pigz", "-d", "-c"]
+        return ["gzip", "-d", "-c"]
+    return None
+
+
+class Registry:
+    """
+    Minimal client of the registry API, authenticated with the credentials
+    of the docker configuration, as skopeo is
+    """
+
+    def __init__(self, hostname):
+        self.hostname = hostname
+        self.session = requests.Session()
+        self.credentials = self._credentials()
+        self.tokens = {}
+
+    def _credentials(self):
+        path = os.path.join(
+            os.environ.get("DOCKER_CONFIG", os.path.expanduser("~/.docker")),
+            "config.json",
+        )
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                auth = json.load(f).get("auths", {}).get(self.hostname, {}).get("auth")
+        except (OSError, ValueError):
+            return None
+        if not auth:
+            return None
+        username, _, password = base64.b64decode(auth).decode().partition(":")
+        return username, password
+
+    def _authenticate(self, repository, challenge):
+        scheme, _, params = challenge.partition(" ")
+        if scheme.lower() == "basic":
+            self.tokens[repository] = None
+            return
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        response = self.session.get(
+            params["realm"],
+            params={
+                "service": params.get("service", ""),
+                "scope": f"repository:{repository}:pull",
+            },
+            auth=self.credentials,
+            timeout=60,
+        )
+        response.raise_for_status()
+        body = response.json()
+        self.tokens[repository] = body.get("token") or body.get("access_token")
+
+    def get(self, repository, path, headers=None, stream=False):
+        url = f"https://{self.hostname}/v2/{repository}/{path}"
+        for attempt in range(2):
+            headers = dict(headers or {})
+            auth = None
+            if self.tokens.get(repository):
+                headers["Authorization"] = "Bearer " + self.tokens[repository]
+            elif repository in self.tokens:
+                auth = self.credentials
+            response = self.session.get(
+                url, headers=headers, auth=auth, stream=stream, timeout=60
+            )
+            if response.status_code != 401 or attempt == 1:
+                break
+            # No token yet, or it expired
+            self._authenticate(repository, response.headers["WWW-Authenticate"])
+        response.raise_for_status()
+        return response
+
+
+def parse_image(image):
+    """
+    Split an image name, like registry/path/name:tag, into its parts
+    """
+    hostname, _, name = image.partition("/")
+    if "@" in name:
+        name, _, reference = name.partition("@")
+    else:
+        name, _, reference = name.rpartition(":") if ":" in name else (name, "", "")
+    return hostname, name, reference or "latest"
+
+
+def get_manifest(registry, repository, reference):
+    """
+    Return the manifest of an image and its digest. For a multi-platform
+    image, the manifest of the linux/amd64 one
+    """
+    response = registry.get(
+        repository, f"manifests/{reference}", {"Accept": ", ".join(MANIFEST_TYPES)}
+    )
+    content = response.content
+    manifest = json.loads(content)
+    if manifest.get("mediaType", response.headers.get("Content-Type")) in INDEX_TYPES:
+        entries = manifest["manifests"]
+        entry = next(
+            (
+                e
+                for e in entries
+                if e.get("platform", {}).get("architecture") == "amd64"
+            ),
+            entries[0],
+        )
+        return get_manifest(registry, repository, entry["digest"])
+    digest = "sha256:" + hashlib.sha256(content).hexdigest()
+    return content, manifest, digest
+
+
+def write_blob(store, digest, content):
+    path = os.path.join(store, "oci_shared", "sha256", digest.removeprefix("sha256:"))
+    if not os.path.exists(path):
+        with open(path + f".{os.getpid()}", "wb") as f:
+            f.write(content)
+        os.replace(path + f".{os.getpid()}", path)
+
+
+def is_whiteout(path):
+    st = os.lstat(path)
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == os.makedev(0, 0)
+
+
+def is_opaque(path):
+    try:
+        return os.getxattr(path, OPAQUE_XATTR, follow_symlinks=False) == b"y"
+    except OSError:
+        return False
+
+
+def convert_whiteouts(path):
+    """
+    Turn the OCI whiteouts of an extracted layer into overlayfs ones: a
+    .wh.<name> file becomes a 0/0 character device <name>, a .wh..wh..opq
+    file an opaque xattr on its directory
+    """
+    for root, _, files in os.walk(path):
+        for name in files:
+            if not name.startswith(WHITEOUT_PREFIX):
+                continue
+            os.remove(os.path.join(root, name))
+            if name == OPAQUE_MARKER:
+                os.setxattr(root, OPAQUE_XATTR, b"y")
+                continue
+            try:
+                os.mknod(
+                    os.path.join(root, name[len(WHITEOUT_PREFIX) :]),
+                    stat.S_IFCHR,
+                    os.makedev(0, 0),
+                )
+            except FileExistsError:
+                pass
+
+
+def disk_usage(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            total += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return total
+
+
+def layer_metadata(store, digest):
+    try:
+        with open(
+            os.path.join(store, "layers", digest + ".json"), "r", encoding="utf-8"
+        ) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def touch_layer(store, digest):
+    try:
+        os.utime(os.path.join(store, "layers", digest + ".json"))
+    except FileNotFoundError:
+        pass
+
+
+def write_layer_metadata(store, digest, metadata):
+    path = os.path.join(store, "layers", digest + ".json")
+    with open(f"{path}.{os.getpid()}", "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    os.replace(f"{path}.{os.getpid()}", path)
+
+
+def extract_layer(registry, repository, layer, store):
+    """
+    Download a layer, and extract it in layers/<digest> as it comes. The
+    layer is extracted in a temporary directory, renamed once its digest is
+    checked: an extracted layer is always complete
+    """
+    digest = layer["digest"].removeprefix("sha256:")
+    destination = os.path.join(store, "layers", digest)
+    if os.path.isdir(destination):
+        metadata = layer_metadata(store, digest)
+        if metadata.get("whiteouts") != "overlay":
+            # Extracted before whiteouts were converted
+            convert_whiteouts(destination)
+            metadata.update(whiteouts="overlay")
+        if "diskUsage" not in metadata:
+            metadata.update(diskUsage=disk_usage(destination))
+        write_layer_metadata(store, digest, metadata)
+        return False
+    tmp = f"{destination}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    response = registry.get(repository, f"blobs/{layer['digest']}", stream=True)
+    command = decompressor(layer["mediaType"])
+    tar = ["tar", "-x", "-f", "-", "-C", tmp]
+    sha256 = hashlib.sha256()
+    try:
+        if command is None:
+            decompress = None
+            tar_process = subprocess.Popen(
+                tar, stdin=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+            sink = tar_process.stdin
+        else:
+            decompress = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            tar_process = subprocess.Popen(
+                tar, stdin=decompress.stdout, stderr=subprocess.PIPE
+            )
+            decompress.stdout.close()
+            sink = decompress.stdin
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                sha256.update(chunk)
+                sink.write(chunk)
+        finally:
+            sink.close()
+        if decompress is not None and decompress.wait() != 0:
+            raise RuntimeError(f"Could not decompress layer {digest}")
+        tar_errors = tar_process.stderr.read().decode()
+        if tar_process.wait() != 0:
+            raise RuntimeError(f"Could not extract layer {digest}: {tar_errors}")
+        if sha256.hexdigest() != digest:
+            raise RuntimeError(
+                f"Layer {digest} is corrupted: got digest {sha256.hexdigest()}"
+            )
+        convert_whiteouts(tmp)
+        write_layer_metadata(
+            store,
+            digest,
+            {
+                "mediaType": layer["mediaType"],
+                "size": layer["size"],
+                "whiteouts": "overlay",
+                "diskUsage": disk_usage(tmp),
+            },
+        )
+        try:
+            os.rename(tmp, destination)
+        except OSError:
+            # Extracted by someone else in the meantime
+            if not os.path.isdir(destination):
+                raise
+            shutil.rmtree(tmp, ignore_errors=True)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    finally:
+        response.close()
+    return True
+
+
+def pull(image, local_path, store):
+    """
+    Fetch an image into local_path (relative to store), unless the local copy
+    is already the one the registry has
+    """
+    hostname, repository, reference = parse_image(image)
+    registry = Registry(hostname)
+    content, manifest, digest = get_manifest(registry, repository, reference)
+    image_path = os.path.join(store, local_path)
+    digest_path = os.path.join(image_path, "Digest.vauban")
+    if os.path.exists(digest_path):
+        with open(digest_path, "r", encoding="utf-8") as f:
+            up_to_date = f.read().strip() == digest
+        # Its layers may have been evicted by gc, or extracted before their
+        # whiteouts were converted: extract_layer converts them
+        if up_to_date and all(
+            os.path.isdir(os.path.join(store, "layers", layer["digest"][7:]))
+            and layer_metadata(store, layer["digest"][7:]).get("whiteouts")
+            == "overlay"
+            for layer in manifest["layers"]
+        ):
+            for layer in manifest["layers"]:
+                touch_layer(store, layer["digest"][7:])
+            print(f"{image} is up to date")
+            return
+        shutil.rmtree(image_path)
+
+    os.makedirs(os.path.join(store, "oci_shared", "sha256"), exist_ok=True)
+    os.makedirs(os.path.join(store, "layers"), exist_ok=True)
+    config_response = registry.get(repository, f"blobs/{manifest['config']['digest']}")
+    write_blob(store, manifest["config"]["digest"], config_response.content)
+    write_blob(store, digest, content)
+
+    print(f"Extracting {len(manifest['layers'])} layers of {image}")
+    parent = vauban_tracing.current()
+
+    def run(layer):
+        start = time.monotonic()
+        for attempt in range(3):
+            try:
+                # Pulls of images sharing the layer wait for the one
+                # extracting it, then find it extracted
+                with vauban_tracing.span(
+                    "pull_layer", parent=parent, layer=layer["digest"]
+                ), lock(
+                    os.path.join(store, "layers", layer["digest"][7:] + ".lock")
+                ):
+                    extracted = extract_layer(registry, repository, layer, store)
+                break
+            except (requests.RequestException, RuntimeError) as e:
+                if attempt == 2:
+                    raise
+                eprint(f"Retrying layer {layer['digest']}: {e}")
+        if extracted:
+            print(f"Extracted {layer['digest']} in {time.monotonic() - start:.1f}s")
+        else:
+            print(f"Skipping extraction of {layer['digest']}: already done")
+
+    # Images may have the same layer more than once
+    layers = {layer["digest"]: layer for layer in manifest["layers"]}.values()
+    with ThreadPoolExecutor(max_workers=PULL_JOBS) as executor:
+        # list() to raise the first error
+        list(executor.map(run, layers))
+
+    # The OCI layout of the image, pointing to the shared blobs
+    os.makedirs(image_path, exist_ok=True)
+    with open(os.path.join(image_path, "oci-layout"), "w", encoding="utf-8") as f:
+        json.dump({"imageLayoutVersion": "1.0.0"}, f)
+    with open(os.path.join(image_path, "index.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "schemaVersion": 2,
+                "manifests": [
+                    {
+                        "mediaType": manifest.get(
+                            "mediaType", "application/vnd.oci.image.manifest.v1+json"
+                        ),
+                        "digest": digest,
+                        "size": len(content),
+                    }
+                ],
+            },
+            f,
+        )
+    with open(digest_path, "w", encoding="utf-8") as f:
+        f.write(digest + "\n")
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def copy_layer(layer, destination):
+    """
+    Copy an extracted layer over a directory, applying its whiteouts: the
+    content of its opaque directories, and its whited out files, are removed
+    before the copy
+    """
+    whiteouts = []
+    for root, _, files in os.walk(layer):
+        relative = os.path.relpath(root, layer)
+        if relative != "." and is_opaque(root):
+            target = os.path.join(destination, relative)
+            if os.path.isdir(target) and not os.path.islink(target):
+                for name in os.listdir(target):
+                    remove(os.path.join(target, name))
+        for name in files:
+            if is_whiteout(os.path.join(root, name)):
+                whiteouts.append(os.path.join(relative, name))
+                remove(os.path.join(destination, relative, name))
+    subprocess.run(
+        ["rsync", "-a", "--force", "-r", "-l", layer + "/", destination + "/"],
+        check=True,
+    )
+    # rsync copied the whiteouts themselves
+    for path in whiteouts:
+        remove(os.path.join(destination, path))
+
+
+def is_directory(path):
+    return path is not None and os.path.isdir(path) and not os.path.islink(path)
+
+
+def merge_layers(layers):
+    """
+    Return the union of extracted layers, the lowest first, as {relative
+    path: path in the highest layer having it}, applying their whiteouts
+    """
+    entries = {}
+    # What the layers above hide from the ones below: their whiteouts, opaque
+    # directories and files
+    hidden = set()
+    for layer in reversed(layers):
+        hiding = set()
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            for entry in os.scandir(os.path.join(layer, directory)):
+                relative = os.path.join(directory, entry.name)
+                if relative in hidden:
+                    continue
+                entries.setdefault(relative, entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    if is_opaque(entry.path):
+                        hiding.add(relative)
+                    pending.append(relative)
+                    continue
+                if is_whiteout(entry.path):
+                    del entries[relative]
+                hiding.add(relative)
+        hidden |= hiding
+    return entries
+
+
+class SizeLimitedFile:
+    """
+    A file object refusing to grow over a size
+    """
+
+    def __init__(self, f, max_size):
+        self.f = f
+        self.max_size = max_size
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        # Like the check on an archive of an assembled conffs: its size must
+        # stay under the limit, not reach it
+        if self.max_size is not None and self.size >= self.max_size:
+            raise RuntimeError(
+                "The conffs archive size is too big. Must be less than "
+                f"{format_size(self.max_size)}"
+            )
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def add_directory(entries, added):
+    """
+    Put the content of a directory over entries, keeping the directories
+    already there
+    """
+    for root, dirs, files in os.walk(added):
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            target = os.path.relpath(path, added)
+            if not (is_directory(path) and is_directory(entries.get(target))):
+                entries[target] = path
+
+
+def union_entries(layers, added, added_over_toslash=True):
+    """
+    Return the union of extracted layers, as merge_layers does, with the
+    content of toslash moved to the root, and the content of the added
+    directory put over it, or under the content of toslash without
+    added_over_toslash. The directories already there are kept
+    """
+    entries = merge_layers(layers)
+    if added is not None and not added_over_toslash:
+        add_directory(entries, added)
+    # Like cp -r toslash/* ., which leaves out the hidden files, and keeps
+    # the directories already there
+    for relative in sorted(entries):
+        if relative.startswith("toslash/"):
+            path = entries.pop(relative)
+            target = relative[len("toslash/") :]
+            if relative.split("/")[1].startswith(".") or (
+                is_directory(path) and is_directory(entries.get(target))
+            ):
+                continue
+            entries[target] = path
+    entries.pop("toslash", None)
+    if added is not None and added_over_toslash:
+        add_directory(entries, added)
+    return entries
+
+
+def excluded(relative, patterns):
+    """
+    Return whether a path, or one of its parents, matches a glob pattern
+    """
+    parts = relative.split("/")
+    return any(
+        fnmatch.fnmatchcase("/".join(parts[:i]), pattern)
+        for i in range(1, len(parts) + 1)
+        for pattern in patterns
+    )
+
+
+def new_tarinfo(relative, kind, linkname=""):
+    """
+    Return the tar header of a directory or symlink that is in no layer
+    """
+    tarinfo = tarfile.TarInfo("./" + relative)
+    tarinfo.type = kind
+    tarinfo.mode = 0o777 if kind == tarfile.SYMTYPE else 0o755
+    tarinfo.mtime = int(time.time())
+    tarinfo.linkname = linkname
+    return tarinfo
+
+
+def write_entries(tar, entries, excludes, owner_names=True, xattrs=False):
+    """
+    Write the entries of union_entries to a tar, but the excluded ones. The
+    owners are stored by id only without owner_names, as mksquashfs would
+    from a directory
+    """
+    for relative in sorted(entries):
+        if excluded(relative, excludes):
+            continue
+        if isinstance(entries[relative], tarfile.TarInfo):
+            tar.addfile(entries[relative])
+            continue
+        tarinfo = tar.gettarinfo(entries[relative], "./" + relative)
+        if tarinfo is None:
+            # A socket
+            continue
+        if not owner_names:
+            tarinfo.uname = tarinfo.gname = ""
+        if xattrs:
+            for name in os.listxattr(entries[relative], follow_symlinks=False):
+                if name == OPAQUE_XATTR:
+                    continue
+                value = os.getxattr(entries[relative], name, follow_symlinks=False)
+                tarinfo.pax_headers["SCHILY.xattr." + name] = value.decode(
+                    "utf-8", "surrogateescape"
+                )
+        if tarinfo.isreg():
+            with open(entries[relative], "rb") as content:
+                tar.addfile(tarinfo, content)
+        else:
+            tar.addfile(tarinfo)
+
+
+def pack_conffs(layers, output, max_size, excludes, added):
+    """
+    Write the union of extracted layers to a gzipped tar archive, in one
+    pass, the way the conffs of a host are archived after being assembled:
+    the content of toslash is moved to the root, the excluded paths (and
+    their content) are left out, and the content of the added directory is
+    put over the layers, but under toslash: the sshd keys of a host are put
+    in its conffs before toslash is moved
+    """
+    entries = union_entries(layers, added, added_over_toslash=False)
+    tmp_output = f"{output}.tmp-{os.getpid()}"
+    try:
+        with open(tmp_output, "wb") as f, gzip.GzipFile(
+            fileobj=SizeLimitedFile(f, max_size), mode="wb", compresslevel=6
+        ) as compressed, tarfile.open(fileobj=compressed, mode="w|") as tar:
+            if layers:
+                tar.addfile(tar.gettarinfo(layers[-1], "."))
+            write_entries(tar, entries, excludes)
+        os.replace(tmp_output, output)
+    finally:
+        remove(tmp_output)
+
+
+def pack_rootfs(layers, output, squashfs_options, added):
+    """
+    Write the union of extracted layers to a squashfs image, streamed to
+    mksquashfs as a tar, with the cleanup export_rootfs does on an assembled
+    rootfs. Nothing but the image is written to disk
+    """
+    entries = union_entries(layers, added)
+    for relative, target in ROOTFS_SYMLINKS.items():
+        entries[relative] = new_tarinfo(relative, tarfile.SYMTYPE, target)
+    for relative in ROOTFS_DIRECTORIES:
+        entries.setdefault(relative, new_tarinfo(relative, tarfile.DIRTYPE))
+
+    tmp_output = f"{output}.tmp-{os.getpid()}"
+    try:
+        with subprocess.Popen(
+            ["mksquashfs", "-", tmp_output, "-tar", "-noappend", "-no-exports"]
+            + shlex.split(squashfs_options),
+            stdin=subprocess.PIPE,
+        ) as mksquashfs:
+            try:
+                with tarfile.open(fileobj=mksquashfs.stdin, mode="w|") as tar:
+                    write_entries(
+                        tar, entries, ROOTFS_EXCLUDES, owner_names=False, xattrs=True
+                    )
+            except BrokenPipeError:
+                # mksquashfs failed, and tells why
+                pass
+        if mksquashfs.returncode != 0:
+            raise RuntimeError(f"mksquashfs failed with code {mksquashfs.returncode}")
+        os.replace(tmp_output, output)
+    finally:
+        remove(tmp_output)
+
+
+def parse_size(size):
+    """
+    Parse a size like 200G, with an optional K, M, G or T binary suffix
+    """
+    size = size.strip().upper().removesuffix("B").removesuffix("I")
+    units = "KMGT"
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+StoredLayer = namedtuple("StoredLayer", "digest size last_used images")
+
+
+def store_images(store):
+    """
+    Return the images of the store, as {local path: manifest}
+    """
+    images = {}
+    for entry in os.scandir(store):
+        index_path = os.path.join(entry.path, "index.json")
+        if entry.name in ("layers", "oci_shared") or not os.path.isfile(index_path):
+            continue
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                manifest_digest = json.load(f)["manifests"][0]["digest"]
+            blob = os.path.join(store, "oci_shared", "sha256", manifest_digest[7:])
+            with open(blob, "r", encoding="utf-8") as f:
+                images[entry.name] = (manifest_digest, json.load(f))
+        except (OSError, ValueError, KeyError, IndexError):
+            # Incomplete: fetched again on next use
+            images[entry.name] = (None, {"layers": []})
+    return images
+
+
+def store_layers(store, images):
+    """
+    Return the extracted layers of the store, with the images using them
+    """
+    users = {}
+    for image, (_, manifest) in images.items():
+        for layer in manifest.get("layers", []):
+            users.setdefault(layer["digest"][7:], set()).add(image)
+    layers_path = os.path.join(store, "layers")
+    layers = []
+    for entry in os.scandir(layers_path):
+        if not entry.is_dir(follow_symlinks=False) or len(entry.name) != 64:
+            continue
+        metadata = layer_metadata(store, entry.name)
+        metadata_path = os.path.join(layers_path, entry.name + ".json")
+        try:
+            last_used = os.stat(metadata_path).st_mtime
+        except FileNotFoundError:
+            last_used = entry.stat().st_mtime
+        if "diskUsage" not in metadata:
+            metadata.update(diskUsage=disk_usage(entry.path))
+            write_layer_metadata(store, entry.name, metadata)
+            # Not a use of the layer
+            os.utime(metadata_path, (last_used, last_used))
+        layers.append(
+            StoredLayer(
+                entry.name,
+                metadata["diskUsage"],
+                last_used,
+                users.get(entry.name, set()),
+            )
+        )
+    return layers
+
+
+def mounted_layers():
+    """
+    Return the (prefixes of the) digests of the layers that are lower
+    directories of a mounted overlay
+    """
+    try:
+        with open("/proc/self/mountinfo", "r", encoding="utf-8") as f:
+            mountinfo = f.read()
+    except OSError:
+        return set()
+    return set(re.findall(r"(?:^|[=:/])([0-9a-f]{12,64})(?=[:,/\s])", mountinfo, re.M))
+
+
+def layers_to_evict(layers, budget, mounted, now):
+    """
+    Return the layers to evict for the store to fit in the budget: the
+    unreferenced ones first, the least recently used first. The layers used
+    during the grace period, or mounted, are kept
+    """
+    total = sum(layer.size for layer in layers)
+    evicted = []
+    for layer in sorted(layers, key=lambda l: (bool(l.images), l.last_used)):
+        if total <= budget:
+            break
+        if now - layer.last_used < GC_GRACE_PERIOD or any(
+            layer.digest.startswith(prefix) for prefix in mounted
+        ):
+            continue
+        total -= layer.size
+        evicted.append(layer)
+    return evicted
+
+
+def gc(store, budget):
+    """
+    Remove what no image uses in oci_shared, the leftovers of interrupted
+    extractions, then evict layers until the store fits in the budget: the
+    unreferenced ones first, the least recently used first. The images
+    using an evicted layer are removed, to be fetched again
+    """
+    images = store_images(store)
+    referenced_blobs = set()
+    for image, (manifest_digest, manifest) in list(images.items()):
+        index_path = os.path.join(store, image, "index.json")
+        if manifest_digest is None:
+            if time.time() - os.stat(index_path).st_mtime > GC_GRACE_PERIOD:
+                remove(os.path.join(store, image))
+                del images[image]
+        else:
+            referenced_blobs.add(manifest_digest[7:])
+            referenced_blobs.add(manifest["config"]["digest"][7:])
+    blobs_path = os.path.join(store, "oci_shared", "sha256")
+    if os.path.isdir(blobs_path):
+        for entry in os.scandir(blobs_path):
+            if entry.name not in referenced_blobs and (
+                time.time() - entry.stat().st_mtime > GC_GRACE_PERIOD
+            ):
+                remove(entry.path)
+    layers_path = os.path.join(store, "layers")
+    for entry in os.scandir(layers_path):
+        match = re.fullmatch(r"[0-9a-f]{64}\.tmp-(\d+)", entry.name)
+        if match and not os.path.exists(f"/proc/{match.group(1)}"):
+            remove(entry.path)
+        # The metadata or lock of a layer gone
+        if entry.name.endswith((".json", ".lock")) and not os.path.exists(
+            entry.path[:-5]
+        ):
+            if time.time() - entry.stat().st_mtime > GC_GRACE_PERIOD:
+                remove(entry.path)
+
+    layers = store_layers(store, images)
+    total = sum(layer.size for layer in layers)
+    if budget is None or total <= budget:
+        return []
+    evicted = layers_to_evict(layers, budget, mounted_layers(), time.time())
+    for layer in evicted:
+        for image in layer.images:
+            remove(os.path.join(store, image))
+        remove(os.path.join(layers_path, layer.digest))
+        remove(os.path.join(layers_path, layer.digest + ".json"))
+        remove(os.path.join(layers_path, layer.digest + ".lock"))
+        total -= layer.size
+    # The short links to the evicted layers, for overlay mounts
+    links_path = os.path.join(layers_path, "l")
+    if evicted and os.path.isdir(links_path):
+        for entry in os.scandir(links_path):
+            if not os.path.exists(entry.path):
+                os.remove(entry.path)
+    if total > budget:
+        eprint(
+            f"The image store takes {format_size(total)}, over its budget of "
+            f"{format_size(budget)}, but its other layers are in use"
+        )
+    return evicted
+
+
+def stats(store, budget):
+    images = store_images(store)
+    layers = store_layers(store, images)
+    referenced = [layer for layer in layers if layer.images]
+    lines = [
+        f"Images: {len(images)}",
+        f"Layers: {len(layers)}, {format_size(sum(l.size for l in layers))}"
+        + (f" out of a budget of {format_size(budget)}" if budget else ""),
+        f"  referenced:   {len(referenced)}, "
+        f"{format_size(sum(l.size for l in referenced))}",
+        f"  unreferenced: {len(layers) - len(referenced)}, "
+        f"{format_size(sum(l.size for l in layers if not l.images))}",
+        "",
+        f"{'layer':<14} {'size':>10} {'last used':>20} images",
+    ]
+    for layer in sorted(layers, key=lambda l: l.last_used, reverse=True):
+        last_used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(layer.last_used))
+        lines.append(
+            f"{layer.digest[:12]:<14} {format_size(layer.size):>10} {last_used:>20} "
+            + ", ".join(sorted(layer.images))
+        )
+    return "\n".join(lines)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command("pull")
+@click.option(
+    "--image",
+    required=True,
+    type=str,
+    help="The image to fetch, as registry/name:tag",
+)
+@click.option(
+    "--local-path",
+    required=True,
+    type=str,
+    help="Where to put the image, relative to the store",
+)
+@click.option(
+    "--store",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="The directory holding the images and their layers",
+)
+def pull_command(image, local_path, store):
+    """
+    Fetch an image and extract its layers
+    """
+    os.makedirs(os.path.join(store, "layers"), exist_ok=True)
+    # gc waits for no pull to be running
+    with vauban_tracing.span("pull_image", image=image), lock(
+        store_lock_path(store), exclusive=False
+    ):
+        pull(image, local_path, store)
+
+
+@cli.command("copy-layers")
+@click.option(
+    "--destination",
+    required=True,
+    type=click.Path(file_okay=False),
+    help="The directory to copy the layers to",
+)
+@click.argument("layers", nargs=-1, type=click.Path(file_okay=False, exists=True))
+def copy_layers_command(destination, layers):
+    """
+    Copy extracted layers, the lowest first, into a directory
+    """
+    for layer in layers:
+        copy_layer(layer.rstrip("/"), destination)
+
+
+@cli.command("pack-conffs")
+@click.option(
+    "--output",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="The archive to write",
+)
+@click.option(
+    "--max-size",
+    type=int,
+    default=None,
+    help="The size in bytes the archive must stay under",
+)
+@click.option(
+    "--exclude",
+    multiple=True,
+    help="A path to leave out, with its content, like var/log. Can be a glob",
+)
+@click.option(
+    "--add",
+    type=click.Path(file_okay=False, exists=True),
+    default=None,
+    help="A directory whose content is put over the layers, under toslash",
+)
+@click.argument("layers", nargs=-1, type=click.Path(file_okay=False, exists=True))
+def pack_conffs_command(output, max_size, exclude, add, layers):
+    """
+    Archive the union of extracted layers, the lowest first
+    """
+    try:
+        pack_conffs(
+            [layer.rstrip("/") for layer in layers], output, max_size, exclude, add
+        )
+    except RuntimeError as e:
+        raise click.ClickException(str(e)) from e
+
+
+@cli.command("pack-rootfs")
+@click.option(
+    "--output",
+    required=True,
+    type=click.Path(dir_okay=False),
+    help="The squashfs image to write",
+)
+@click.option(
+    "--squashfs-options",
+    default="",
+    type=str,
+    help="The mksquashfs compression options",
+)
+@click.option(
+    "--add",
+    type=click.Path(file_okay=False, exists=True),
+    default=None,
+    help="A directory whose content is put over the layers",
+)
+@click.argument("layers", nargs=-1, type=click.Path(file_okay=False, exists=True))
+def pack_rootfs_command(output, squashfs_options, add, layers):
+    """
+    Make a rootfs squashfs image of the union of extracted layers, the lowest
+    first
+    """
+    try:
+        pack_rootfs(
+            [layer.rstrip("/") for layer in layers], output, squashfs_options, add
+        )
+    except RuntimeError as e:
+        raise click.ClickException(str(e)) from e
+
+
+store_option = click.option(
+    "--store",
+    required=True,
+    type=click.Path(file_okay=False, exists=True),
+    help="The directory holding the images and their layers",
+)
+budget_option = click.option(
+    "--budget",
+    default=STORE_BUDGET,
+    show_default=True,
+    type=str,
+    help="The size to keep the store under, like 200G",
+)
+
+
+@cli.command("gc")
+@store_option
+@budget_option
+def gc_command(store, budget):
+    """
+    Remove unused blobs, and evict layers to fit in the budget
+    """
+    with vauban_tracing.span("image_store_gc"), lock(
+        store_lock_path(store), blocking=False
+    ) as locked:
+        if not locked:
+            print("The image store is being used, skipping its garbage collection")
+            return
+        evicted = gc(store, parse_size(budget) if budget else None)
+    for layer in evicted:
+        print(f"Evicted {layer.digest} ({format_size(layer.size)})")
+
+
+@cli.command("stats")
+@store_option
+@budget_option
+def stats_command(store, budget):
+    """
+    Show the size and last use of the layers of the store
+    """
+    print(stats(store, parse_size(budget) if budget else None))
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Compare the squashfs profiles of config.yml on a rootfs: the time each one
+takes to build the image, the size of the image, and how fast it is
+extracted back. Only the squashfs_profiles of the configuration are read:
+the masters are neither loaded nor checked
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import time
+
+import click
+import yaml
+
+# What export_rootfs gives mksquashfs, whatever the profile
+SQUASHFS_BASE_OPTIONS = ["-noappend", "-no-exports"]
+# The profile of the masters without one, from vauban.sh
+DEFAULT_SQUASHFS_OPTIONS = "-comp xz -always-use-fragments"
+
+
+def squashfs_profiles(config_path):
+    """
+    Return the squashfs profiles of a configuration file, the default first
+    """
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+    return {
+        "default": DEFAULT_SQUASHFS_OPTIONS,
+        **(config.get("configuration") or {}).get("squashfs_profiles", {}),
+    }
+
+
+def benchmark_squashfs(rootfs, profiles):
+    """
+    Compress a rootfs, a directory or a squashfs image, with each squashfs
+    profile, then extract it back. Return a table of the build time, size and
+    decompression throughput of each profile
+    """
+    mib = 1 << 20
+    # Next to the rootfs: /tmp may be too small for it
+    with tempfile.TemporaryDirectory(
+        prefix=".vauban-squashfs-", dir=os.path.dirname(os.path.abspath(rootfs))
+    ) as tmp:
+        source = rootfs
+        if os.path.isfile(rootfs):
+            source = os.path.join(tmp, "rootfs")
+            subprocess.run(
+                ["unsquashfs", "-no-progress", "-d", source, rootfs],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+        size = 0
+        for root, _, files in os.walk(source):
+            for name in files:
+                size += os.lstat(os.path.join(root, name)).st_size
+
+        lines = [
+            f"rootfs: {size / mib:.1f} MiB",
+            f"{'profile':<20} {'build':>8} {'size':>12} {'ratio':>6} {'extract':>13}",
+        ]
+        for name, options in profiles.items():
+            image = os.path.join(tmp, f"{name}.img")
+            extracted = os.path.join(tmp, "extracted")
+            start = time.monotonic()
+            subprocess.run(
+                ["mksquashfs", source, image, "-no-progress"]
+                + SQUASHFS_BASE_OPTIONS
+                + shlex.split(options),
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            build_time = time.monotonic() - start
+            image_size = os.path.getsize(image)
+            start = time.monotonic()
+            subprocess.run(
+                ["unsquashfs", "-no-progress", "-d", extracted, image],
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            extract_time = time.monotonic() - start
+            shutil.rmtree(extracted)
+            os.remove(image)
+            lines.append(
+                f"{name:<20} {build_time:>7.1f}s {image_size / mib:>8.1f} MiB"
+                f" {size / max(image_size, 1):>5.2f}x"
+                f" {size / mib / extract_time:>7.1f} MiB/s"
+            )
+    return "\n".join(lines)
+
+
+@click.command()
+@click.option(
+    "--config-path",
+    type=click.Path(exists=True, dir_okay=False),
+    default="config.yml",
+    show_default=True,
+    help="Vauban config file, whose squashfs_profiles are compared",
+)
+@click.option(
+    "--profile",
+    multiple=True,
+    help="A profile to compare, instead of all of them. Can be given several times",
+)
+@click.argument("rootfs", type=click.Path(exists=True))
+def benchmark(config_path, profile, rootfs):
+    """
+    Compress ROOTFS, a directory or a squashfs image like rootfs.img, with
+    each squashfs profile, and report their build time, size and
+    decompression throughput
+    """
+    profiles = squashfs_profiles(config_path)
+    unknown = [name for name in profile if name not in profiles]
+    if unknown:
+        raise click.BadParameter(
+            f"{', '.join(unknown)} not in squashfs_profiles", param_hint="--profile"
+        )
+    if profile:
+        profiles = {name: profiles[name] for name in profile}
+    print(benchmark_squashfs(rootfs, profiles))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,171 @@
+"""
+Build tracing for vauban. Spans are appended, one JSON object per line, to a
+trace file, in a format close to the OTLP JSON one. The trace context is
+passed to child processes (vauban.sh, kubernetes_controller.py) through the
+VAUBAN_TRACEPARENT environment variable, formatted like a W3C traceparent.
+Only the standard library is used, so that tracing costs nothing to import
+"""
+
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+TRACE_FILE_ENV = "VAUBAN_TRACE_FILE"
+TRACEPARENT_ENV = "VAUBAN_TRACEPARENT"
+
+_local = threading.local()
+_lock = threading.Lock()
+_trace_file = None
+
+
+def configure(path):
+    """
+    Write the spans of this process to the given file instead of the one from
+    the VAUBAN_TRACE_FILE environment variable
+    """
+    global _trace_file  # pylint: disable=global-statement
+    _trace_file = path
+
+
+def trace_file():
+    """
+    Return the file spans are written to, or None if tracing is disabled
+    """
+    return _trace_file or os.environ.get(TRACE_FILE_ENV) or None
+
+
+def _from_env():
+    parts = os.environ.get(TRACEPARENT_ENV, "").split("-")
+    if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+        return parts[1], parts[2]
+    return None
+
+
+def current():
+    """
+    Return the (trace id, span id) of the current span of this thread, or the
+    one inherited from the parent process, or None
+    """
+    stack = getattr(_local, "stack", None)
+    if stack:
+        return stack[-1]
+    return _from_env()
+
+
+def env(context=None):
+    """
+    Return the environment variables that make a child process record its
+    spans under the given context (the current span by default)
+    """
+    context = context or current()
+    if context is None:
+        return {}
+    return {TRACEPARENT_ENV: f"00-{context[0]}-{context[1]}-01"}
+
+
+def _write(record):
+    path = trace_file()
+    if path is None:
+        return
+    line = json.dumps(record) + "\n"
+    with _lock:
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(line)
+        except OSError:
+            pass
+
+
+def _write_span(context, parent, name, start, end, status, attributes):
+    _write(
+        {
+            "traceId": context[0],
+            "spanId": context[1],
+            "parentSpanId": parent[1] if parent is not None else "",
+            "name": name,
+            "startTimeUnixNano": start,
+            "endTimeUnixNano": end,
+            "attributes": {k: str(v) for k, v in attributes.items()},
+            "status": {"code": status},
+        }
+    )
+
+
+def _new_context(parent):
+    trace_id = parent[0] if parent is not None else secrets.token_hex(16)
+    return trace_id, secrets.token_hex(8)
+
+
+def record(name, start, end, parent=None, status="OK", **attributes):
+    """
+    Record a span that was measured by the caller, from start to end
+    (nanoseconds since the epoch, as returned by time.time_ns())
+    """
+    parent = parent or current()
+    _write_span(_new_context(parent), parent, name, start, end, status, attributes)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Record the time spent in the body of the with statement. The parent is
+    the current span, unless given: threads don't share their current span
+    """
+    parent = parent or current()
+    context = _new_context(parent)
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    _local.stack.append(context)
+    status = "OK"
+    start = time.time_ns()
+    try:
+        yield context
+    except BaseException:
+        status = "ERROR"
+        raise
+    finally:
+        # Not necessarily the last one: coroutines of a thread share its stack
+        _local.stack.remove(context)
+        _write_span(context, parent, name, start, time.time_ns(), status, attributes)
+
+
+def merge(path):
+    """
+    Append the spans of another trace file, written by a child process, to
+    our own trace file
+    """
+    own_path = trace_file()
+    if own_path is None or not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+    with _lock:
+        with open(own_path, "a", encoding="utf-8") as f:
+            f.write(content)
+
+
+def summary(path):
+    """
+    Return a table of the time spent per span name in a trace file, the
+    longest first
+    """
+    stats = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            duration = (entry["endTimeUnixNano"] - entry["startTimeUnixNano"]) / 1e9
+            count, total, longest = stats.get(entry["name"], (0, 0.0, 0.0))
+            stats[entry["name"]] = (count + 1, total + duration, max(longest, duration))
+
+    lines = [f"{'span':<40} {'count':>6} {'total':>10} {'max':>10}"]
+    for name, (count, total, longest) in sorted(
+        stats.items(), key=lambda item: item[1][1], reverse=True
+    ):
+        lines.append(f"{name:<40} {count:>6} {total:>9.1f}s {longest:>9.1f}s")
+    return "\n".join(lines)